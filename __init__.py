@@ -13,6 +13,12 @@ import binascii
 import hashlib
 import hmac
 import io
+import json
+import mmap
+import os
+import re
+
+from proofmarshal import varuint
 
 """Cryptographic proof marshalling
 
@@ -20,6 +26,56 @@ Provides serialization and deserialization for complex, immutable,
 cryptographic proofs.
 """
 
+class DeserializationError(Exception):
+    """Serialized data could not be deserialized"""
+
+class TruncationError(DeserializationError):
+    """Serialized data ended before the object did"""
+
+class TrailingDataError(DeserializationError):
+    """Serialized data continued after the end of the object"""
+
+class LimitExceededError(DeserializationError):
+    """Serialized data exceeded a deserialization limit"""
+
+class DeserializationLimits:
+    """Limits on the resources deserialization may use
+
+    Without limits a small hostile message can make deserialization allocate
+    a huge byte array, or nest deeply enough to exhaust the stack. Exceeding
+    a limit raises LimitExceededError; None is unlimited.
+
+    max_bytes         - Total bytes read
+    max_bytes_length  - Length of a single byte array
+    max_varuint_bytes - Encoded length of a single varuint
+    max_depth         - Nesting depth of objects, and of the nodes of a tree
+    max_nodes         - Number of nodes in a single tree
+    """
+
+    def __init__(self, max_bytes=None, max_bytes_length=None, max_varuint_bytes=None,
+                       max_depth=None, max_nodes=None):
+        self.max_bytes = max_bytes
+        self.max_bytes_length = max_bytes_length
+        self.max_varuint_bytes = max_varuint_bytes
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+
+    def check_bytes(self, total):
+        if self.max_bytes is not None and total > self.max_bytes:
+            raise LimitExceededError('more than %d bytes' % self.max_bytes)
+
+    def check_bytes_length(self, length):
+        if self.max_bytes_length is not None and length > self.max_bytes_length:
+            raise LimitExceededError('byte array of %d bytes; limit is %d' % (length, self.max_bytes_length))
+
+    def check_depth(self, depth):
+        if self.max_depth is not None and depth > self.max_depth:
+            raise LimitExceededError('nested more than %d deep' % self.max_depth)
+
+    def check_nodes(self, nodes):
+        if self.max_nodes is not None and nodes > self.max_nodes:
+            raise LimitExceededError('more than %d nodes' % self.max_nodes)
+
 class SerializationContext:
     """Context for serialization
 
@@ -43,7 +99,13 @@ class DeserializationContext:
 
     Allows multiple deserialization sources to share the same codebase, for
     instance bytes, memoized serialization, hashing, JSON, etc.
+
+    limits, if not None, is a DeserializationLimits enforced by the context.
     """
+    limits = None
+
+    # Nesting depth of read_obj()
+    depth = 0
 
     def read_varuint(self, attr_name, value):
         """Write a variable-length unsigned integer"""
@@ -56,24 +118,42 @@ class DeserializationContext:
     def read_obj(self, attr_name, serialization_class=None):
         raise NotImplementedError
 
+    def _obj_deserialize(self, serialization_class):
+        """Deserialize a nested object, checking its depth"""
+        if self.limits is None:
+            return serialization_class.ctx_deserialize(self)
+
+        self.depth += 1
+        try:
+            self.limits.check_depth(self.depth)
+            return serialization_class.ctx_deserialize(self)
+        finally:
+            self.depth -= 1
+
+    def _decode_varuint(self, buf, pos):
+        """Decode a varuint from a buffer, checking its length"""
+        if self.limits is None or self.limits.max_varuint_bytes is None:
+            return varuint.decode(buf, pos)
+
+        # Don't even look past the limit. The views are released before
+        # raising, so the traceback doesn't keep buf exported.
+        end = pos + self.limits.max_varuint_bytes
+        with memoryview(buf) as view, view[:end] as limited:
+            try:
+                return varuint.decode(limited, pos)
+            except ValueError:
+                pass
+        if end < len(buf):
+            raise LimitExceededError('varuint longer than %d bytes' % self.limits.max_varuint_bytes)
+        raise ValueError('truncated varuint')
+
 class StreamSerializationContext(SerializationContext):
     def __init__(self, fd):
         self.fd = fd
 
     def write_varuint(self, attr_name, value):
         # unsigned little-endian base128 format (LEB128)
-        if value == 0:
-            self.fd.write(b'\x00')
-
-        else:
-            while value != 0:
-                b = value & 0b01111111
-                if value > 0b01111111:
-                    b |= 0b10000000
-                self.fd.write(bytes([b]))
-                if value <= 0b01111111:
-                    break
-                value >>= 7
+        self.fd.write(varuint.encode(value))
 
     def write_bytes(self, attr_name, value, expected_length=None):
         if expected_length is None:
@@ -88,52 +168,344 @@ class StreamSerializationContext(SerializationContext):
         value.ctx_serialize(self)
 
 class StreamDeserializationContext(DeserializationContext):
-    def __init__(self, fd):
+    def __init__(self, fd, limits=None):
         self.fd = fd
+        self.limits = limits
+        self.bytes_read = 0
 
     def fd_read(self, l):
+        if self.limits is not None:
+            # Checked before reading, so nothing large is allocated
+            self.bytes_read += l
+            self.limits.check_bytes(self.bytes_read)
+
         r = self.fd.read(l)
-        assert len(r) == l # FIXME: raise exception
+        if r is None or len(r) != l:
+            raise TruncationError('needed %d bytes; stream returned %d' % (l, len(r or b'')))
         return r
 
     def read_varuint(self, attr_name):
-        value = 0
-        shift = 0
-
-        while True:
-            b = self.fd_read(1)[0]
-            value |= (b & 0b01111111) << shift
-            if not (b & 0b10000000):
-                break
-            shift += 7
-
-        return value
+        buf = self.fd_read(1)
+        if buf[0] < 0x80:
+            return buf[0]
+
+        max_bytes = None
+        if self.limits is not None:
+            max_bytes = self.limits.max_varuint_bytes
+
+        # Streams can't be peeked, so read up to the last byte before decoding
+        buf = bytearray(buf)
+        while buf[-1] >= 0x80:
+            if len(buf) == max_bytes:
+                raise LimitExceededError('varuint longer than %d bytes' % max_bytes)
+            buf += self.fd_read(1)
+        return varuint.decode(buf)[0]
 
     def read_bytes(self, attr_name, expected_length=None):
         if expected_length is None:
             expected_length = self.read_varuint(None)
+        if self.limits is not None:
+            self.limits.check_bytes_length(expected_length)
         return self.fd_read(expected_length)
 
     def read_obj(self, attr_name, serialization_class):
-        return serialization_class.ctx_deserialize(self)
+        return self._obj_deserialize(serialization_class)
+
+class _PreallocatedWriter:
+    """File-like writer into a fixed-size bytearray"""
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.pos = 0
+
+    def write(self, b):
+        end = self.pos + len(b)
+        if end > len(self.buf):
+            raise ValueError('wrote past the end of the %d byte preallocated buffer' % len(self.buf))
+        self.buf[self.pos:end] = b
+        self.pos = end
+        return len(b)
+
+    def getbuffer(self):
+        if self.pos != len(self.buf):
+            return memoryview(self.buf)[:self.pos]
+        return self.buf
+
+    def getvalue(self):
+        return bytes(self.getbuffer())
 
 class BytesSerializationContext(StreamSerializationContext):
-    def __init__(self):
-        super().__init__(io.BytesIO())
+    """Serialize to bytes
+
+    If size is given, usually from serialized_size(), the output is written
+    into a single bytearray of that size rather than a growing BytesIO.
+    """
+
+    def __init__(self, size=None):
+        if size is None:
+            super().__init__(io.BytesIO())
+        else:
+            super().__init__(_PreallocatedWriter(size))
 
     def getbytes(self):
         """Return the bytes serialized to date"""
         return self.fd.getvalue()
 
+    def getbuffer(self):
+        """Return the bytes serialized to date without copying"""
+        return self.fd.getbuffer()
+
+class LengthSerializationContext(SerializationContext):
+    """Calculate the exact length of the serialization, without any output"""
+
+    def __init__(self):
+        self.length = 0
+
+    def write_varuint(self, attr_name, value):
+        if 0 <= value < 0x80:
+            self.length += 1
+        else:
+            self.length += len(varuint.encode(value))
+
+    def write_bytes(self, attr_name, value, expected_length=None):
+        if expected_length is None:
+            self.write_varuint(None, len(value))
+        else:
+            # FIXME: proper exception
+            assert len(value) == expected_length
+        self.length += len(value)
+
+    def write_obj(self, attr_name, value, serialization_class=None):
+        if serialization_class is None:
+            value.ctx_serialize(self)
+        else:
+            serialization_class.ctx_serialize(value, self)
+
+class GatherSerializationContext(SerializationContext):
+    """Serialize to a list of buffers, for scatter-gather I/O
+
+    Byte arrays of at least copy_threshold bytes are referenced, not copied;
+    everything else is coalesced into scratch bytearrays between them. The
+    result can be written with writev() or sendmsg(), or joined with
+    getbytes(), so large byte arrays are copied at most once.
+    """
+
+    # Most platforms limit a single writev() or sendmsg() to 1024 buffers
+    MAX_BUFFERS = 1024
+
+    def __init__(self, copy_threshold=4096):
+        self.copy_threshold = copy_threshold
+        self.buffers = []
+        self.scratch = bytearray()
+
+    def write_varuint(self, attr_name, value):
+        self.scratch += varuint.encode(value)
+
+    def write_bytes(self, attr_name, value, expected_length=None):
+        if expected_length is None:
+            self.write_varuint(None, len(value))
+        else:
+            # FIXME: proper exception
+            assert len(value) == expected_length
+
+        if len(value) >= self.copy_threshold:
+            self._end_scratch()
+            self.buffers.append(value)
+        else:
+            self.scratch += value
+
+    def write_obj(self, attr_name, value, serialization_class=None):
+        assert serialization_class is None
+        value.ctx_serialize(self)
+
+    def _end_scratch(self):
+        if self.scratch:
+            self.buffers.append(self.scratch)
+            self.scratch = bytearray()
+
+    def getbuffers(self):
+        """Return the list of buffers serialized to date"""
+        self._end_scratch()
+        return self.buffers
+
+    def getbytes(self):
+        """Return the bytes serialized to date"""
+        return b''.join(self.getbuffers())
+
+    def _write_all(self, write):
+        buffers = list(self.getbuffers())
+        i = 0
+        while i < len(buffers):
+            n = write(buffers[i:i + self.MAX_BUFFERS])
+
+            # Skip past what was written, which may end part way through a
+            # buffer.
+            while i < len(buffers) and n >= len(buffers[i]):
+                n -= len(buffers[i])
+                i += 1
+            if n:
+                buffers[i] = memoryview(buffers[i])[n:]
+
+    def writev(self, fd):
+        """Write everything serialized to a file descriptor with os.writev()"""
+        self._write_all(lambda buffers: os.writev(fd, buffers))
+
+    def sendmsg(self, sock):
+        """Send everything serialized on a socket with sock.sendmsg()"""
+        self._write_all(sock.sendmsg)
+
 class BytesDeserializationContext(StreamDeserializationContext):
-    def __init__(self, buf):
-        super().__init__(io.BytesIO(buf))
+    def __init__(self, buf, limits=None):
+        super().__init__(io.BytesIO(buf), limits)
+        self.buf = buf
+
+    def read_varuint(self, attr_name):
+        # Decode directly from the buffer rather than a byte at a time
+        start = self.fd.tell()
+        value, offset = self._decode_varuint(self.buf, start)
+        if self.limits is not None:
+            self.bytes_read += offset - start
+            self.limits.check_bytes(self.bytes_read)
+        self.fd.seek(offset)
+        return value
+
+    def finish(self):
+        """Check that the entire buffer has been deserialized"""
+        if self.fd.tell() != len(self.buf):
+            raise TrailingDataError('%d bytes of trailing data' % (len(self.buf) - self.fd.tell()))
+
+class BufferDeserializationContext(DeserializationContext):
+    """Deserialize from a buffer without copying
+
+    Works with anything supporting the buffer protocol, such as bytes,
+    bytearray, memoryview or mmap. Byte arrays are returned as memoryview
+    slices of the underlying buffer, or as bytes if materialize is true.
+    """
+
+    def __init__(self, buf, materialize=False, limits=None):
+        self.buf = memoryview(buf)
+        if self.buf.format != 'B' or self.buf.ndim != 1:
+            self.buf = self.buf.cast('B')
+        self.pos = 0
+        self.materialize = materialize
+        self.limits = limits
+
+    def read_varuint(self, attr_name):
+        try:
+            value, self.pos = self._decode_varuint(self.buf, self.pos)
+        except ValueError:
+            raise TruncationError('truncated varuint at offset %d' % self.pos) from None
+        if self.limits is not None:
+            self.limits.check_bytes(self.pos)
+        return value
+
+    def read_bytes(self, attr_name, expected_length=None):
+        if expected_length is None:
+            expected_length = self.read_varuint(None)
+
+        start = self.pos
+        end = start + expected_length
+        if self.limits is not None:
+            self.limits.check_bytes_length(expected_length)
+            self.limits.check_bytes(end)
+        if end > len(self.buf):
+            raise TruncationError('needed %d bytes at offset %d; only %d remain' % \
+                                  (expected_length, start, len(self.buf) - start))
+        self.pos = end
+
+        r = self.buf[start:end]
+        if self.materialize:
+            r = r.tobytes()
+        return r
+
+    def read_obj(self, attr_name, serialization_class):
+        return self._obj_deserialize(serialization_class)
+
+    def finish(self):
+        """Check that the entire buffer has been deserialized"""
+        if self.pos != len(self.buf):
+            raise TrailingDataError('%d bytes of trailing data' % (len(self.buf) - self.pos))
+
 
-    # FIXME: need to check that there isn't extra crap at end of object
+class MemoizedSerializationContext(StreamSerializationContext):
+    """Serialize with back-references to repeated objects
 
+    Every object written with write_obj is prefixed with a varuint; zero if
+    the object follows in full, or n to refer to the nth object previously
+    serialized in full. Objects are identified by their hash, so output size
+    scales with unique content.
+
+    Objects whose class isn't MEMOIZABLE always follow in full, and aren't
+    numbered.
+    """
+
+    def __init__(self, fd):
+        super().__init__(fd)
+        self.memo = {}
+
+    def write_obj(self, attr_name, value, serialization_class=None):
+        if not (serialization_class or value).MEMOIZABLE:
+            self.write_varuint(None, 0)
+            if serialization_class is None:
+                value.ctx_serialize(self)
+            else:
+                serialization_class.ctx_serialize(value, self)
+            return
+
+        if serialization_class is None:
+            key = (value.__class__, value.hash)
+        else:
+            key = (serialization_class, serialization_class.calc_hash(value))
+
+        try:
+            self.write_varuint(None, self.memo[key])
+
+        except KeyError:
+            self.write_varuint(None, 0)
+            if serialization_class is None:
+                value.ctx_serialize(self)
+            else:
+                serialization_class.ctx_serialize(value, self)
+
+            # Numbered in the order they finish, which is the order the
+            # deserializer finishes reading them in.
+            self.memo[key] = len(self.memo) + 1
+
+class MemoizedDeserializationContext(BufferDeserializationContext):
+    """Deserialize the output of MemoizedSerializationContext
+
+    Back-references resolve to the same instance each time.
+    """
+
+    def __init__(self, buf, materialize=False, limits=None):
+        super().__init__(buf, materialize, limits)
+        self.memo = []
+
+    def read_obj(self, attr_name, serialization_class):
+        ref = self.read_varuint(None)
+        if ref == 0:
+            value = self._obj_deserialize(serialization_class)
+            if serialization_class.MEMOIZABLE:
+                self.memo.append(value)
+            return value
+
+        elif ref <= len(self.memo):
+            value = self.memo[ref - 1]
+            if not isinstance(value, serialization_class):
+                raise DeserializationError('back-reference %d is to a %s, not a %s' % \
+                                           (ref, value.__class__.__name__, serialization_class.__name__))
+            return value
+
+        else:
+            raise DeserializationError('back-reference %d to unknown object' % ref)
 
 class JsonSerializationContext:
-    """serialize to a human-readable JSON-compatible dict"""
+    """serialize to a human-readable JSON-compatible dict
+
+    Objects are nested dicts. Objects made of a sequence of like parts, such
+    as the nodes of a MerbinnerTree, use write_list() to write a list of
+    dicts.
+    """
 
     def __init__(self):
         self.pairs = {}
@@ -147,26 +519,398 @@ class JsonSerializationContext:
         hex_value = binascii.hexlify(value).decode('utf8')
         self.pairs[attr_name] = hex_value
 
+    def write_obj(self, attr_name, value, serialization_class=None):
+        assert attr_name not in self.pairs
+        ctx = JsonSerializationContext()
+        if serialization_class is None:
+            value.ctx_serialize(ctx)
+        else:
+            serialization_class.ctx_serialize(value, ctx)
+        self.pairs[attr_name] = ctx.pairs
+
+    def write_list(self, attr_name, items, write_item):
+        """Write a list, calling write_item(ctx, item) for each item"""
+        assert attr_name not in self.pairs
+        r = []
+        for item in items:
+            ctx = JsonSerializationContext()
+            write_item(ctx, item)
+            r.append(ctx.pairs)
+        self.pairs[attr_name] = r
+
 
 class JsonDeserializationContext:
-    """deserialize a human-readable JSON-compatible attribute-value pairs"""
+    """deserialize a human-readable JSON-compatible attribute-value pairs
 
-    def __init__(self, pairs=None):
+    The pairs are already in memory, so of the limits only max_bytes_length,
+    and the limits on trees, are enforced.
+    """
+
+    def __init__(self, pairs=None, limits=None):
         self.pairs = pairs
+        self.limits = limits
 
     def read_varuint(self, attr_name):
         return self.pairs[attr_name]
 
-    def read_bytes(self, attr_name, expected_length):
-        return binascii.unhexlify(self.pairs[attr_name].encode('utf8'))
+    def read_bytes(self, attr_name, expected_length=None):
+        hex_value = self.pairs[attr_name]
+        if self.limits is not None:
+            self.limits.check_bytes_length(len(hex_value) // 2)
+        return binascii.unhexlify(hex_value.encode('utf8'))
+
+    def read_obj(self, attr_name, serialization_class):
+        return serialization_class.ctx_deserialize(JsonDeserializationContext(self.pairs[attr_name], self.limits))
+
+    def iter_list(self, attr_name):
+        """Iterate over a list, yielding a context to read each item from"""
+        for pairs in self.pairs[attr_name]:
+            yield JsonDeserializationContext(pairs, self.limits)
+
+class JsonStreamSerializationContext(JsonSerializationContext):
+    """Serialize to JSON text, written incrementally to a text file object
+
+    The output is the same as json.dump() of what JsonSerializationContext
+    produces, without building it in memory first. Call finish() once the
+    object has been serialized.
+    """
+
+    # Byte arrays are converted to hex this many bytes at a time
+    HEX_CHUNK_SIZE = 64*1024
+
+    def __init__(self, fd):
+        self.fd = fd
+
+        # Whether or not each object being written has no attributes yet
+        self.empty = [True]
+        self.fd.write('{')
+
+    def _write_key(self, attr_name):
+        if self.empty[-1]:
+            self.empty[-1] = False
+        else:
+            self.fd.write(', ')
+        self.fd.write(json.dumps(attr_name))
+        self.fd.write(': ')
+
+    def _write_dict(self, serialize):
+        self.fd.write('{')
+        self.empty.append(True)
+        serialize()
+        self.empty.pop()
+        self.fd.write('}')
+
+    def write_varuint(self, attr_name, value):
+        self._write_key(attr_name)
+        self.fd.write(str(int(value)))
+
+    def write_bytes(self, attr_name, value, expected_length=None):
+        self._write_key(attr_name)
+        self.fd.write('"')
+        for i in range(0, len(value), self.HEX_CHUNK_SIZE):
+            self.fd.write(value[i:i + self.HEX_CHUNK_SIZE].hex())
+        self.fd.write('"')
+
+    def write_obj(self, attr_name, value, serialization_class=None):
+        self._write_key(attr_name)
+        if serialization_class is None:
+            self._write_dict(lambda: value.ctx_serialize(self))
+        else:
+            self._write_dict(lambda: serialization_class.ctx_serialize(value, self))
+
+    def write_list(self, attr_name, items, write_item):
+        self._write_key(attr_name)
+        self.fd.write('[')
+        for i, item in enumerate(items):
+            if i:
+                self.fd.write(', ')
+            self._write_dict(lambda: write_item(self, item))
+        self.fd.write(']')
+
+    def finish(self):
+        """Finish the top-level object"""
+        assert len(self.empty) == 1
+        self.fd.write('}')
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_INT = re.compile(r'-?[0-9]+')
+
+class JsonStreamDeserializationContext(JsonDeserializationContext):
+    """Deserialize JSON text, read incrementally from a text file object
+
+    Unlike JsonDeserializationContext attributes must be in the order they
+    are deserialized in, as written by JsonStreamSerializationContext. Byte
+    arrays are converted from hex as they are read. Call finish() once the
+    object has been deserialized.
+    """
+
+    def __init__(self, fd, chunk_size=64*1024, limits=None):
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.limits = limits
+        self.buf = ''
+        self.pos = 0
+
+        # Characters read, counted against max_bytes
+        self.chars_read = 0
+
+        # Whether or not each object being read has had no attributes yet
+        self.empty = [True]
+        self._expect('{')
+
+    def _fill(self):
+        """Read more text, discarding what has been parsed
+
+        Returns False at the end of the file.
+        """
+        data = self.fd.read(self.chunk_size)
+        if not data:
+            return False
+        if self.limits is not None:
+            self.chars_read += len(data)
+            self.limits.check_bytes(self.chars_read)
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Skip whitespace, returning the next character"""
+        while True:
+            self.pos = _JSON_WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            elif not self._fill():
+                raise TruncationError('JSON ended unexpectedly')
+
+    def _expect(self, c):
+        actual = self._peek()
+        if actual != c:
+            raise DeserializationError('expected %r in JSON; got %r' % (c, actual))
+        self.pos += 1
+
+    def _count_backslashes(self, end):
+        """Count the backslashes immediately before end"""
+        n = 0
+        while end - n > self.pos and self.buf[end - n - 1] == '\\':
+            n += 1
+        return n
+
+    def _iter_string(self):
+        """Yield the raw contents of a string in pieces"""
+        self._expect('"')
+        while True:
+            end = self.buf.find('"', self.pos)
+            while end != -1 and self._count_backslashes(end) % 2:
+                # Escaped quote
+                end = self.buf.find('"', end + 1)
+
+            if end != -1:
+                yield self.buf[self.pos:end]
+                self.pos = end + 1
+                return
+
+            # Don't split an escape sequence
+            split = len(self.buf) - self._count_backslashes(len(self.buf))
+            yield self.buf[self.pos:split]
+            self.pos = split
+            if not self._fill():
+                raise TruncationError('JSON ended part way through a string')
+
+    def _read_key(self, attr_name):
+        if self.empty[-1]:
+            self.empty[-1] = False
+        else:
+            self._expect(',')
+        key = ''.join(self._iter_string())
+        if '\\' in key:
+            key = json.loads('"%s"' % key)
+        if key != attr_name:
+            raise DeserializationError('expected JSON attribute %r; got %r' % (attr_name, key))
+        self._expect(':')
+
+    def _read_dict(self, deserialize):
+        self._expect('{')
+        self.empty.append(True)
+        if self.limits is not None:
+            self.limits.check_depth(len(self.empty) - 1)
+        r = deserialize()
+        self.empty.pop()
+        self._expect('}')
+        return r
+
+    def read_varuint(self, attr_name):
+        self._read_key(attr_name)
+        self._peek()
+        while True:
+            m = _JSON_INT.match(self.buf, self.pos)
+            if m is not None and m.end() == len(self.buf) and self._fill():
+                # May continue
+                continue
+            elif m is None:
+                raise DeserializationError('expected integer in JSON for attribute %r' % attr_name)
+            self.pos = m.end()
+            value = int(m.group())
+            if value < 0:
+                raise DeserializationError('varuint must not be negative; got %d' % value)
+            return value
+
+    def read_bytes(self, attr_name, expected_length=None):
+        self._read_key(attr_name)
+        r = bytearray()
+        odd = ''
+        try:
+            for piece in self._iter_string():
+                piece = odd + piece
+                split = len(piece) & ~1
+                r += bytes.fromhex(piece[:split])
+                odd = piece[split:]
+                if self.limits is not None:
+                    self.limits.check_bytes_length(len(r))
+        except ValueError:
+            raise DeserializationError('invalid hex in JSON for attribute %r' % attr_name) from None
+        if odd:
+            raise DeserializationError('odd-length hex in JSON for attribute %r' % attr_name)
+
+        if expected_length is not None and len(r) != expected_length:
+            raise DeserializationError('expected %d bytes for attribute %r; got %d' % \
+                                       (expected_length, attr_name, len(r)))
+        return bytes(r)
+
+    def read_obj(self, attr_name, serialization_class):
+        self._read_key(attr_name)
+        return self._read_dict(lambda: serialization_class.ctx_deserialize(self))
+
+    def iter_list(self, attr_name):
+        self._read_key(attr_name)
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            self._expect('{')
+            self.empty.append(True)
+            yield self
+            self.empty.pop()
+            self._expect('}')
+
+            c = self._peek()
+            self.pos += 1
+            if c == ']':
+                return
+            elif c != ',':
+                raise DeserializationError("expected ',' or ']' in JSON; got %r" % c)
+
+    def finish(self):
+        """Check that the top-level object is complete and nothing follows"""
+        assert len(self.empty) == 1
+        self._expect('}')
+        try:
+            c = self._peek()
+        except TruncationError:
+            return
+        raise TrailingDataError('trailing data after JSON object: %r' % c)
+
+_hash_cache = None
+def set_hash_cache(cache):
+    """Set the process-wide hash cache, returning the previous one
+
+    The cache is consulted by HashSerializationContext.write_obj before
+    hashing an object; None disables it.
+    """
+    global _hash_cache
+    prev = _hash_cache
+    _hash_cache = cache
+    return prev
+
+def get_hash_cache():
+    """Return the process-wide hash cache, or None if disabled"""
+    return _hash_cache
+
+class HashEngine:
+    """Keyed hash function used to calculate the hashes of objects
+
+    Classes select theirs with the HASH_ENGINE attribute, keyed with their
+    HASH_HMAC_KEY. Digests are always 32 bytes.
+
+    The keyed initial state is computed once per key and copied thereafter.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._states = {}
+
+    def _new_state(self, key):
+        raise NotImplementedError
+
+    def new(self, key):
+        """Return a new hash object, with update() and digest(), for key"""
+        try:
+            state = self._states[key]
+        except KeyError:
+            state = self._new_state(key)
+            self._states[key] = state
+        return state.copy()
+
+    def __repr__(self):
+        return '<HashEngine %s>' % self.name
+
+class HmacHashEngine(HashEngine):
+    """HMAC with a hashlib hash function"""
+
+    def __init__(self, name, digestmod):
+        super().__init__(name)
+        self.digestmod = digestmod
+
+    def _new_state(self, key):
+        return hmac.new(key, digestmod=self.digestmod)
+
+class Blake2HashEngine(HashEngine):
+    """BLAKE2 in its native keyed mode
+
+    Faster than HMAC, as the key costs one compression rather than two per
+    hash. Keys may be up to 64 bytes for BLAKE2b, and 32 bytes for BLAKE2s.
+    """
+
+    def __init__(self, name, hash_func):
+        super().__init__(name)
+        self.hash_func = hash_func
+
+    def _new_state(self, key):
+        return self.hash_func(key=key, digest_size=32)
+
+HMAC_SHA256 = HmacHashEngine('hmac-sha256', hashlib.sha256)
+BLAKE2B = Blake2HashEngine('blake2b', hashlib.blake2b)
+BLAKE2S = Blake2HashEngine('blake2s', hashlib.blake2s)
+
+def new_hmac(key, engine=HMAC_SHA256):
+    """Return a new hash object for key from engine, HMAC-SHA256 by default"""
+    return engine.new(key)
 
 class HashSerializationContext(BytesSerializationContext):
     """Serialization context for calculating hashes of objects
 
     Serialization is never recursive in this context; when encountering an
     object its hash is used instead.
+
+    If hmac_key is given everything written is fed directly into a hash from
+    engine keyed with it, returned by digest(); nothing is buffered.
+    Otherwise the hash preimage is buffered, and returned by getbytes().
     """
 
+    def __init__(self, hmac_key=None, engine=HMAC_SHA256):
+        if hmac_key is None:
+            super().__init__()
+            self.hasher = None
+            self._update = self.fd.write
+        else:
+            self.fd = None
+            self.hasher = new_hmac(hmac_key, engine)
+            self._update = self.hasher.update
+
+    def write_varuint(self, attr_name, value):
+        self._update(varuint.encode(value))
+
     def write_bytes(self, attr_name, value, expected_length=None):
         # FIXME: should we write the bytes themselves, or the hash of the bytes?
         if expected_length is None:
@@ -174,11 +918,15 @@ class HashSerializationContext(BytesSerializationContext):
         else:
             # FIXME: proper exception
             assert len(value) == expected_length
-        self.fd.write(value)
+        self._update(value)
 
     def write_obj(self, attr_name, value, serialization_class=None):
         hash = None
-        if serialization_class is None:
+        cache = _hash_cache
+        if cache is not None and (serialization_class or value).HASH_CACHEABLE:
+            hash = cache.obj_hash(value, serialization_class)
+
+        elif serialization_class is None:
             hash = value.hash
 
         else:
@@ -187,10 +935,34 @@ class HashSerializationContext(BytesSerializationContext):
         assert len(hash) == 32
         self.write_bytes(None, hash, 32)
 
+    def getbytes(self):
+        if self.hasher is not None:
+            raise ValueError('nothing is buffered when hashing with a key; use digest()')
+        return super().getbytes()
+
+    def getbuffer(self):
+        if self.hasher is not None:
+            raise ValueError('nothing is buffered when hashing with a key; use digest()')
+        return super().getbuffer()
+
+    def digest(self):
+        """Return the digest of everything written to date"""
+        if self.hasher is None:
+            raise ValueError('no hmac_key to hash with; use getbytes()')
+        return self.hasher.digest()
+
 class Serializer:
     """Serializes an instance of a class"""
 
     HASH_HMAC_KEY = None
+    HASH_ENGINE = HMAC_SHA256
+
+    # Whether or not hashes may be looked up in the process-wide hash cache
+    HASH_CACHEABLE = True
+
+    # Whether or not instances with the same hash may be serialized as
+    # back-references to each other by MemoizedSerializationContext
+    MEMOIZABLE = True
 
     @classmethod
     def ctx_serialize(cls, self, ctx):
@@ -210,9 +982,16 @@ class Serializer:
         return ctx.getbytes()
 
     @classmethod
-    def stream_deserialize(cls, fd):
+    def serialized_size(cls, self):
+        """Return the length of the serialization, without serializing"""
+        ctx = LengthSerializationContext()
+        cls.ctx_serialize(self, ctx)
+        return ctx.length
+
+    @classmethod
+    def stream_deserialize(cls, fd, limits=None):
         """Deserialize from a stream"""
-        ctx = StreamDeserializationContext(fd)
+        ctx = StreamDeserializationContext(fd, limits)
         return cls.ctx_deserialize(ctx)
 
     @classmethod
@@ -222,10 +1001,17 @@ class Serializer:
         self.ctx_serialize(ctx)
 
     @classmethod
-    def deserialize(cls, buf):
+    def deserialize(cls, buf, limits=None):
         """Deserialize from bytes"""
-        ctx = BytesDeserializationContext(buf)
-        return cls.ctx_deserialize(ctx)
+        return cls.buffer_deserialize(buf, materialize=True, limits=limits)
+
+    @classmethod
+    def buffer_deserialize(cls, buf, materialize=False, limits=None):
+        """Deserialize from a buffer without copying"""
+        ctx = BufferDeserializationContext(buf, materialize, limits)
+        r = cls.ctx_deserialize(ctx)
+        ctx.finish()
+        return r
 
     @classmethod
     def json_serialize(cls, self):
@@ -235,16 +1021,31 @@ class Serializer:
         return ctx.pairs
 
     @classmethod
-    def json_deserialize(cls, pairs):
+    def json_deserialize(cls, pairs, limits=None):
         """Serialize from JSON-compatible attribute-value pairs"""
-        ctx = JsonDeserializationContext(pairs)
+        ctx = JsonDeserializationContext(pairs, limits)
         return cls.ctx_deserialize(ctx)
 
+    @classmethod
+    def json_stream_serialize(cls, self, fd):
+        """Serialize as JSON text to a text file object, incrementally"""
+        ctx = JsonStreamSerializationContext(fd)
+        cls.ctx_serialize(self, ctx)
+        ctx.finish()
+
+    @classmethod
+    def json_stream_deserialize(cls, fd, limits=None):
+        """Deserialize from JSON text in a text file object, incrementally"""
+        ctx = JsonStreamDeserializationContext(fd, limits=limits)
+        r = cls.ctx_deserialize(ctx)
+        ctx.finish()
+        return r
+
     @classmethod
     def calc_hash(cls, self):
-        ctx = HashSerializationContext()
+        ctx = HashSerializationContext(cls.HASH_HMAC_KEY, cls.HASH_ENGINE)
         cls.ctx_serialize(self, ctx)
-        return hmac.HMAC(cls.HASH_HMAC_KEY, ctx.getbytes(), hashlib.sha256).digest()
+        return ctx.digest()
 
 class ImmutableProof:
     """Base class for immutable proof objects
@@ -254,6 +1055,14 @@ class ImmutableProof:
     __slots__ = []
 
     HASH_HMAC_KEY = None
+    HASH_ENGINE = HMAC_SHA256
+
+    # Whether or not hashes may be looked up in the process-wide hash cache
+    HASH_CACHEABLE = True
+
+    # Whether or not instances with the same hash may be serialized as
+    # back-references to each other by MemoizedSerializationContext
+    MEMOIZABLE = True
 
     def __setattr__(self, name, value):
         raise AttributeError('Object is immutable')
@@ -276,10 +1085,16 @@ class ImmutableProof:
         self.ctx_serialize(ctx)
         return ctx.getbytes()
 
+    def serialized_size(self):
+        """Return the length of the serialization, without serializing"""
+        ctx = LengthSerializationContext()
+        self.ctx_serialize(ctx)
+        return ctx.length
+
     @classmethod
-    def stream_deserialize(cls, fd):
+    def stream_deserialize(cls, fd, limits=None):
         """Deserialize from a stream"""
-        ctx = StreamDeserializationContext(fd)
+        ctx = StreamDeserializationContext(fd, limits)
         return cls.ctx_deserialize(ctx)
 
     def stream_serialize(self, fd):
@@ -288,10 +1103,59 @@ class ImmutableProof:
         self.ctx_serialize(ctx)
 
     @classmethod
-    def deserialize(cls, buf):
+    def deserialize(cls, buf, limits=None):
         """Deserialize from bytes"""
-        ctx = BytesDeserializationContext(buf)
-        return cls.ctx_deserialize(ctx)
+        return cls.buffer_deserialize(buf, materialize=True, limits=limits)
+
+    @classmethod
+    def buffer_deserialize(cls, buf, materialize=False, limits=None):
+        """Deserialize from a buffer without copying
+
+        Unless materialize is true byte arrays in the result are memoryview
+        slices of buf, keeping it alive.
+        """
+        ctx = BufferDeserializationContext(buf, materialize, limits)
+        self = cls.ctx_deserialize(ctx)
+        ctx.finish()
+        return self
+
+    @classmethod
+    def mmap_deserialize(cls, fd, materialize=False, limits=None):
+        """Deserialize from a file by memory-mapping it
+
+        If materialize is true the mapping is closed before returning.
+        Otherwise the result owns it, and it is unmapped once the result and
+        every byte array taken from it have been garbage collected.
+        """
+        if os.fstat(fd.fileno()).st_size == 0:
+            raise TruncationError('empty file')
+        buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if not materialize:
+            return cls.buffer_deserialize(buf, materialize, limits)
+
+        ctx = BufferDeserializationContext(buf, materialize, limits)
+        try:
+            self = cls.ctx_deserialize(ctx)
+            ctx.finish()
+        finally:
+            ctx.buf.release()
+            buf.close()
+        return self
+
+    def memoized_serialize(self):
+        """Serialize to bytes, with back-references to repeated objects"""
+        fd = io.BytesIO()
+        ctx = MemoizedSerializationContext(fd)
+        self.ctx_serialize(ctx)
+        return fd.getvalue()
+
+    @classmethod
+    def memoized_deserialize(cls, buf, materialize=True, limits=None):
+        """Deserialize from bytes produced by memoized_serialize()"""
+        ctx = MemoizedDeserializationContext(buf, materialize, limits)
+        self = cls.ctx_deserialize(ctx)
+        ctx.finish()
+        return self
 
     def json_serialize(self):
         """Serialize to JSON-compatible attribute-value pairs"""
@@ -300,15 +1164,29 @@ class ImmutableProof:
         return ctx.pairs
 
     @classmethod
-    def json_deserialize(cls, pairs):
+    def json_deserialize(cls, pairs, limits=None):
         """Serialize from JSON-compatible attribute-value pairs"""
-        ctx = JsonDeserializationContext(pairs)
+        ctx = JsonDeserializationContext(pairs, limits)
         return cls.ctx_deserialize(ctx)
 
+    def json_stream_serialize(self, fd):
+        """Serialize as JSON text to a text file object, incrementally"""
+        ctx = JsonStreamSerializationContext(fd)
+        self.ctx_serialize(ctx)
+        ctx.finish()
+
+    @classmethod
+    def json_stream_deserialize(cls, fd, limits=None):
+        """Deserialize from JSON text in a text file object, incrementally"""
+        ctx = JsonStreamDeserializationContext(fd, limits=limits)
+        self = cls.ctx_deserialize(ctx)
+        ctx.finish()
+        return self
+
     def calc_hash(self):
-        ctx = HashSerializationContext()
+        ctx = HashSerializationContext(self.HASH_HMAC_KEY, self.HASH_ENGINE)
         self.ctx_serialize(ctx)
-        return hmac.HMAC(self.HASH_HMAC_KEY, ctx.getbytes(), hashlib.sha256).digest()
+        return ctx.digest()
 
     @property
     def hash(self):
@@ -0,0 +1,145 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Benchmarks
+
+Run the whole suite, optionally comparing against a baseline, with:
+
+    python -m proofmarshal.bench [--baseline FILE] [--output FILE]
+
+Individual modules can also be run on their own, for instance:
+
+    python -m proofmarshal.bench.merbinnertree_parallel
+"""
+
+import random
+import struct
+import time
+
+import proofmarshal
+from proofmarshal.merbinnertree import MerbinnerTree
+
+BENCHMARKS = []
+
+def benchmark(name, size=None):
+    """Register a benchmark
+
+    Decorates a function that returns (func, setup); see timeit(). size, if
+    given, is the number of items the benchmark works on, allowing large
+    benchmarks to be skipped.
+    """
+    def decorator(make):
+        BENCHMARKS.append((name, size, make))
+        return make
+    return decorator
+
+def timeit(func, setup=None, min_time=0.2):
+    """Return the best time per call of func, in seconds
+
+    func is called repeatedly until at least min_time has elapsed, including
+    setup. If setup is given it is called, untimed, before every call and its
+    result passed to func.
+    """
+    best = None
+    deadline = time.perf_counter() + min_time
+    while best is None or time.perf_counter() < deadline:
+        if setup is not None:
+            arg = setup()
+            start = time.perf_counter()
+            func(arg)
+        else:
+            start = time.perf_counter()
+            func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class BenchVarUInt(proofmarshal.ImmutableProof):
+    HASH_HMAC_KEY = bytes.fromhex('8f1d3c4e0a6b2f7d9e5c1a3b7d2e4f60')
+
+    def __init__(self, i):
+        object.__setattr__(self, 'i', i)
+
+    def _ctx_serialize(self, ctx):
+        ctx.write_varuint('i', self.i)
+
+    def _ctx_deserialize(self, ctx):
+        object.__setattr__(self, 'i', ctx.read_varuint('i'))
+
+class BenchBytes(proofmarshal.ImmutableProof):
+    HASH_HMAC_KEY = bytes.fromhex('2b7e151628aed2a6abf7158809cf4f3c')
+
+    def __init__(self, buf):
+        object.__setattr__(self, 'buf', buf)
+
+    def _ctx_serialize(self, ctx):
+        ctx.write_bytes('buf', self.buf)
+
+    def _ctx_deserialize(self, ctx):
+        object.__setattr__(self, 'buf', ctx.read_bytes('buf'))
+
+class BenchNested(proofmarshal.ImmutableProof):
+    """Chain of nested objects, ending in a BenchBytes"""
+    HASH_HMAC_KEY = bytes.fromhex('5a0c1e2d3f4b6a7c8e9d0f1a2b3c4d5e')
+
+    def __init__(self, i, child):
+        object.__setattr__(self, 'i', BenchVarUInt(i))
+        object.__setattr__(self, 'child', child)
+
+    def _ctx_serialize(self, ctx):
+        ctx.write_obj('i', self.i)
+        ctx.write_varuint('more', int(isinstance(self.child, BenchNested)))
+        ctx.write_obj('child', self.child)
+
+    def _ctx_deserialize(self, ctx):
+        object.__setattr__(self, 'i', ctx.read_obj('i', BenchVarUInt))
+        if ctx.read_varuint('more'):
+            object.__setattr__(self, 'child', ctx.read_obj('child', BenchNested))
+        else:
+            object.__setattr__(self, 'child', ctx.read_obj('child', BenchBytes))
+
+def nested(depth):
+    """Return a BenchNested chain depth objects deep"""
+    obj = BenchBytes(b'\xff' * 32)
+    for i in range(depth):
+        obj = BenchNested(i, obj)
+    return obj
+
+
+class BenchMerbinnerTree(MerbinnerTree):
+    """Tree with 32 byte keys, used directly as key hashes, and 32 byte values"""
+    HASH_HMAC_KEY = bytes.fromhex('6c1b4a9a0b0f6ea0b1a81bd4e0bd8b1c')
+
+    key_serialize = lambda self, ctx, key: ctx.write_bytes('key', key, 32)
+    key_deserialize = lambda self, ctx: ctx.read_bytes('key', 32)
+
+    value_serialize = lambda self, ctx, value: ctx.write_bytes('value', value, 32)
+    value_deserialize = lambda self, ctx: ctx.read_bytes('value', 32)
+
+    key_gethash = lambda self, key: key
+
+_sum_struct = struct.Struct('>Q')
+class BenchSummedMerbinnerTree(BenchMerbinnerTree):
+    """As above, summing the last two bytes of every value"""
+    HASH_HMAC_KEY = bytes.fromhex('d1e2f3a4b5c6d7e8f90a1b2c3d4e5f60')
+
+    sum_serialize = lambda self, ctx, sum: ctx.write_bytes('sum', _sum_struct.pack(sum), 8)
+    sum_deserialize = lambda self, ctx: _sum_struct.unpack(ctx.read_bytes('sum', 8))[0]
+
+    value_getsum = lambda self, value: value[-2] << 8 | value[-1]
+
+def random_items(n, seed=0):
+    """Return n deterministic pseudo-random (key, value) pairs"""
+    rand = random.Random(seed)
+    return [(rand.getrandbits(256).to_bytes(32, 'big'), rand.getrandbits(256).to_bytes(32, 'big'))
+            for i in range(n)]
@@ -0,0 +1,114 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+"""Run the benchmark suite
+
+Results are written as JSON, and compared against a baseline if given;
+benchmarks slower than the baseline by more than the threshold are reported
+as regressions, and the exit status is non-zero.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+
+from proofmarshal.bench import BENCHMARKS, timeit
+import proofmarshal.bench.core
+import proofmarshal.bench.merbinnertree
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+def run(names=None, max_size=None, min_time=0.2, log=None):
+    """Run benchmarks, returning a dict of name: seconds per call"""
+    results = {}
+    for name, size, make in BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        if size is not None and max_size is not None and size > max_size:
+            continue
+
+        func, setup = make()
+        results[name] = timeit(func, setup, min_time)
+        if log is not None:
+            print('%-50s %12.6f' % (name, results[name]), file=log)
+    return results
+
+def compare(results, baseline, threshold):
+    """Compare results against a baseline
+
+    Returns a list of (name, baseline seconds, seconds, ratio) for every
+    benchmark in both, and a list of the names of those that regressed.
+    """
+    rows = []
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name] / baseline[name]
+        rows.append((name, baseline[name], results[name], ratio))
+        if ratio > threshold:
+            regressions.append(name)
+    return (rows, regressions)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-k', dest='names', action='append', metavar='SUBSTR',
+                        help='only run benchmarks whose names contain SUBSTR; may be repeated')
+    parser.add_argument('--max-size', type=int, default=100000,
+                        help='skip benchmarks on more items than this (default: %(default)s)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum time to spend on each benchmark (default: %(default)s)')
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='write JSON results to FILE rather than stdout')
+    parser.add_argument('--baseline', metavar='FILE', nargs='?', const=DEFAULT_BASELINE,
+                        help='compare against baseline results (default: %s)' % DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results to the baseline file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='ratio to the baseline above which a benchmark has regressed (default: %(default)s)')
+    args = parser.parse_args()
+
+    results = run(args.names, args.max_size, args.min_time, log=sys.stderr)
+    doc = {'python': platform.python_version(),
+           'implementation': platform.python_implementation(),
+           'machine': platform.machine(),
+           'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(doc, fd, indent=1, sort_keys=True)
+    else:
+        json.dump(doc, sys.stdout, indent=1, sort_keys=True)
+        print()
+
+    if args.save_baseline:
+        with open(args.baseline or DEFAULT_BASELINE, 'w') as fd:
+            json.dump(doc, fd, indent=1, sort_keys=True)
+            fd.write('\n')
+
+    elif args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)['results']
+
+        rows, regressions = compare(results, baseline, args.threshold)
+        print('%-50s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio'), file=sys.stderr)
+        for name, baseline_time, current_time, ratio in rows:
+            print('%-50s %12.6f %12.6f %8.2f%s' % (name, baseline_time, current_time, ratio,
+                                                   ' REGRESSION' if name in regressions else ''),
+                  file=sys.stderr)
+
+        if regressions:
+            print('%d benchmark(s) regressed' % len(regressions), file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+"""Benchmarks of the serialization, deserialization and hash contexts"""
+
+import io
+
+import proofmarshal
+from proofmarshal import varuint
+from proofmarshal.bench import benchmark, nested, BenchBytes, BenchNested, BenchVarUInt
+
+VARUINTS = [i * 7919 % 2**21 for i in range(10000)]
+
+@benchmark('varuint.encode.10k')
+def bench_varuint_encode():
+    def run():
+        encode = varuint.encode
+        for i in VARUINTS:
+            encode(i)
+    return (run, None)
+
+@benchmark('varuint.encode_many.10k')
+def bench_varuint_encode_many():
+    return (lambda: varuint.encode_many(VARUINTS), None)
+
+@benchmark('varuint.decode.10k')
+def bench_varuint_decode():
+    buf = varuint.encode_many(VARUINTS)
+    def run():
+        decode = varuint.decode
+        offset = 0
+        for i in range(len(VARUINTS)):
+            value, offset = decode(buf, offset)
+    return (run, None)
+
+@benchmark('varuint.decode_many.10k')
+def bench_varuint_decode_many():
+    buf = varuint.encode_many(VARUINTS)
+    return (lambda: varuint.decode_many(buf), None)
+
+@benchmark('context.bytes.write_varuint.10k')
+def bench_write_varuint():
+    def run():
+        ctx = proofmarshal.BytesSerializationContext()
+        for i in VARUINTS:
+            ctx.write_varuint('i', i)
+        ctx.getbytes()
+    return (run, None)
+
+@benchmark('context.stream.read_varuint.10k')
+def bench_stream_read_varuint():
+    buf = varuint.encode_many(VARUINTS)
+    def run(ctx):
+        for i in range(len(VARUINTS)):
+            ctx.read_varuint('i')
+    return (run, lambda: proofmarshal.StreamDeserializationContext(io.BytesIO(buf)))
+
+@benchmark('context.buffer.read_varuint.10k')
+def bench_buffer_read_varuint():
+    buf = varuint.encode_many(VARUINTS)
+    def run(ctx):
+        for i in range(len(VARUINTS)):
+            ctx.read_varuint('i')
+    return (run, lambda: proofmarshal.BufferDeserializationContext(buf))
+
+BIG = b'\xaa' * (16 * 1024 * 1024)
+
+@benchmark('bytes.serialize.16MiB')
+def bench_serialize_big():
+    obj = BenchBytes(BIG)
+    return (obj.serialize, None)
+
+@benchmark('bytes.stream_deserialize.16MiB')
+def bench_stream_deserialize_big():
+    buf = BenchBytes(BIG).serialize()
+    return (lambda fd: BenchBytes.stream_deserialize(fd), lambda: io.BytesIO(buf))
+
+@benchmark('bytes.buffer_deserialize.16MiB')
+def bench_buffer_deserialize_big():
+    buf = BenchBytes(BIG).serialize()
+    return (lambda: BenchBytes.buffer_deserialize(buf), None)
+
+@benchmark('bytes.hash.16MiB')
+def bench_hash_big():
+    return (lambda obj: obj.hash, lambda: BenchBytes(BIG))
+
+@benchmark('nested.serialize.depth100')
+def bench_nested_serialize():
+    obj = nested(100)
+    return (obj.serialize, None)
+
+@benchmark('nested.deserialize.depth100')
+def bench_nested_deserialize():
+    buf = nested(100).serialize()
+    return (lambda: BenchNested.deserialize(buf), None)
+
+@benchmark('nested.stream_deserialize.depth100')
+def bench_nested_stream_deserialize():
+    buf = nested(100).serialize()
+    return (lambda fd: BenchNested.stream_deserialize(fd), lambda: io.BytesIO(buf))
+
+@benchmark('nested.hash.depth100')
+def bench_nested_hash():
+    return (lambda obj: obj.hash, lambda: nested(100))
+
+@benchmark('json.roundtrip.1k')
+def bench_json_roundtrip():
+    objs = [BenchBytes(i.to_bytes(4, 'big')) for i in range(1000)] + \
+           [BenchVarUInt(i) for i in range(1000)]
+    def run():
+        for obj in objs:
+            obj.__class__.json_deserialize(obj.json_serialize())
+    return (run, None)
@@ -0,0 +1,91 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+"""Benchmarks of MerbinnerTree building, serialization and hashing"""
+
+import proofmarshal
+from proofmarshal.bench import benchmark, random_items, BenchMerbinnerTree, BenchSummedMerbinnerTree
+from proofmarshal.merbinnertree import LeafNode, InnerNode
+
+SIZES = (10, 100, 1000, 10000, 100000, 1000000)
+
+def register(n, tree_class, label):
+    def items():
+        # Generated lazily, and only once, as the large sizes are slow
+        try:
+            return register.cache[n]
+        except KeyError:
+            register.cache.clear()
+            register.cache[n] = random_items(n)
+            return register.cache[n]
+
+    def built_tree():
+        mbtree = tree_class(items())
+        mbtree._get_root()
+        return mbtree
+
+    @benchmark('merbinnertree.%s.build.%d' % (label, n), size=n)
+    def bench_build():
+        return (lambda: tree_class(items())._get_root(), None)
+
+    @benchmark('merbinnertree.%s.serialize.%d' % (label, n), size=n)
+    def bench_serialize():
+        mbtree = built_tree()
+        return (mbtree.serialize, None)
+
+    @benchmark('merbinnertree.%s.deserialize.%d' % (label, n), size=n)
+    def bench_deserialize():
+        buf = built_tree().serialize()
+        return (lambda: tree_class.deserialize(buf), None)
+
+    @benchmark('merbinnertree.%s.hash.%d' % (label, n), size=n)
+    def bench_hash():
+        return (lambda mbtree: mbtree.hash, built_tree)
+
+    @benchmark('merbinnertree.%s.rehash_one.%d' % (label, n), size=n)
+    def bench_rehash_one():
+        key = items()[0][0]
+        def setup():
+            mbtree = built_tree()
+            mbtree.hash
+            return mbtree
+        def run(mbtree):
+            mbtree[key] = b'\x00' * 32
+            mbtree.hash
+        return (run, setup)
+register.cache = {}
+
+for n in SIZES:
+    register(n, BenchMerbinnerTree, 'plain')
+    register(n, BenchSummedMerbinnerTree, 'summed')
+
+def register_engine(engine):
+    """Per-node hashing cost of a hash engine"""
+    class tree_class(BenchMerbinnerTree):
+        HASH_ENGINE = engine
+    tree = tree_class()
+
+    (key, value), (key2, value2) = random_items(2)
+    left = LeafNode(key, key, value)
+    right = LeafNode(key2, key2, value2)
+    tree._node_hash(left)
+    tree._node_hash(right)
+
+    # Fresh nodes every call, as hashes are cached
+    @benchmark('merbinnertree.hash_node.%s.leaf' % engine.name)
+    def bench_leaf():
+        return (tree._node_hash, lambda: LeafNode(key, key, value))
+
+    @benchmark('merbinnertree.hash_node.%s.inner' % engine.name)
+    def bench_inner():
+        return (tree._node_hash, lambda: InnerNode(left, right))
+
+for engine in (proofmarshal.HMAC_SHA256, proofmarshal.BLAKE2B, proofmarshal.BLAKE2S):
+    register_engine(engine)
@@ -0,0 +1,54 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Scaling of parallel MerbinnerTree hashing with the number of workers"""
+
+import argparse
+import os
+
+from proofmarshal.bench import BenchMerbinnerTree, random_items, timeit
+
+def bench_parallel_hash(n, parallelism, use_threads=False):
+    """Return the time taken to hash a tree of n items from scratch"""
+    items = random_items(n)
+    expected_hash = BenchMerbinnerTree(items).hash
+
+    def setup():
+        mbtree = BenchMerbinnerTree(items)
+        mbtree._get_root()
+        return mbtree
+
+    def run(mbtree):
+        assert mbtree.calc_hash(parallelism=parallelism, use_threads=use_threads) == expected_hash
+    return timeit(run, setup)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=100000,
+                        help='number of items in the tree (default: %(default)s)')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count(),
+                        help='maximum number of workers (default: %(default)s)')
+    parser.add_argument('--threads', action='store_true',
+                        help='use threads rather than processes')
+    args = parser.parse_args()
+
+    serial = bench_parallel_hash(args.n, None)
+    print('%8s %10s %8s' % ('workers', 'seconds', 'speedup'))
+    print('%8s %10.3f %8.2f' % ('serial', serial, 1.0))
+
+    workers = 1
+    while workers <= args.max_workers:
+        t = bench_parallel_hash(args.n, workers, args.threads)
+        print('%8d %10.3f %8.2f' % (workers, t, serial / t))
+        workers *= 2
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Process-wide cache of object hashes
+
+Objects are only hashed once per instance; identical objects deserialized
+separately are hashed again. Enabling a HashCache with
+proofmarshal.set_hash_cache() lets HashSerializationContext.write_obj look up
+the hash of an identical, previously hashed object by its hash preimage: what
+would be hashed, which has the hashes of its sub-objects in place of the
+sub-objects themselves. Those hashes are looked up in turn, so every object is
+serialized once whether or not its hash is cached.
+"""
+
+import collections
+import threading
+
+import proofmarshal
+
+class HashCache:
+    """Bounded LRU cache of hashes keyed by (class, hash preimage)
+
+    The size of an entry is the length of its preimage plus its digest;
+    least recently used entries are evicted to keep the total under max_bytes.
+
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, max_bytes=16*1024*1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, cls, preimage):
+        """Return the cached digest, or None"""
+        key = (cls, preimage)
+        with self._lock:
+            try:
+                digest = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return digest
+
+    def put(self, cls, preimage, digest):
+        """Add a digest to the cache"""
+        key = (cls, preimage)
+        cost = len(preimage) + len(digest)
+        if cost > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+
+            self._entries[key] = digest
+            self.size += cost
+            while self.size > self.max_bytes:
+                (old_cls, old_preimage), old_digest = self._entries.popitem(last=False)
+                self.size -= len(old_preimage) + len(old_digest)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return hit/miss counters and size as a dict"""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries),
+                    'size': self.size,
+                    'max_bytes': self.max_bytes}
+
+    def obj_hash(self, value, serialization_class=None):
+        """Return the hash of an object, using the cache if possible"""
+        if serialization_class is None:
+            try:
+                return value._cached_hash
+            except AttributeError:
+                pass
+            cls = value.__class__
+        else:
+            cls = serialization_class
+
+        # Sub-objects written to the context are looked up in the cache too
+        ctx = proofmarshal.HashSerializationContext()
+        if serialization_class is None:
+            value.ctx_serialize(ctx)
+        else:
+            serialization_class.ctx_serialize(value, ctx)
+        preimage = ctx.getbytes()
+
+        digest = self.get(cls, preimage)
+        if digest is None:
+            hasher = proofmarshal.new_hmac(cls.HASH_HMAC_KEY, cls.HASH_ENGINE)
+            hasher.update(preimage)
+            digest = hasher.digest()
+            self.put(cls, preimage, digest)
+
+        if serialization_class is None:
+            object.__setattr__(value, '_cached_hash', digest)
+        return digest
@@ -0,0 +1,284 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Instrumentation of serialization, deserialization and hashing
+
+Accounts for where the bytes and time go:
+
+    with Instrumentation() as inst:
+        ctx = inst.wrap(proofmarshal.BytesSerializationContext())
+        obj.ctx_serialize(ctx)
+
+    inst.as_dict()
+    inst.flamegraph()
+
+While active, calls to ctx_serialize() and ctx_deserialize() on every
+ImmutableProof, HMAC invocations, and MerbinnerTree node hashing are recorded.
+Byte counts per attribute and MerbinnerTree node type and depth histograms are
+recorded by contexts passed through wrap().
+
+Nothing is hooked until an Instrumentation is entered, and everything is
+restored when it exits, so there is no cost when disabled. Only one may be
+active at a time, and it is not thread-safe.
+"""
+
+import collections
+import time
+
+import proofmarshal
+from proofmarshal import varuint
+from proofmarshal.merbinnertree import MerbinnerTree
+
+_active = None
+
+class _Frame:
+    """An object being (de)serialized"""
+    __slots__ = ['cls', 'name', 'path', 'children_time', 'pending_nodes']
+
+    def __init__(self, cls, name, path):
+        self.cls = cls
+        self.name = name
+        self.path = path
+        self.children_time = 0.0
+
+        # Remaining children per inner node, if a MerbinnerTree
+        self.pending_nodes = []
+
+class Instrumentation:
+    """Collects statistics while active"""
+
+    def __init__(self):
+        # (class name, attr_name) -> [calls, bytes]
+        self.attrs = collections.defaultdict(lambda: [0, 0])
+
+        # (class name, kind) -> [calls, seconds]
+        self.classes = collections.defaultdict(lambda: [0, 0.0])
+
+        # class name -> hashes started, with any HashEngine
+        self.hmacs = collections.Counter()
+
+        # node type -> count, for nodes serialized or deserialized, and hashed
+        self.node_types = collections.Counter()
+        self.hashed_node_types = collections.Counter()
+
+        # depth -> count
+        self.node_depths = collections.Counter()
+
+        # flame graph stacks -> bytes, seconds
+        self.stack_bytes = collections.Counter()
+        self.stack_time = collections.Counter()
+
+        self._stack = [_Frame(None, '<root>', '<root>')]
+        self._saved = None
+
+    def __enter__(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError('an Instrumentation is already active')
+        _active = self
+
+        ImmutableProof = proofmarshal.ImmutableProof
+        self._saved = (ImmutableProof.__dict__['ctx_serialize'],
+                       ImmutableProof.__dict__['ctx_deserialize'],
+                       MerbinnerTree.__dict__['_node_hash'],
+                       proofmarshal.new_hmac)
+
+        orig_ctx_serialize, orig_ctx_deserialize, orig_node_hash, orig_new_hmac = self._saved
+        orig_ctx_deserialize = orig_ctx_deserialize.__func__
+
+        def ctx_serialize(obj, ctx):
+            kind = 'hash' if isinstance(ctx, proofmarshal.HashSerializationContext) else 'serialize'
+            return self._call(obj.__class__, kind, orig_ctx_serialize, obj, ctx)
+
+        def ctx_deserialize(cls, ctx):
+            return self._call(cls, 'deserialize', orig_ctx_deserialize, cls, ctx)
+
+        def node_hash(tree, node):
+            if hasattr(node, '_hash'):
+                return orig_node_hash(tree, node)
+
+            self.hashed_node_types[node.NODE_TYPE] += 1
+            if self._stack[-1].cls is not tree.__class__:
+                # Hashing the tree directly, rather than via a context
+                return self._call(tree.__class__, 'hash', orig_node_hash, tree, node)
+            else:
+                return orig_node_hash(tree, node)
+
+        def new_hmac(key, engine=proofmarshal.HMAC_SHA256):
+            self.hmacs[self._stack[-1].name] += 1
+            return orig_new_hmac(key, engine)
+
+        ImmutableProof.ctx_serialize = ctx_serialize
+        ImmutableProof.ctx_deserialize = classmethod(ctx_deserialize)
+        MerbinnerTree._node_hash = node_hash
+        proofmarshal.new_hmac = new_hmac
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active
+        ImmutableProof = proofmarshal.ImmutableProof
+        (ImmutableProof.ctx_serialize, ImmutableProof.ctx_deserialize,
+         MerbinnerTree._node_hash, proofmarshal.new_hmac) = self._saved
+        self._saved = None
+        _active = None
+
+    def _call(self, cls, kind, func, *args):
+        parent = self._stack[-1]
+        frame = _Frame(cls, cls.__name__, parent.path + ';' + cls.__name__)
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            parent.children_time += elapsed
+
+            stats = self.classes[(frame.name, kind)]
+            stats[0] += 1
+            stats[1] += elapsed
+            self.stack_time[frame.path] += elapsed - frame.children_time
+
+    def _record(self, attr_name, nbytes):
+        frame = self._stack[-1]
+        stats = self.attrs[(frame.name, attr_name)]
+        stats[0] += 1
+        stats[1] += nbytes
+        self.stack_bytes['%s;%s' % (frame.path, attr_name)] += nbytes
+
+    def _record_node(self, node_type):
+        """Record a MerbinnerTree node, seen in pre-order"""
+        pending = self._stack[-1].pending_nodes
+        self.node_types[node_type] += 1
+        self.node_depths[len(pending)] += 1
+        if pending:
+            pending[-1] -= 1
+        if node_type == 2:
+            pending.append(2)
+        while pending and pending[-1] == 0:
+            pending.pop()
+
+    def wrap(self, ctx):
+        """Instrument a context
+
+        The context itself is modified, and returned.
+        """
+        ctx.__class__ = _instrumented_class(ctx.__class__)
+        ctx._instrumentation = self
+        ctx._suppress = 0
+        return ctx
+
+    def as_dict(self):
+        """Return the statistics as a JSON-compatible dict"""
+        r = {'attrs': {}, 'classes': {}}
+        for (name, attr_name), (calls, nbytes) in sorted(self.attrs.items(), key=str):
+            r['attrs']['%s.%s' % (name, attr_name)] = {'calls': calls, 'bytes': nbytes}
+        for (name, kind), (calls, seconds) in sorted(self.classes.items()):
+            r['classes'].setdefault(name, {})[kind] = {'calls': calls, 'time': seconds}
+        r['hmacs'] = dict(self.hmacs)
+        r['merbinnertree'] = {'node_types': dict(self.node_types),
+                              'hashed_node_types': dict(self.hashed_node_types),
+                              'node_depths': dict(self.node_depths)}
+        return r
+
+    def flamegraph(self, metric='bytes'):
+        """Return the stacks in collapsed format, as used by flamegraph.pl
+
+        metric is either 'bytes', with the attribute as the leaf of each stack,
+        or 'time', in microseconds of self time per object.
+        """
+        if metric == 'bytes':
+            stacks = self.stack_bytes
+        elif metric == 'time':
+            stacks = {path: int(seconds * 1e6) for path, seconds in self.stack_time.items()}
+        else:
+            raise ValueError('unknown metric %r' % metric)
+        return ''.join('%s %d\n' % (path, count) for path, count in sorted(stacks.items()) if count)
+
+
+def _varuint_len(value):
+    return len(varuint.encode(value))
+
+class _InstrumentedContext:
+    """Mixed into instrumented contexts"""
+
+    def _record(self, attr_name, nbytes):
+        if not self._suppress:
+            self._instrumentation._record(attr_name, nbytes)
+
+    def _record_varuint(self, attr_name, value):
+        if not self._suppress:
+            inst = self._instrumentation
+            inst._record(attr_name, _varuint_len(value))
+            cls = inst._stack[-1].cls
+            if attr_name == 'type' and cls is not None and issubclass(cls, MerbinnerTree):
+                inst._record_node(value)
+
+class _InstrumentedSerializationContext(_InstrumentedContext):
+    def write_varuint(self, attr_name, value):
+        self._record_varuint(attr_name, value)
+        super().write_varuint(attr_name, value)
+
+    def write_bytes(self, attr_name, value, expected_length=None):
+        nbytes = len(value)
+        if expected_length is None:
+            nbytes += _varuint_len(nbytes)
+        self._record(attr_name, nbytes)
+
+        self._suppress += 1
+        try:
+            super().write_bytes(attr_name, value, expected_length)
+        finally:
+            self._suppress -= 1
+
+    def write_obj(self, attr_name, value, serialization_class=None):
+        if isinstance(self, proofmarshal.HashSerializationContext):
+            # Only the hash is written
+            self._record(attr_name, 32)
+            self._suppress += 1
+            try:
+                super().write_obj(attr_name, value, serialization_class)
+            finally:
+                self._suppress -= 1
+        else:
+            super().write_obj(attr_name, value, serialization_class)
+
+class _InstrumentedDeserializationContext(_InstrumentedContext):
+    def read_varuint(self, attr_name):
+        value = super().read_varuint(attr_name)
+        self._record_varuint(attr_name, value)
+        return value
+
+    def read_bytes(self, attr_name, expected_length=None):
+        self._suppress += 1
+        try:
+            value = super().read_bytes(attr_name, expected_length)
+        finally:
+            self._suppress -= 1
+
+        nbytes = len(value)
+        if expected_length is None:
+            nbytes += _varuint_len(nbytes)
+        self._record(attr_name, nbytes)
+        return value
+
+_instrumented_classes = {}
+def _instrumented_class(cls):
+    try:
+        return _instrumented_classes[cls]
+    except KeyError:
+        if hasattr(cls, 'read_varuint'):
+            mixin = _InstrumentedDeserializationContext
+        else:
+            mixin = _InstrumentedSerializationContext
+        instrumented_cls = type('Instrumented' + cls.__name__, (mixin, cls), {})
+        _instrumented_classes[cls] = instrumented_cls
+        return instrumented_cls
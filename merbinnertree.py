@@ -9,119 +9,1124 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
-import hashlib
-import hmac
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
 import operator
 
 import proofmarshal
+from proofmarshal import varuint
+
+class Node:
+    """Node in a merbinner tree
+
+    Nodes are immutable; modifying a tree replaces the nodes along the path
+    to the modified leaf, leaving every other node, and its cached hash, sum
+    and serialized size, shared with the previous version.
+    """
+    __slots__ = ['_hash', '_sum', '_size']
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Object is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Object is immutable')
+
+    def __setstate__(self, state):
+        # Otherwise pickle and copy restore the slots with setattr
+        dict_state, slot_state = state
+        for name, value in slot_state.items():
+            object.__setattr__(self, name, value)
+
+class EmptyNode(Node):
+    """Node with no items in it"""
+    __slots__ = []
+
+    NODE_TYPE = 0
+
+class LeafNode(Node):
+    """Node with exactly one item in it"""
+    __slots__ = ['key', 'keyhash', 'value']
+
+    NODE_TYPE = 1
+
+    def __init__(self, key, keyhash, value):
+        object.__setattr__(self, 'key', key)
+        object.__setattr__(self, 'keyhash', keyhash)
+        object.__setattr__(self, 'value', value)
+
+class InnerNode(Node):
+    """Node with two or more items in it"""
+    __slots__ = ['left', 'right']
+
+    NODE_TYPE = 2
+
+    def __init__(self, left, right):
+        object.__setattr__(self, 'left', left)
+        object.__setattr__(self, 'right', right)
+
+class PrunedNode(Node):
+    """Subtree that has been pruned away, leaving only its hash and sum"""
+    __slots__ = []
+
+    NODE_TYPE = 3
+
+    def __init__(self, hash, sum):
+        object.__setattr__(self, '_hash', hash)
+        object.__setattr__(self, '_sum', sum)
+
+    @property
+    def hash(self):
+        return self._hash
+
+    @property
+    def sum(self):
+        return self._sum
+
+def get_bit(keyhash, depth):
+    """Return the bit of keyhash at depth; 1 is the left side"""
+    return keyhash[depth // 8] >> (7 - depth % 8) & 0b1
+
+def iter_leaves(node):
+    """Iterate over the leaf nodes under a node, left to right"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, LeafNode):
+            yield node
+        elif isinstance(node, InnerNode):
+            stack.append(node.right)
+            stack.append(node.left)
+
+def iter_nodes(node):
+    """Iterate over every node in a subtree, in pre-order"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, InnerNode):
+            stack.append(node.right)
+            stack.append(node.left)
+
+def _iter_unpruned_leaves(node):
+    for node in iter_nodes(node):
+        if isinstance(node, PrunedNode):
+            raise ValueError('subtree has been pruned')
+        elif isinstance(node, LeafNode):
+            yield node
+
+def _children(node, depth):
+    """Return the (left, right) children of a node at depth
+
+    A leaf or empty node is treated as an inner node with itself on one side,
+    or both, so it can be compared against an inner node.
+    """
+    if isinstance(node, InnerNode):
+        return (node.left, node.right)
+    elif isinstance(node, EmptyNode):
+        return (node, node)
+    elif isinstance(node, LeafNode):
+        if get_bit(node.keyhash, depth):
+            return (node, EmptyNode())
+        else:
+            return (EmptyNode(), node)
+    else:
+        raise ValueError('subtree has been pruned')
+
+TreeDiff = collections.namedtuple('TreeDiff', ['added', 'removed', 'changed'])
+TreeDiff.__doc__ = """Differences between two trees
+
+added and removed are dicts of the items only in the second and first trees
+respectively; changed is a dict of key -> (old value, new value).
+"""
+
+def _diff_nodes(tree, a, b, depth, r):
+    """Add the differences between two subtrees at depth to TreeDiff r"""
+    if a is b or tree._node_hash(a) == tree._node_hash(b):
+        return
+
+    elif isinstance(a, EmptyNode):
+        for leaf in _iter_unpruned_leaves(b):
+            r.added[leaf.key] = leaf.value
+
+    elif isinstance(b, EmptyNode):
+        for leaf in _iter_unpruned_leaves(a):
+            r.removed[leaf.key] = leaf.value
+
+    elif isinstance(a, LeafNode) and isinstance(b, LeafNode):
+        if a.key == b.key:
+            r.changed[a.key] = (a.value, b.value)
+        else:
+            r.removed[a.key] = a.value
+            r.added[b.key] = b.value
+
+    else:
+        for a_child, b_child in zip(_children(a, depth), _children(b, depth)):
+            _diff_nodes(tree, a_child, b_child, depth+1, r)
+
+def diff(tree, a, b):
+    """Return the TreeDiff between two root nodes
+
+    tree is a tree of the class both belong to. Subtrees with the same hash
+    and sum are skipped, so this takes O(differences * depth) time once the
+    hashes are known. Raises ValueError if a difference is in a pruned
+    subtree.
+    """
+    r = TreeDiff({}, {}, {})
+    _diff_nodes(tree, a, b, 0, r)
+    return r
+
+def _prefix_sum(tree, node, bit_prefix):
+    if bit_prefix.strip('01'):
+        raise ValueError('bit prefix must consist of 0 and 1, not %r' % bit_prefix)
+
+    for depth, bit in enumerate(bit_prefix):
+        if isinstance(node, InnerNode):
+            node = node.left if bit == '1' else node.right
+
+        elif isinstance(node, LeafNode):
+            # The leaf is the only item under this node
+            keyhash_bits = format(int.from_bytes(node.keyhash, 'big'), '0%db' % (len(node.keyhash) * 8))
+            if not keyhash_bits.startswith(bit_prefix):
+                return tree.SUM_IDENTITY
+            break
+
+        elif isinstance(node, PrunedNode):
+            raise ValueError('tree has been pruned at prefix %s' % bit_prefix[:depth])
+
+        else:
+            return tree.SUM_IDENTITY
+
+    return tree._node_sum(node)
+
+def _hash_subtree(tree_class, items, depth):
+    """Return the (hash, sum) of the subtree of items at depth
+
+    Run in worker processes by MerbinnerTree.calc_hash()
+    """
+    self = tree_class()
+    return self._node_hash(self._build(items, depth))
 
 class MerbinnerTree(proofmarshal.ImmutableProof, dict):
-    """Temporary non-prunable merbinner tree
+    """Prunable merbinner tree
+
+    The tree structure is kept alongside the dict contents with a cached hash
+    and sum for every node, so after modifying a few keys only the nodes on the
+    paths to those keys need to be rehashed.
 
-    To reduce implementation effort for the Java team.
+    Subtrees can be pruned away, leaving just their hash and sum, to create
+    compact proofs that a subset of the keys are, or are not, in the tree. See
+    prune(). The dict contents of a pruned tree are only the keys that remain.
     """
     HASH_HMAC_KEY = None
 
+    # Hashes are already cached per node, which is far cheaper than
+    # serializing the whole tree to look it up.
+    HASH_CACHEABLE = False
+
+    # Pruned trees have the same hash as the full tree, and trees are
+    # mutable, so they can't be shared.
+    MEMOIZABLE = False
+
     SUM_IDENTITY = 0
 
+    # Length of key hashes, in bytes; subclasses whose key_gethash() returns
+    # another length must set it. Inner nodes can't be this many bits deep,
+    # as the items under them would need identical key hashes, so
+    # deserialization rejects deeper trees regardless of limits.
+    KEYHASH_LENGTH = 32
+
     key_serialize = None
     key_deserialize = None
     value_serialize = None
     value_deserialize = None
     sum_serialize = lambda self, ctx, sum: None
+    sum_deserialize = lambda self, ctx: self.SUM_IDENTITY
 
     key_gethash = lambda self, key: key.hash
     value_getsum = lambda self, value: 0
 
     sum_func = operator.add
 
+    def __setitem__(self, key, value):
+        root = self.__dict__.get('_root')
+        if root is not None:
+            root = self._insert(root, key, self.key_gethash(key), value, 0)
+            object.__setattr__(self, '_root', root)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        root = self.__dict__.get('_root')
+        if root is not None and key in self:
+            root = self._remove(root, key, self.key_gethash(key), 0)
+            object.__setattr__(self, '_root', root)
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    _MISSING = object()
+    def pop(self, key, default=_MISSING):
+        if key not in self:
+            if default is self._MISSING:
+                raise KeyError(key)
+            return default
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        dict.__setitem__(self, key, value)
+        del self[key]
+        return (key, value)
+
+    def clear(self):
+        dict.clear(self)
+        self.__dict__.pop('_root', None)
+
+    def _get_root(self):
+        """Return the root node, building the tree if required"""
+        try:
+            return self.__dict__['_root']
+        except KeyError:
+            root = self._build(self.items())
+            object.__setattr__(self, '_root', root)
+            return root
+
+    def _build(self, items, depth=0):
+        """Build the tree structure for (key, value) items
+
+        If depth is non-zero the items must all share the first depth bits of
+        their key hashes, and the subtree at that depth is returned.
+
+        Each key is hashed exactly once, after which the leaves are sorted by
+        key hash. Every subtree is then a contiguous range of the sorted
+        leaves, so the split point between the left and right sides at each
+        depth can be found by bisection without partitioning the items.
+        """
+        leaves = [LeafNode(key, self.key_gethash(key), value) for key, value in items]
+        leaves.sort(key=operator.attrgetter('keyhash'))
+        keyhashes = [leaf.keyhash for leaf in leaves]
+
+        for i in range(1, len(keyhashes)):
+            if keyhashes[i-1] == keyhashes[i]:
+                raise ValueError('duplicate key hash: %r and %r' % (leaves[i-1].key, leaves[i].key))
+
+        def recurse(lo, hi, depth):
+            if hi - lo == 0:
+                return EmptyNode()
+
+            elif hi - lo == 1:
+                return leaves[lo]
+
+            else:
+                # All keyhashes in the range share their first depth bits;
+                # those with the next bit set sort at or above the prefix
+                # followed by a one bit.
+                i = depth // 8
+                prefix = keyhashes[lo]
+                bit = 0b10000000 >> (depth % 8)
+                threshold = prefix[:i] + bytes([(prefix[i] & -bit | bit) & 0xff])
+                mid = bisect.bisect_left(keyhashes, threshold, lo, hi)
+
+                # Left side is the one with the bit set
+                return InnerNode(recurse(mid, hi, depth+1), recurse(lo, mid, depth+1))
+
+        return recurse(0, len(leaves), depth)
+
+    def _split(self, leaf1, leaf2, depth):
+        """Create the subtree containing two leaves"""
+        if leaf1.keyhash == leaf2.keyhash:
+            raise ValueError('duplicate key hash: %r and %r' % (leaf1.key, leaf2.key))
+
+        side1 = get_bit(leaf1.keyhash, depth)
+        side2 = get_bit(leaf2.keyhash, depth)
+        if side1 != side2:
+            if side1:
+                return InnerNode(leaf1, leaf2)
+            else:
+                return InnerNode(leaf2, leaf1)
+
+        elif side1:
+            return InnerNode(self._split(leaf1, leaf2, depth+1), EmptyNode())
+        else:
+            return InnerNode(EmptyNode(), self._split(leaf1, leaf2, depth+1))
+
+    def _insert(self, node, key, keyhash, value, depth):
+        """Return node with key set to value"""
+        if isinstance(node, EmptyNode):
+            return LeafNode(key, keyhash, value)
+
+        elif isinstance(node, LeafNode):
+            if node.key == key:
+                return LeafNode(key, keyhash, value)
+            else:
+                return self._split(node, LeafNode(key, keyhash, value), depth)
+
+        elif isinstance(node, PrunedNode):
+            raise ValueError('can not set %r; it is in a pruned subtree' % (key,))
+
+        elif get_bit(keyhash, depth):
+            return InnerNode(self._insert(node.left, key, keyhash, value, depth+1), node.right)
+        else:
+            return InnerNode(node.left, self._insert(node.right, key, keyhash, value, depth+1))
+
+    def _remove(self, node, key, keyhash, depth):
+        """Return node with key removed"""
+        if isinstance(node, LeafNode):
+            assert node.key == key
+            return EmptyNode()
+
+        assert isinstance(node, InnerNode)
+        if get_bit(keyhash, depth):
+            changed = self._remove(node.left, key, keyhash, depth+1)
+            other = node.right
+        else:
+            changed = self._remove(node.right, key, keyhash, depth+1)
+            other = node.left
+
+        # An inner node with only one item left under it collapses into that
+        # leaf, which is valid at any depth.
+        if isinstance(changed, EmptyNode) and isinstance(other, LeafNode):
+            return other
+        elif isinstance(changed, EmptyNode) and isinstance(other, PrunedNode):
+            # Whether or not to collapse depends on whether the pruned
+            # sibling is a single leaf, which we can't know.
+            raise ValueError('cannot remove %r: sibling is pruned' % (key,))
+        elif isinstance(changed, LeafNode) and isinstance(other, EmptyNode):
+            return changed
+        elif get_bit(keyhash, depth):
+            return InnerNode(changed, other)
+        else:
+            return InnerNode(other, changed)
+
+    def _node_ctx_serialize(self, ctx, node, hashing):
+        if isinstance(node, EmptyNode):
+            ctx.write_varuint('type', 0)
+
+        elif isinstance(node, LeafNode):
+            ctx.write_varuint('type', 1)
+            self.key_serialize(ctx, node.key)
+            self.value_serialize(ctx, node.value)
+
+        elif isinstance(node, PrunedNode):
+            # Never reached while hashing, as the hash of a pruned node is
+            # already known.
+            assert not hashing
+            ctx.write_varuint('type', 3)
+            ctx.write_bytes('hash', node.hash, 32)
+            self.sum_serialize(ctx, node.sum)
+
+        else:
+            ctx.write_varuint('type', 2)
+            for child in (node.left, node.right):
+                if hashing:
+                    # Sum only needs to be serialized while hashing;
+                    # serializing it otherwise is redundent as the sums can be
+                    # recalculated from the values, and pruned nodes have a
+                    # sum field.
+                    hash, sum = self._node_hash(child)
+                    ctx.write_bytes(None, hash, 32)
+                    self.sum_serialize(ctx, sum)
+                else:
+                    self._node_ctx_serialize(ctx, child, False)
+
+    def _node_hash(self, node):
+        """Return the (hash, sum) of a node, calculating them if required"""
+        try:
+            return (node._hash, node._sum)
+        except AttributeError:
+            pass
+
+        sum = self._node_sum(node)
+        ctx = proofmarshal.HashSerializationContext(self.HASH_HMAC_KEY, self.HASH_ENGINE)
+        self._node_ctx_serialize(ctx, node, True)
+        hash = ctx.digest()
+
+        object.__setattr__(node, '_hash', hash)
+        object.__setattr__(node, '_sum', sum)
+        return (hash, sum)
+
+    def _node_sum(self, node):
+        """Return the sum of a node, calculating it if required
+
+        Unlike _node_hash() nothing is hashed, so sums are cheap to keep up to
+        date as the tree is modified.
+        """
+        try:
+            return node._sum
+        except AttributeError:
+            pass
+
+        if isinstance(node, EmptyNode):
+            sum = self.SUM_IDENTITY
+        elif isinstance(node, LeafNode):
+            sum = self.value_getsum(node.value)
+        else:
+            sum = self.sum_func(self._node_sum(node.left),
+                                self._node_sum(node.right))
+
+        object.__setattr__(node, '_sum', sum)
+        return sum
+
+    def _node_size(self, node):
+        """Return the serialized size of a node, calculating it if required"""
+        try:
+            return node._size
+        except AttributeError:
+            pass
+
+        if isinstance(node, InnerNode):
+            # type is always a single byte
+            size = 1 + self._node_size(node.left) + self._node_size(node.right)
+        else:
+            ctx = proofmarshal.LengthSerializationContext()
+            self._node_ctx_serialize(ctx, node, False)
+            size = ctx.length
+
+        object.__setattr__(node, '_size', size)
+        return size
+
     def _ctx_serialize(self, ctx):
-        def recurse(ctx, items, depth):
-            if len(items) == 0:
-                # Empty node
-                ctx.write_varuint('type', 0)
-                return self.SUM_IDENTITY
+        self._root_ctx_serialize(ctx, self._get_root())
 
-            elif len(items) == 1:
-                # Leaf node
-                ctx.write_varuint('type', 1)
+    def _root_ctx_serialize(self, ctx, root):
+        if isinstance(ctx, proofmarshal.LengthSerializationContext):
+            ctx.length += self._node_size(root)
+            return
+        elif isinstance(ctx, proofmarshal.JsonSerializationContext):
+            ctx.write_list('nodes', iter_nodes(root), self._node_json_serialize)
+            return
+        hashing = isinstance(ctx, proofmarshal.HashSerializationContext)
+        self._node_ctx_serialize(ctx, root, hashing)
+
+    def _node_json_serialize(self, ctx, node):
+        # Children are separate items in the node list
+        if isinstance(node, InnerNode):
+            ctx.write_varuint('type', 2)
+        else:
+            self._node_ctx_serialize(ctx, node, False)
 
-                key, value, sum = items[0]
-                self.key_serialize(ctx, key)
-                self.value_serialize(ctx, value)
+    def calc_hash(self, parallelism=None, split_depth=None, use_threads=False):
+        """Calculate the hash of the tree
 
-                return sum
+        If parallelism is given the subtrees at split_depth are hashed by a
+        pool of that many worker processes, or threads if use_threads is true,
+        and then combined. The result is identical to hashing serially.
 
+        With processes the keys and values of each subtree are pickled and the
+        tree rebuilt in the worker, so the tree class must be importable.
+        """
+        root = self._get_root()
+        if parallelism is not None and parallelism > 1:
+            if split_depth is None:
+                # A few subtrees per worker evens out the load
+                split_depth = (parallelism - 1).bit_length() + 2
+            self._parallel_hash(root, parallelism, split_depth, use_threads)
+        return self._node_hash(root)[0]
+
+    def _parallel_hash(self, root, parallelism, split_depth, use_threads):
+        """Hash subtrees at split_depth in parallel, caching the results"""
+        subtrees = []
+        def collect(node, depth):
+            if not isinstance(node, InnerNode) or hasattr(node, '_hash'):
+                return
+            elif depth == split_depth:
+                subtrees.append((node, depth))
             else:
-                # Inner node
-                ctx.write_varuint('type', 2)
+                collect(node.left, depth+1)
+                collect(node.right, depth+1)
+        collect(root, 0)
 
-                # Sort items into left and right sides
-                left_items = []
-                right_items = []
-                for key, value, sum in items:
-                    # FIXME: detect dup keys here
-                    keyhash = self.key_gethash(key)
-                    side = keyhash[depth // 8] >> (7 - depth % 8) & 0b1
+        if use_threads:
+            with concurrent.futures.ThreadPoolExecutor(parallelism) as executor:
+                results = list(executor.map(lambda subtree: self._node_hash(subtree[0]), subtrees))
 
-                    if side:
-                        left_items.append((key, value, sum))
-                    else:
-                        right_items.append((key, value, sum))
-
-                # Definitely a hack, but if we're hashing, rather than
-                # serializing, we need to create new contexts and do the hmac
-                # hash calculation. This hack will get removed when the full
-                # prunable merbinner tree is implemented.
-                def do_recurse(items):
-                    sum = None
-                    if isinstance(ctx, proofmarshal.HashSerializationContext):
-                        next_ctx = proofmarshal.HashSerializationContext()
-                        sum = recurse(next_ctx, items, depth+1)
-                        hash = hmac.HMAC(self.HASH_HMAC_KEY, next_ctx.getbytes(), hashlib.sha256).digest()
-                        ctx.write_bytes(None, hash, 32)
-
-                        # Also, sum only needs to be serialized while hashing;
-                        # serializing it otherwise is redundent as the sums can
-                        # be recalculated from the values. (future pruned nodes
-                        # will have a sum field)
-                        self.sum_serialize(ctx, sum)
-                    else:
-                        sum = recurse(ctx, items, depth+1)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(parallelism) as executor:
+                futures = [executor.submit(_hash_subtree, self.__class__,
+                                           [(leaf.key, leaf.value) for leaf in iter_leaves(node)],
+                                           depth)
+                           for node, depth in subtrees]
+                results = [future.result() for future in futures]
+
+        for (node, depth), (hash, sum) in zip(subtrees, results):
+            object.__setattr__(node, '_hash', hash)
+            object.__setattr__(node, '_sum', sum)
+
+    @property
+    def hash(self):
+        # Not cached on the instance as the tree is mutable; the root node
+        # caches it instead.
+        return self.calc_hash()
+
+    def total_sum(self):
+        """Return the sum of every value in the tree
+
+        Sums are cached per node, so after modifying a few keys only the nodes
+        on the paths to them are summed again.
+        """
+        return self._node_sum(self._get_root())
+
+    def prefix_sum(self, bit_prefix):
+        """Return the sum of the values whose key hashes start with bit_prefix
 
-                    return sum
+        bit_prefix is a string of '0' and '1' characters, most significant bit
+        first. Takes O(depth) time once sums are cached. Raises ValueError if
+        that part of the tree has been pruned away.
+        """
+        return _prefix_sum(self, self._get_root(), bit_prefix)
 
-                left_sum = do_recurse(left_items)
-                right_sum = do_recurse(right_items)
+    def diff(self, other):
+        """Return the TreeDiff from this tree to other
 
-                return self.sum_func(left_sum, right_sum)
+        other may be a tree or a PersistentMerbinnerTree of the same class.
+        """
+        return _diff_with(self, self._get_root(), other)
 
-        items = [(key, value, self.value_getsum(value)) for key, value in self.items()]
+    def snapshot(self):
+        """Return an immutable snapshot of the tree
 
-        final_sum = recurse(ctx, items, 0)
+        Takes constant time; the snapshot shares every node with the tree.
+        """
+        return PersistentMerbinnerTree._from_root(self.__class__(), self._get_root(), len(self))
 
     def _ctx_deserialize(self, ctx):
-        items = {}
-        def recurse():
-            node_type = ctx.read_varuint('type')
+        if isinstance(ctx, proofmarshal.JsonDeserializationContext):
+            # Every node is a separate item in a list, in pre-order
+            nodes = ctx.iter_list('nodes')
+            def next_ctx():
+                try:
+                    return next(nodes)
+                except StopIteration:
+                    raise proofmarshal.DeserializationError('missing nodes in node list') from None
+        else:
+            next_ctx = lambda: ctx
+
+        self._set_root(self._node_ctx_deserialize(next_ctx, limits=ctx.limits))
+
+        if isinstance(ctx, proofmarshal.JsonDeserializationContext):
+            for extra in nodes:
+                raise proofmarshal.DeserializationError('extra nodes in node list')
+
+    def _set_root(self, root):
+        """Set the contents of the tree to a deserialized root node"""
+        for leaf in iter_leaves(root):
+            dict.__setitem__(self, leaf.key, leaf.value)
+        object.__setattr__(self, '_root', root)
+
+    def _node_ctx_deserialize(self, next_ctx, depth=0, prefix=0, indexed=False, limits=None):
+        """Deserialize the subtree at depth, whose key hashes start with prefix
+
+        next_ctx() returns the context to read each node from. If indexed,
+        inner nodes have the length of their left subtree, which is checked;
+        next_ctx() must then return a BufferDeserializationContext.
+
+        The max_depth and max_nodes of limits are enforced. Nodes are read
+        with an explicit stack, so deep trees can't exhaust the Python stack.
+        """
+        # Inner nodes whose children are being read, as
+        # [depth, prefix, left child, start of left subtree, left length]
+        stack = []
+        nodes = 0
+        while True:
+            ctx = next_ctx()
+            if limits is not None:
+                nodes += 1
+                limits.check_nodes(nodes)
+                limits.check_depth(depth)
 
+            node_type = ctx.read_varuint('type')
             if node_type == 0:
-                # Empty node, do nothing
-                pass
+                # Empty node
+                node = EmptyNode()
 
             elif node_type == 1:
                 # Leaf node
                 key = self.key_deserialize(ctx)
+                if isinstance(key, memoryview):
+                    # Zero-copy keys can't go in the dict; views of a
+                    # writable buffer aren't hashable.
+                    key = key.tobytes()
                 value = self.value_deserialize(ctx)
+                keyhash = self.key_gethash(key)
+                if len(keyhash) != self.KEYHASH_LENGTH:
+                    raise proofmarshal.DeserializationError('key hash of %d bytes; expected %d' % \
+                                                            (len(keyhash), self.KEYHASH_LENGTH))
 
-                self[key] = value
+                # The leaf must be on the path its key hash says it is on,
+                # otherwise a pruned tree could prove anything.
+                if depth > len(keyhash)*8 or \
+                   int.from_bytes(keyhash, 'big') >> (len(keyhash)*8 - depth) != prefix:
+                    raise proofmarshal.DeserializationError('leaf node for key %r in wrong position' % (key,))
+
+                node = LeafNode(key, keyhash, value)
 
             elif node_type == 2:
-                # Inner node
-                recurse() # left
-                recurse() # right
+                # Inner node; the left child follows
+                if depth >= self.KEYHASH_LENGTH * 8:
+                    raise proofmarshal.DeserializationError('inner node at depth %d; key hashes are only %d bits' % \
+                                                            (depth, self.KEYHASH_LENGTH * 8))
+                if indexed:
+                    left_length = ctx.read_varuint('left_length')
+                    stack.append([depth, prefix, None, ctx.pos, left_length])
+                else:
+                    stack.append([depth, prefix, None, None, None])
+                depth += 1
+                prefix = prefix << 1 | 1
+                continue
+
+            elif node_type == 3:
+                # Pruned node
+                hash = ctx.read_bytes('hash', 32)
+                sum = self.sum_deserialize(ctx)
+                node = PrunedNode(hash, sum)
 
             else:
-                raise Exception('unsupported node type: %d' % node_type)
+                raise proofmarshal.DeserializationError('unsupported node type: %d' % node_type)
+
+            # Complete every inner node that node finishes
+            while stack:
+                frame = stack[-1]
+                if frame[2] is None:
+                    # Left child done; the right child follows
+                    if indexed and ctx.pos - frame[3] != frame[4]:
+                        raise proofmarshal.DeserializationError('left subtree is %d bytes long, not %d' % \
+                                                                (ctx.pos - frame[3], frame[4]))
+                    frame[2] = node
+                    depth = frame[0] + 1
+                    prefix = frame[1] << 1
+                    break
+
+                stack.pop()
+                left, right = frame[2], node
+
+                # An inner node must have at least two items under it; only
+                # pruned and inner children can hide them.
+                if not (isinstance(left, (InnerNode, PrunedNode)) or
+                        isinstance(right, (InnerNode, PrunedNode)) or
+                        (isinstance(left, LeafNode) and isinstance(right, LeafNode))):
+                    raise proofmarshal.DeserializationError('inner node with fewer than two items')
+
+                node = InnerNode(left, right)
+            else:
+                return node
+
+    def _node_indexed_serialize(self, ctx, node):
+        # Sizes of every inner node are calculated bottom-up first, as the
+        # length of the left subtree is written before it.
+        sizes = {}
+        def calc_size(node):
+            if isinstance(node, InnerNode):
+                left_size = calc_size(node.left)
+                size = 1 + len(varuint.encode(left_size)) + left_size + calc_size(node.right)
+            else:
+                size = self._node_size(node)
+            sizes[id(node)] = size
+            return size
+        calc_size(node)
+
+        def recurse(node):
+            if isinstance(node, InnerNode):
+                ctx.write_varuint('type', 2)
+                ctx.write_varuint('left_length', sizes[id(node.left)])
+                recurse(node.left)
+                recurse(node.right)
+            else:
+                self._node_ctx_serialize(ctx, node, False)
+        recurse(node)
+
+    def indexed_serialize(self):
+        """Serialize to the indexed format
+
+        Identical to the usual serialization, except that after the type of
+        every inner node is the length of its left subtree as a varuint. See
+        IndexedMerbinnerTree.
+        """
+        ctx = proofmarshal.BytesSerializationContext()
+        self._node_indexed_serialize(ctx, self._get_root())
+        return ctx.getbytes()
+
+    @classmethod
+    def indexed_deserialize(cls, buf, limits=None):
+        """Deserialize from the indexed format"""
+        self = cls()
+        ctx = proofmarshal.BufferDeserializationContext(buf, materialize=True, limits=limits)
+        self._set_root(self._node_ctx_deserialize(lambda: ctx, indexed=True, limits=limits))
+        ctx.finish()
+        return self
+
+    def prune(self, keys):
+        """Return a copy of the tree pruned down to keys
+
+        Every subtree that is not on the path to one of the keys is replaced by
+        a pruned node, so the result is O(depth) in size per key, with paths
+        shared between keys. The hash of the pruned tree is the same as the
+        hash of the full tree.
+
+        Keys that are not in the tree are allowed; the path to where they would
+        be is kept, proving that they are not.
+        """
+        def recurse(node, keyhashes, depth):
+            if isinstance(node, EmptyNode):
+                # Cheaper than a pruned node
+                return node
+
+            elif not keyhashes:
+                return PrunedNode(*self._node_hash(node))
+
+            elif isinstance(node, InnerNode):
+                left_keyhashes = []
+                right_keyhashes = []
+                for keyhash in keyhashes:
+                    if get_bit(keyhash, depth):
+                        left_keyhashes.append(keyhash)
+                    else:
+                        right_keyhashes.append(keyhash)
+
+                return InnerNode(recurse(node.left, left_keyhashes, depth+1),
+                                 recurse(node.right, right_keyhashes, depth+1))
+
+            else:
+                return node
+
+        root = recurse(self._get_root(), [self.key_gethash(key) for key in keys], 0)
+
+        pruned = self.__class__()
+        object.__setattr__(pruned, '_root', root)
+        dict.update(pruned, ((leaf.key, leaf.value) for leaf in iter_leaves(root)))
+        return pruned
+
+    def prove(self, key):
+        """Return a copy of the tree pruned down to a single key"""
+        return self.prune([key])
+
+    @classmethod
+    def verify_batch(cls, root_hash, proofs):
+        """Verify many proofs against the same root hash
+
+        proofs may be trees, typically pruned, or their serialized bytes.
+
+        Nodes are identified by their contents, with inner nodes identified by
+        the hashes and sums of their children. Proofs are thus merged into a
+        single DAG of distinct nodes, each of which is hashed exactly once,
+        even when one proof prunes a subtree that another reveals.
+
+        Returns a list with True for every proof whose hash is root_hash, and
+        False otherwise, including if it could not be deserialized.
+        """
+        self = cls()
+        digests = {}
+
+        def recurse(node):
+            if isinstance(node, PrunedNode):
+                return (node.hash, node.sum)
+
+            elif isinstance(node, InnerNode):
+                left_hash, left_sum = recurse(node.left)
+                right_hash, right_sum = recurse(node.right)
+                node_key = (2, bytes(left_hash), left_sum, bytes(right_hash), right_sum)
+                node = InnerNode(PrunedNode(left_hash, left_sum), PrunedNode(right_hash, right_sum))
+
+            elif isinstance(node, LeafNode):
+                ctx = proofmarshal.BytesSerializationContext()
+                self._node_ctx_serialize(ctx, node, False)
+                node_key = ctx.getbytes()
+
+            else:
+                node_key = 0
+
+            try:
+                return digests[node_key]
+            except KeyError:
+                # Hashed from scratch, as any cached hash in the proof is
+                # what we're verifying.
+                if isinstance(node, LeafNode):
+                    node = LeafNode(node.key, node.keyhash, node.value)
+                elif isinstance(node, EmptyNode):
+                    node = EmptyNode()
+                r = digests[node_key] = self._node_hash(node)
+                return r
+
+        results = []
+        for proof in proofs:
+            if not isinstance(proof, MerbinnerTree):
+                try:
+                    proof = cls.deserialize(proof)
+                except proofmarshal.DeserializationError:
+                    results.append(False)
+                    continue
+            results.append(recurse(proof._get_root())[0] == root_hash)
+
+        return results
+
+    def is_pruned(self, key):
+        """Return whether the position of key in the tree has been pruned
+
+        If so, whether or not key is in the tree is unknown.
+        """
+        keyhash = self.key_gethash(key)
+        node = self._get_root()
+        depth = 0
+        while isinstance(node, InnerNode):
+            node = node.left if get_bit(keyhash, depth) else node.right
+            depth += 1
+        return isinstance(node, PrunedNode)
+
+
+class PersistentMerbinnerTree(collections.abc.Mapping):
+    """Immutable version of a MerbinnerTree
+
+    Modifying a version with set() or delete() returns a new version, leaving
+    the original as is. Every node not on the path to the modified key, along
+    with its cached hash and sum, is shared between the two, so keeping many
+    versions costs memory in proportion to the changes between them rather
+    than to their sizes.
+
+    tree_class is the MerbinnerTree subclass whose key, value and sum
+    functions, and serialization, are used. The hash and serialization of a
+    version are identical to those of the equivalent tree_class instance.
+    """
+    __slots__ = ['_tree', '_root', '_len']
+
+    def __init__(self, tree_class, items=()):
+        tree = tree_class()
+        object.__setattr__(self, '_tree', tree)
+        object.__setattr__(self, '_root', tree._build(dict(items).items()))
+        object.__setattr__(self, '_len', len(list(iter_leaves(self._root))))
+
+    @classmethod
+    def _from_root(cls, tree, root, length):
+        # tree is only used for its methods, so every version shares it
+        self = cls.__new__(cls)
+        object.__setattr__(self, '_tree', tree)
+        object.__setattr__(self, '_root', root)
+        object.__setattr__(self, '_len', length)
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Object is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Object is immutable')
+
+    __setstate__ = Node.__setstate__
+
+    @property
+    def tree_class(self):
+        return self._tree.__class__
+
+    def _find(self, key):
+        """Return the node at the position of key"""
+        keyhash = self._tree.key_gethash(key)
+        node = self._root
+        depth = 0
+        while isinstance(node, InnerNode):
+            node = node.left if get_bit(keyhash, depth) else node.right
+            depth += 1
+        return node
+
+    def __getitem__(self, key):
+        node = self._find(key)
+        if isinstance(node, LeafNode) and node.key == key:
+            return node.value
+        raise KeyError(key)
+
+    def __iter__(self):
+        for leaf in iter_leaves(self._root):
+            yield leaf.key
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return '%s(%s, %r)' % (self.__class__.__name__, self.tree_class.__name__, dict(self.items()))
+
+    def set(self, key, value):
+        """Return a new version with key set to value"""
+        tree = self._tree
+        length = self._len if key in self else self._len + 1
+        root = tree._insert(self._root, key, tree.key_gethash(key), value, 0)
+        return self._from_root(tree, root, length)
+
+    def delete(self, key):
+        """Return a new version without key
+
+        Raises KeyError if key is not present.
+        """
+        if key not in self:
+            raise KeyError(key)
+        tree = self._tree
+        root = tree._remove(self._root, key, tree.key_gethash(key), 0)
+        return self._from_root(tree, root, self._len - 1)
+
+    def update(self, *args, **kwargs):
+        """Return a new version with every key in the arguments set"""
+        r = self
+        for key, value in dict(*args, **kwargs).items():
+            r = r.set(key, value)
+        return r
+
+    def is_pruned(self, key):
+        """Return whether the position of key in the tree has been pruned"""
+        return isinstance(self._find(key), PrunedNode)
+
+    def diff(self, other):
+        """Return the TreeDiff from this version to other
+
+        other may be a version or a MerbinnerTree of the same class.
+        """
+        return _diff_with(self._tree, self._root, other)
+
+    @property
+    def hash(self):
+        return self._tree._node_hash(self._root)[0]
+
+    @property
+    def sum(self):
+        return self._tree._node_sum(self._root)
+
+    def total_sum(self):
+        """Return the sum of every value in this version"""
+        return self._tree._node_sum(self._root)
+
+    def prefix_sum(self, bit_prefix):
+        """Return the sum of the values whose key hashes start with bit_prefix
+
+        See MerbinnerTree.prefix_sum()
+        """
+        return _prefix_sum(self._tree, self._root, bit_prefix)
+
+    def ctx_serialize(self, ctx):
+        self._tree._root_ctx_serialize(ctx, self._root)
+
+    def serialize(self):
+        """Serialize to bytes"""
+        ctx = proofmarshal.BytesSerializationContext()
+        self.ctx_serialize(ctx)
+        return ctx.getbytes()
+
+    def serialized_size(self):
+        return self._tree._node_size(self._root)
+
+    def thaw(self):
+        """Return a mutable tree_class instance with the same contents
+
+        The tree shares every node with this version; only its dict contents
+        are copied.
+        """
+        tree = self.tree_class()
+        for leaf in iter_leaves(self._root):
+            dict.__setitem__(tree, leaf.key, leaf.value)
+        object.__setattr__(tree, '_root', self._root)
+        return tree
+
+def _diff_with(tree, root, other):
+    if isinstance(other, PersistentMerbinnerTree):
+        other_tree, other_root = other._tree, other._root
+    else:
+        other_tree, other_root = other, other._get_root()
+    if other_tree.__class__ is not tree.__class__:
+        raise TypeError('can not diff a %s against a %s' % (tree.__class__.__name__,
+                                                            other_tree.__class__.__name__))
+    return diff(tree, root, other_root)
+
+
+class IndexedMerbinnerTree(collections.abc.Mapping):
+    """Read-only view of a tree in the indexed format
+
+    buf is anything supporting the buffer protocol, such as bytes or mmap.
+    Looking up a key follows its key hash bits from the root, skipping over
+    left subtrees by their lengths, so takes O(depth) time without
+    deserializing the rest of the tree. Iteration and len() walk the whole
+    buffer, but don't keep anything from it.
+
+    Lengths are trusted when looking up keys; to_tree() fully deserializes
+    and checks the buffer, and can be used to convert it to the usual format.
+    """
+
+    def __init__(self, tree_class, buf):
+        self.tree = tree_class()
+        self.buf = buf
+
+    def _ctx(self, pos):
+        ctx = proofmarshal.BufferDeserializationContext(self.buf, materialize=True)
+        ctx.pos = pos
+        return ctx
+
+    def _read_leaf(self, ctx, depth, prefix):
+        ctx.pos -= 1
+        return self.tree._node_ctx_deserialize(lambda: ctx, depth, prefix)
+
+    def __getitem__(self, key):
+        keyhash = self.tree.key_gethash(key)
+        ctx = self._ctx(0)
+        depth = prefix = 0
+        while True:
+            node_type = ctx.read_varuint('type')
+            if node_type == 2:
+                left_length = ctx.read_varuint('left_length')
+                bit = get_bit(keyhash, depth)
+                if not bit:
+                    ctx.pos += left_length
+                prefix = prefix << 1 | bit
+                depth += 1
+
+            elif node_type == 1:
+                leaf = self._read_leaf(ctx, depth, prefix)
+                if leaf.key == key:
+                    return leaf.value
+                raise KeyError(key)
+
+            elif node_type in (0, 3):
+                raise KeyError(key)
+
+            else:
+                raise proofmarshal.DeserializationError('unsupported node type: %d' % node_type)
+
+    def __iter__(self):
+        ctx = self._ctx(0)
+        stack = [(0, 0, 0)]
+        while stack:
+            pos, depth, prefix = stack.pop()
+            ctx.pos = pos
+            node_type = ctx.read_varuint('type')
+            if node_type == 2:
+                left_length = ctx.read_varuint('left_length')
+                stack.append((ctx.pos + left_length, depth+1, prefix << 1))
+                stack.append((ctx.pos, depth+1, prefix << 1 | 1))
+            elif node_type == 1:
+                yield self._read_leaf(ctx, depth, prefix).key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def is_pruned(self, key):
+        """Return whether the position of key in the tree has been pruned"""
+        keyhash = self.tree.key_gethash(key)
+        ctx = self._ctx(0)
+        depth = 0
+        while True:
+            node_type = ctx.read_varuint('type')
+            if node_type != 2:
+                return node_type == 3
+            left_length = ctx.read_varuint('left_length')
+            if not get_bit(keyhash, depth):
+                ctx.pos += left_length
+            depth += 1
 
-        recurse()
+    def to_tree(self):
+        """Deserialize the whole tree, checking it"""
+        return self.tree.__class__.indexed_deserialize(self.buf)
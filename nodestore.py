@@ -0,0 +1,280 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Disk-backed MerbinnerTrees
+
+A NodeStore keeps the nodes of trees in an sqlite3 database, keyed by their
+hashes, so identical subtrees, in any number of versions of a tree, are stored
+once. Each node is stored with its children pruned; they're referred to by
+hash and sum.
+
+A StoredMerbinnerTree loads nodes lazily, only along the paths to the keys
+accessed, through the store's bounded LRU node cache. Modifications are kept
+in memory until commit(), which writes just the new nodes:
+
+    store = NodeStore('tree.db', FooTree)
+    tree = StoredMerbinnerTree(store, 'head')
+    tree[key] = value
+    tree.commit('head')
+
+Trees with pruned subtrees can't be stored, as pruned nodes are
+indistinguishable from references to stored nodes.
+"""
+
+import collections
+import collections.abc
+import sqlite3
+
+import proofmarshal
+from proofmarshal.merbinnertree import EmptyNode, LeafNode, InnerNode, PrunedNode, get_bit, iter_nodes
+
+class NodeStore:
+    """Content-addressed store of the nodes of trees of one class
+
+    At most cache_size nodes are kept in memory.
+    """
+
+    def __init__(self, path, tree_class, cache_size=100000):
+        self.tree = tree_class()
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS nodes (hash BLOB PRIMARY KEY, data BLOB NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS roots '
+                        '(name TEXT PRIMARY KEY, hash BLOB NOT NULL, count INTEGER NOT NULL)')
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        """Number of nodes stored"""
+        return self.db.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+
+    def _cache_put(self, hash, node):
+        self.cache[hash] = node
+        self.cache.move_to_end(hash)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def load(self, hash, depth=0, prefix=0):
+        """Return the node with a hash
+
+        The node is at depth with key hashes starting with prefix. Children
+        of inner nodes are references to stored nodes: PrunedNodes with their
+        hash and sum.
+        """
+        try:
+            node = self.cache[hash]
+        except KeyError:
+            pass
+        else:
+            self.cache.move_to_end(hash)
+            return node
+
+        row = self.db.execute('SELECT data FROM nodes WHERE hash = ?', (hash,)).fetchone()
+        if row is None:
+            raise KeyError('node %s not in store' % hash.hex())
+
+        ctx = proofmarshal.BufferDeserializationContext(row[0], materialize=True)
+        node = self.tree._node_ctx_deserialize(lambda: ctx, depth, prefix)
+        ctx.finish()
+        if self.tree._node_hash(node)[0] != hash:
+            raise proofmarshal.DeserializationError('stored node %s is corrupt' % hash.hex())
+
+        self._cache_put(hash, node)
+        return node
+
+    def _shallow(self, node):
+        """Return node with its children, if any, replaced by references"""
+        if isinstance(node, InnerNode):
+            shallow = InnerNode(PrunedNode(*self.tree._node_hash(node.left)),
+                                PrunedNode(*self.tree._node_hash(node.right)))
+            hash, sum = self.tree._node_hash(node)
+            object.__setattr__(shallow, '_hash', hash)
+            object.__setattr__(shallow, '_sum', sum)
+            return shallow
+        else:
+            return node
+
+    def store(self, root):
+        """Store every node under root that isn't stored already
+
+        Returns a reference to root.
+        """
+        rows = []
+        def recurse(node):
+            if isinstance(node, PrunedNode):
+                # Reference to a stored node
+                return
+
+            hash, sum = self.tree._node_hash(node)
+            if hash in self.cache:
+                # Loaded from, or already written to, the store
+                return
+
+            if isinstance(node, InnerNode):
+                recurse(node.left)
+                recurse(node.right)
+
+            shallow = self._shallow(node)
+            ctx = proofmarshal.BytesSerializationContext()
+            self.tree._node_ctx_serialize(ctx, shallow, False)
+            rows.append((hash, ctx.getbytes(), shallow))
+
+        recurse(root)
+        self.db.executemany('INSERT OR IGNORE INTO nodes VALUES (?, ?)',
+                            ((hash, data) for hash, data, shallow in rows))
+        for hash, data, shallow in rows:
+            self._cache_put(hash, shallow)
+        return PrunedNode(*self.tree._node_hash(root))
+
+    def get_root(self, name):
+        """Return (hash, count) of a named root, or None"""
+        return self.db.execute('SELECT hash, count FROM roots WHERE name = ?', (name,)).fetchone()
+
+    def set_root(self, name, hash, count):
+        self.db.execute('INSERT OR REPLACE INTO roots VALUES (?, ?, ?)', (name, hash, count))
+
+    def commit(self):
+        self.db.commit()
+
+
+class StoredMerbinnerTree(collections.abc.MutableMapping):
+    """MerbinnerTree whose nodes are loaded lazily from a NodeStore
+
+    If name is given the tree is the named root in the store, if it exists;
+    otherwise the tree starts empty.
+    """
+
+    def __init__(self, store, name=None):
+        self.store = store
+        self.tree = store.tree
+
+        root = None if name is None else store.get_root(name)
+        if root is None:
+            self._root = EmptyNode()
+            self._len = 0
+        else:
+            hash, self._len = root
+            self._root = store.load(hash)
+
+    @classmethod
+    def from_tree(cls, store, tree):
+        """Create from a MerbinnerTree, which is written on commit()
+
+        Raises ValueError if the tree has been pruned.
+        """
+        if tree.__class__ is not store.tree.__class__:
+            raise TypeError('store is for %s, not %s' % (store.tree.__class__.__name__, tree.__class__.__name__))
+        root = tree._get_root()
+        if any(isinstance(node, PrunedNode) for node in iter_nodes(root)):
+            raise ValueError("pruned trees can't be stored")
+        self = cls(store)
+        self._root = root
+        self._len = len(tree)
+        return self
+
+    def _resolve(self, node, depth, prefix):
+        if isinstance(node, PrunedNode):
+            ref = node
+            node = self.store.load(ref.hash, depth, prefix)
+            if self.tree._node_hash(node)[1] != ref.sum:
+                raise proofmarshal.DeserializationError('stored node %s has the wrong sum' % ref.hash.hex())
+        return node
+
+    def _find(self, keyhash):
+        node = self._root
+        depth = prefix = 0
+        while True:
+            node = self._resolve(node, depth, prefix)
+            if not isinstance(node, InnerNode):
+                return node
+            bit = get_bit(keyhash, depth)
+            node = node.left if bit else node.right
+            prefix = prefix << 1 | bit
+            depth += 1
+
+    def _materialize(self, node, keyhash, depth=0, prefix=0):
+        """Load the path to keyhash, and the siblings along it
+
+        Returns the subtree with loaded nodes in place of references along the
+        path, so it can be modified.
+        """
+        node = self._resolve(node, depth, prefix)
+        if not isinstance(node, InnerNode):
+            return node
+
+        left = self._resolve(node.left, depth+1, prefix << 1 | 1)
+        right = self._resolve(node.right, depth+1, prefix << 1)
+        if get_bit(keyhash, depth):
+            left = self._materialize(left, keyhash, depth+1, prefix << 1 | 1)
+        else:
+            right = self._materialize(right, keyhash, depth+1, prefix << 1)
+
+        if left is node.left and right is node.right:
+            return node
+        return InnerNode(left, right)
+
+    def __getitem__(self, key):
+        node = self._find(self.tree.key_gethash(key))
+        if isinstance(node, LeafNode) and node.key == key:
+            return node.value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        keyhash = self.tree.key_gethash(key)
+        root = self._materialize(self._root, keyhash)
+        if key not in self:
+            self._len += 1
+        self._root = self.tree._insert(root, key, keyhash, value, 0)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        keyhash = self.tree.key_gethash(key)
+        root = self._materialize(self._root, keyhash)
+        self._root = self.tree._remove(root, key, keyhash, 0)
+        self._len -= 1
+
+    def __iter__(self):
+        stack = [(self._root, 0, 0)]
+        while stack:
+            node, depth, prefix = stack.pop()
+            node = self._resolve(node, depth, prefix)
+            if isinstance(node, LeafNode):
+                yield node.key
+            elif isinstance(node, InnerNode):
+                stack.append((node.right, depth+1, prefix << 1))
+                stack.append((node.left, depth+1, prefix << 1 | 1))
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def hash(self):
+        return self.tree._node_hash(self._root)[0]
+
+    @property
+    def sum(self):
+        return self.tree._node_hash(self._root)[1]
+
+    def commit(self, name=None):
+        """Write every new node to the store, returning the hash of the tree
+
+        If name is given the tree is saved as that named root. Afterwards the
+        nodes are only held in memory by the store's cache.
+        """
+        self._root = self.store.store(self._root)
+        if name is not None:
+            self.store.set_root(name, self._root.hash, self._len)
+        self.store.commit()
+        return self._root.hash
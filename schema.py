@@ -0,0 +1,309 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Schema-declared proof objects
+
+Rather than hand-writing _ctx_serialize() and _ctx_deserialize(), subclasses
+of SchemaProof declare their fields:
+
+    class Foo(SchemaProof):
+        HASH_HMAC_KEY = ...
+        FIELDS = (('n', VarUInt()),
+                  ('digest', FixedBytes(32)),
+                  ('bar', Obj(Bar)))
+
+From the schema specialized serialize, deserialize and hash functions are
+generated once per class; runs of fixed-length fields are packed and unpacked
+with a single precompiled struct. The generic _ctx_serialize() and
+_ctx_deserialize() methods are generated as well, so every context works as
+usual, and the output is identical to the equivalent hand-written methods.
+"""
+
+import keyword
+import struct
+
+import proofmarshal
+from proofmarshal import varuint
+
+class Field:
+    """A field in a schema"""
+
+class VarUInt(Field):
+    """Variable-length unsigned integer"""
+
+class FixedBytes(Field):
+    """Byte array of a fixed length"""
+
+    def __init__(self, length):
+        self.length = length
+
+class VarBytes(Field):
+    """Variable-length byte array"""
+
+class Obj(Field):
+    """Nested object of a given class"""
+
+    def __init__(self, cls):
+        self.cls = cls
+
+
+def _read_varuint(buf, pos):
+    try:
+        return varuint.decode(buf, pos)
+    except ValueError:
+        raise proofmarshal.TruncationError('truncated varuint at offset %d' % pos) from None
+
+def _truncated(buf, pos, length):
+    raise proofmarshal.TruncationError('needed %d bytes at offset %d; only %d remain' % \
+                                       (length, pos, len(buf) - pos))
+
+def _serialize_obj(value, parts):
+    try:
+        fast_serialize = value._fast_serialize
+    except AttributeError:
+        parts.append(value.serialize())
+    else:
+        fast_serialize(parts)
+
+def _deserialize_obj(cls, buf, pos):
+    try:
+        fast_deserialize = cls._fast_deserialize
+    except AttributeError:
+        ctx = proofmarshal.BufferDeserializationContext(buf, materialize=True)
+        ctx.pos = pos
+        return (cls.ctx_deserialize(ctx), ctx.pos)
+    else:
+        return fast_deserialize(buf, pos)
+
+def _check_length(name, value, length):
+    if len(value) != length:
+        raise ValueError('%s must be %d bytes long; got %d' % (name, length, len(value)))
+
+
+def _check_field_names(cls, fields):
+    """Check that field names are identifiers usable in generated code
+
+    Generated helpers and locals are all prefixed with __pm_, which field
+    names may not use, nor may they shadow SchemaProof attributes.
+    """
+    seen = set()
+    for name, field in fields:
+        if not isinstance(name, str) or not name.isidentifier() or keyword.iskeyword(name):
+            raise ValueError('%s: field name %r is not a valid identifier' % (cls.__qualname__, name))
+        if name.startswith('__pm_') or hasattr(SchemaProof, name):
+            raise ValueError('%s: field name %r is reserved' % (cls.__qualname__, name))
+        if name in seen:
+            raise ValueError('%s: duplicate field name %r' % (cls.__qualname__, name))
+        seen.add(name)
+
+def _runs(fields, hashing):
+    """Group fields into runs of fixed-length fields and single other fields
+
+    Yields (struct_format, [(name, field), ...]), with struct_format None for
+    the latter. While hashing nested objects are fixed-length hashes.
+    """
+    run = []
+    for name, field in fields:
+        if isinstance(field, FixedBytes) or (hashing and isinstance(field, Obj)):
+            run.append((name, field))
+        else:
+            if run:
+                yield (_run_format(run), run)
+                run = []
+            yield (None, [(name, field)])
+    if run:
+        yield (_run_format(run), run)
+
+def _run_format(run):
+    return '>' + ''.join('%ds' % (field.length if isinstance(field, FixedBytes) else 32)
+                         for name, field in run)
+
+def _gen_serialize(fields, ns, hashing):
+    """Generate the body of a function appending the serialization to parts"""
+    lines = ['    __pm_append = __pm_parts.append']
+    for fmt, run in _runs(fields, hashing):
+        if fmt is not None:
+            struct_name = '__pm_struct%d' % len(ns)
+            ns[struct_name] = struct.Struct(fmt)
+            args = []
+            for name, field in run:
+                if isinstance(field, FixedBytes):
+                    lines.append('    __pm_f_%s = __pm_self.%s' % (name, name))
+                    lines.append('    if len(__pm_f_%s) != %d: __pm_check_length(%r, __pm_f_%s, %d)' % \
+                                 (name, field.length, name, name, field.length))
+                else:
+                    lines.append('    __pm_f_%s = __pm_self.%s.hash' % (name, name))
+                    lines.append('    assert len(__pm_f_%s) == 32' % name)
+                args.append('__pm_f_' + name)
+            lines.append('    __pm_append(%s.pack(%s))' % (struct_name, ', '.join(args)))
+
+        else:
+            ((name, field),) = run
+            if isinstance(field, VarUInt):
+                lines.append('    __pm_append(__pm_encode_varuint(__pm_self.%s))' % name)
+            elif isinstance(field, VarBytes):
+                lines.append('    __pm_f_%s = __pm_self.%s' % (name, name))
+                lines.append('    __pm_append(__pm_encode_varuint(len(__pm_f_%s)))' % name)
+                lines.append('    __pm_append(__pm_f_%s)' % name)
+            elif isinstance(field, Obj):
+                lines.append('    __pm_serialize_obj(__pm_self.%s, __pm_parts)' % name)
+            else:
+                raise TypeError('unknown field type %r' % field)
+    return lines
+
+def _gen_deserialize(fields, ns):
+    """Generate the body of a function deserializing from buf at pos"""
+    lines = ['    __pm_self = __pm_cls.__new__(__pm_cls)',
+             '    __pm_d = __pm_self.__dict__']
+    for fmt, run in _runs(fields, False):
+        if fmt is not None:
+            struct_name = '__pm_struct%d' % len(ns)
+            ns[struct_name] = struct.Struct(fmt)
+            size = ns[struct_name].size
+            lines.append('    __pm_end = __pm_pos + %d' % size)
+            lines.append('    if __pm_end > len(__pm_buf): __pm_truncated(__pm_buf, __pm_pos, %d)' % size)
+            lines.append('    (%s,) = %s.unpack_from(__pm_buf, __pm_pos)' % \
+                         (', '.join("__pm_d[%r]" % name for name, field in run), struct_name))
+            lines.append('    __pm_pos = __pm_end')
+
+        else:
+            ((name, field),) = run
+            if isinstance(field, VarUInt):
+                lines.append('    __pm_d[%r], __pm_pos = __pm_read_varuint(__pm_buf, __pm_pos)' % name)
+            elif isinstance(field, VarBytes):
+                lines.append('    __pm_length, __pm_pos = __pm_read_varuint(__pm_buf, __pm_pos)')
+                lines.append('    __pm_end = __pm_pos + __pm_length')
+                lines.append('    if __pm_end > len(__pm_buf): __pm_truncated(__pm_buf, __pm_pos, __pm_length)')
+                lines.append('    __pm_d[%r] = bytes(__pm_buf[__pm_pos:__pm_end])' % name)
+                lines.append('    __pm_pos = __pm_end')
+            elif isinstance(field, Obj):
+                cls_name = '__pm_class%d' % len(ns)
+                ns[cls_name] = field.cls
+                lines.append('    __pm_d[%r], __pm_pos = __pm_deserialize_obj(%s, __pm_buf, __pm_pos)' % \
+                             (name, cls_name))
+            else:
+                raise TypeError('unknown field type %r' % field)
+    lines.append('    return (__pm_self, __pm_pos)')
+    return lines
+
+def _gen_ctx_serialize(fields, ns):
+    lines = []
+    for name, field in fields:
+        if isinstance(field, VarUInt):
+            lines.append('    __pm_ctx.write_varuint(%r, __pm_self.%s)' % (name, name))
+        elif isinstance(field, FixedBytes):
+            lines.append('    __pm_ctx.write_bytes(%r, __pm_self.%s, %d)' % (name, name, field.length))
+        elif isinstance(field, VarBytes):
+            lines.append('    __pm_ctx.write_bytes(%r, __pm_self.%s)' % (name, name))
+        elif isinstance(field, Obj):
+            lines.append('    __pm_ctx.write_obj(%r, __pm_self.%s)' % (name, name))
+    return lines or ['    pass']
+
+def _gen_ctx_deserialize(fields, ns):
+    lines = ['    __pm_d = __pm_self.__dict__']
+    for name, field in fields:
+        if isinstance(field, VarUInt):
+            lines.append('    __pm_d[%r] = __pm_ctx.read_varuint(%r)' % (name, name))
+        elif isinstance(field, FixedBytes):
+            lines.append('    __pm_d[%r] = __pm_ctx.read_bytes(%r, %d)' % (name, name, field.length))
+        elif isinstance(field, VarBytes):
+            lines.append('    __pm_d[%r] = __pm_ctx.read_bytes(%r)' % (name, name))
+        elif isinstance(field, Obj):
+            cls_name = '__pm_class%d' % len(ns)
+            ns[cls_name] = field.cls
+            lines.append('    __pm_d[%r] = __pm_ctx.read_obj(%r, %s)' % (name, name, cls_name))
+    return lines
+
+def _gen_init(fields, ns):
+    # Arguments are named after the fields
+    return ['    __pm_self.__dict__.update({%s})' % ', '.join('%r: %s' % (name, name) for name, field in fields)]
+
+def _make_function(cls, func_name, args, body, ns):
+    src = 'def %s(%s):\n%s\n' % (func_name, ', '.join(args), '\n'.join(body))
+    exec(src, ns)
+    func = ns[func_name]
+    func.__qualname__ = '%s.%s' % (cls.__qualname__, func_name)
+    func.__module__ = cls.__module__
+    return func
+
+class SchemaProof(proofmarshal.ImmutableProof):
+    """Proof object whose serialization is declared by FIELDS
+
+    FIELDS is a sequence of (name, Field) pairs, serialized in order. Unless
+    the class defines them, __init__() taking the fields as arguments, and
+    _ctx_serialize() and _ctx_deserialize() are generated too.
+    """
+
+    FIELDS = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'FIELDS' not in cls.__dict__:
+            return
+
+        fields = tuple(cls.FIELDS)
+        _check_field_names(cls, fields)
+        field_names = [name for name, field in fields]
+
+        ns = {'__pm_encode_varuint': varuint.encode,
+              '__pm_read_varuint': _read_varuint,
+              '__pm_truncated': _truncated,
+              '__pm_serialize_obj': _serialize_obj,
+              '__pm_deserialize_obj': _deserialize_obj,
+              '__pm_check_length': _check_length}
+
+        cls._fast_serialize = _make_function(cls, '_fast_serialize', ['__pm_self', '__pm_parts'],
+                                             _gen_serialize(fields, ns, False), ns)
+        cls._fast_hash_serialize = _make_function(cls, '_fast_hash_serialize', ['__pm_self', '__pm_parts'],
+                                                  _gen_serialize(fields, ns, True), ns)
+        cls._fast_deserialize = classmethod(_make_function(cls, '_fast_deserialize',
+                                                           ['__pm_cls', '__pm_buf', '__pm_pos'],
+                                                           _gen_deserialize(fields, ns), ns))
+        cls._HAS_OBJ_FIELDS = any(isinstance(field, Obj) for name, field in fields)
+
+        if '_ctx_serialize' not in cls.__dict__:
+            cls._ctx_serialize = _make_function(cls, '_ctx_serialize', ['__pm_self', '__pm_ctx'],
+                                                _gen_ctx_serialize(fields, ns), ns)
+        if '_ctx_deserialize' not in cls.__dict__:
+            cls._ctx_deserialize = _make_function(cls, '_ctx_deserialize', ['__pm_self', '__pm_ctx'],
+                                                  _gen_ctx_deserialize(fields, ns), ns)
+        if '__init__' not in cls.__dict__:
+            cls.__init__ = _make_function(cls, '__init__', ['__pm_self'] + field_names,
+                                          _gen_init(fields, ns), ns)
+
+    def serialize(self):
+        """Serialize to bytes"""
+        parts = []
+        self._fast_serialize(parts)
+        return b''.join(parts)
+
+    @classmethod
+    def deserialize(cls, buf, limits=None):
+        """Deserialize from bytes"""
+        if limits is not None:
+            # Only the context path enforces limits
+            return super().deserialize(buf, limits)
+
+        self, pos = cls._fast_deserialize(buf, 0)
+        if pos != len(buf):
+            raise proofmarshal.TrailingDataError('%d bytes of trailing data' % (len(buf) - pos))
+        return self
+
+    def calc_hash(self):
+        if self._HAS_OBJ_FIELDS and proofmarshal.get_hash_cache() is not None:
+            # Let HashSerializationContext.write_obj consult the cache
+            return super().calc_hash()
+
+        parts = []
+        self._fast_hash_serialize(parts)
+        hasher = proofmarshal.new_hmac(self.HASH_HMAC_KEY, self.HASH_ENGINE)
+        hasher.update(b''.join(parts))
+        return hasher.digest()
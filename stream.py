@@ -0,0 +1,282 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Streams of many proofs
+
+PushParser does no I/O itself; the caller feeds it whatever bytes have arrived
+and gets back the objects completed so far:
+
+    parser = PushParser(Foo)
+    for chunk in chunks:
+        for foo in parser.feed(chunk):
+            ...
+    parser.close()
+
+AsyncReader adapts a PushParser to an asyncio StreamReader, and
+iter_deserialize() to a blocking file object. BatchWriter writes many objects
+with as few writes as possible.
+
+Objects in a stream are either simply concatenated, or each is prefixed by its
+length as a varuint, allowing the end of an object to be found without parsing
+it.
+"""
+
+import collections
+import io
+
+import proofmarshal
+from proofmarshal import varuint
+
+class _PushDeserializationContext(proofmarshal.BufferDeserializationContext):
+    """Records how much of the buffer is needed when truncated"""
+
+    def __init__(self, buf, limits=None):
+        super().__init__(buf, materialize=True, limits=limits)
+
+        # Unless we know better, at least one more byte
+        self.needed = len(self.buf) + 1
+
+    def read_bytes(self, attr_name, expected_length=None):
+        if expected_length is None:
+            expected_length = self.read_varuint(None)
+        if self.pos + expected_length > len(self.buf):
+            self.needed = self.pos + expected_length
+        return super().read_bytes(attr_name, expected_length)
+
+class PushParser:
+    """Resumable parser of a stream of concatenated objects
+
+    serialization_class is the class of the objects in the stream, usually a
+    subclass of ImmutableProof or MerbinnerTree.
+
+    Incomplete objects are parsed again from the start when more data
+    arrives, but not until enough has arrived for the read that failed, and
+    the buffered data has at least doubled, so the total cost of parsing is
+    linear however many chunks an object arrives in. An object may thus only
+    be returned by a later feed(), or by close(); if length_prefixed objects
+    are only parsed once they have fully arrived, and returned immediately.
+
+    limits, a DeserializationLimits, applies to each object, and is checked
+    before waiting for more data, so a hostile stream can't make the parser
+    buffer more than max_bytes.
+    """
+
+    def __init__(self, serialization_class, length_prefixed=False, limits=None):
+        self.serialization_class = serialization_class
+        self.length_prefixed = length_prefixed
+        self.limits = limits
+        self.buf = bytearray()
+        self.pos = 0
+
+        # Bytes required, from pos, before parsing is worth trying again
+        self.needed = 0
+
+    def __len__(self):
+        """Number of bytes buffered that are not yet part of an object"""
+        return len(self.buf) - self.pos
+
+    def feed(self, data):
+        """Add data to the stream
+
+        Returns a list of the objects completed, possibly empty. Invalid data
+        raises DeserializationError, after which the parser is unusable.
+        """
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += data
+
+        parse = self._parse_length_prefixed if self.length_prefixed else self._parse
+        r = []
+        while len(self) and len(self) >= self.needed:
+            obj = parse()
+            if obj is None:
+                break
+            r.append(obj)
+        return r
+
+    def _parse(self):
+        ctx = _PushDeserializationContext(memoryview(self.buf)[self.pos:], self.limits)
+        try:
+            obj = self.serialization_class.ctx_deserialize(ctx)
+        except proofmarshal.TruncationError:
+            self.needed = max(ctx.needed, 2 * len(self))
+            return None
+        finally:
+            ctx.buf.release()
+
+        self.pos += ctx.pos
+        self.needed = 0
+        return obj
+
+    def _parse_length_prefixed(self):
+        try:
+            length, start = varuint.decode(self.buf, self.pos)
+        except ValueError:
+            self.needed = len(self) + 1
+            return None
+
+        if self.limits is not None:
+            self.limits.check_bytes(length)
+
+        end = start + length
+        if end > len(self.buf):
+            self.needed = end - self.pos
+            return None
+
+        ctx = proofmarshal.BufferDeserializationContext(memoryview(self.buf)[start:end], materialize=True,
+                                                        limits=self.limits)
+        try:
+            obj = self.serialization_class.ctx_deserialize(ctx)
+            ctx.finish()
+        except proofmarshal.TruncationError as exp:
+            raise proofmarshal.DeserializationError('object longer than its length prefix: %s' % exp) from None
+        finally:
+            ctx.buf.release()
+
+        self.pos = end
+        self.needed = 0
+        return obj
+
+    def close(self):
+        """Signal the end of the stream
+
+        Returns a list of the objects completed that feed() has not yet
+        returned. Raises TruncationError if the stream ended part way through
+        an object.
+        """
+        r = []
+        if not self.length_prefixed:
+            while len(self):
+                obj = self._parse()
+                if obj is None:
+                    break
+                r.append(obj)
+        if len(self):
+            raise proofmarshal.TruncationError('stream ended with %d bytes of an incomplete object' % len(self))
+        return r
+
+
+def iter_deserialize(fd, serialization_class, length_prefixed=False, block_size=64*1024, limits=None):
+    """Yield successive objects from a file object until the end of the stream
+
+    The file is read in blocks of up to block_size, using read1() if it has
+    it, so objects are yielded as soon as a pipe or socket delivers them.
+    Raises TruncationError if the stream ends part way through an object.
+    """
+    read = getattr(fd, 'read1', fd.read)
+    parser = PushParser(serialization_class, length_prefixed, limits)
+    while True:
+        data = read(block_size)
+        if not data:
+            yield from parser.close()
+            return
+        yield from parser.feed(data)
+
+class BatchWriter:
+    """Write many objects to a file object in as few writes as possible
+
+    Objects are serialized into a buffer, which is written out whenever it
+    reaches batch_size, and on flush() or close(). Also usable as a context
+    manager, flushing on exit.
+    """
+
+    def __init__(self, fd, length_prefixed=False, batch_size=64*1024):
+        self.fd = fd
+        self.length_prefixed = length_prefixed
+        self.batch_size = batch_size
+        self.buf = io.BytesIO()
+        self.ctx = proofmarshal.StreamSerializationContext(self.buf)
+
+    def write(self, obj, serialization_class=None):
+        """Write an object"""
+        if self.length_prefixed:
+            if serialization_class is None:
+                serialized = obj.serialize()
+            else:
+                serialized = serialization_class.serialize(obj)
+            self.ctx.write_bytes(None, serialized)
+        elif serialization_class is None:
+            obj.ctx_serialize(self.ctx)
+        else:
+            serialization_class.ctx_serialize(obj, self.ctx)
+
+        if self.buf.tell() >= self.batch_size:
+            self.flush()
+
+    def write_many(self, objs, serialization_class=None):
+        """Write every object in an iterable"""
+        for obj in objs:
+            self.write(obj, serialization_class)
+
+    def flush(self):
+        """Write everything buffered to the file object"""
+        view = self.buf.getbuffer()[:self.buf.tell()]
+        try:
+            while view:
+                n = self.fd.write(view)
+                if n is None:
+                    raise BlockingIOError('file object is non-blocking')
+                view = view[n:]
+        finally:
+            view.release()
+        self.buf.seek(0)
+        self.buf.truncate()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AsyncReader:
+    """Deserialize a stream of objects from an asyncio StreamReader
+
+    Usable as an async iterator:
+
+        async for foo in AsyncReader(reader, Foo):
+            ...
+    """
+
+    def __init__(self, reader, serialization_class, length_prefixed=False, chunk_size=64*1024, limits=None):
+        self.reader = reader
+        self.parser = PushParser(serialization_class, length_prefixed, limits)
+        self.chunk_size = chunk_size
+        self.pending = collections.deque()
+
+    async def read(self):
+        """Return the next object
+
+        Raises EOFError if the stream ends cleanly, and TruncationError if it
+        ends part way through an object.
+        """
+        while not self.pending:
+            data = await self.reader.read(self.chunk_size)
+            if not data:
+                self.pending.extend(self.parser.close())
+                if not self.pending:
+                    raise EOFError('end of stream')
+                break
+            self.pending.extend(self.parser.feed(data))
+        return self.pending.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.read()
+        except EOFError:
+            raise StopAsyncIteration from None
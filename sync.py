@@ -0,0 +1,177 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Synchronization of MerbinnerTrees over a message-based transport
+
+A client brings its copy of a tree up to date with a server's by exchanging
+request and reply messages, descending only into subtrees whose hashes and
+sums differ:
+
+    server = SyncServer(remote_tree)
+    diff = sync(local_tree, LocalTransport(server))
+
+Each request lists the bit paths of the nodes the client wants; each reply
+has, for every path, the node there with its children pruned, or the whole
+node if it's a leaf or empty. There is one round trip per level of the tree
+that has differences, with the size of the messages proportional to the
+number of differences.
+
+A transport is anything with a request(message) method returning the reply;
+LocalTransport calls a SyncServer directly.
+"""
+
+import proofmarshal
+from proofmarshal.merbinnertree import InnerNode, PrunedNode, MerbinnerTree, PersistentMerbinnerTree, \
+                                       TreeDiff, _children, _diff_nodes
+
+def _serialize_paths(paths):
+    ctx = proofmarshal.BytesSerializationContext()
+    ctx.write_varuint('count', len(paths))
+    for depth, prefix in paths:
+        ctx.write_varuint('depth', depth)
+        ctx.write_varuint('prefix', prefix)
+    return ctx.getbytes()
+
+def _deserialize_paths(buf):
+    ctx = proofmarshal.BufferDeserializationContext(buf)
+    paths = []
+    for i in range(ctx.read_varuint('count')):
+        depth = ctx.read_varuint('depth')
+        prefix = ctx.read_varuint('prefix')
+        if prefix >> depth:
+            raise proofmarshal.DeserializationError('prefix %d longer than depth %d' % (prefix, depth))
+        paths.append((depth, prefix))
+    ctx.finish()
+    return paths
+
+class SyncServer:
+    """Serves nodes of a tree to clients
+
+    tree may be a MerbinnerTree, in which case a snapshot of it is served, or
+    a PersistentMerbinnerTree.
+    """
+
+    def __init__(self, tree):
+        if isinstance(tree, MerbinnerTree):
+            tree = tree.snapshot()
+        self.snapshot = tree
+
+    def _find(self, depth, prefix):
+        node = self.snapshot._root
+        for i in range(depth):
+            if not isinstance(node, InnerNode):
+                raise ValueError('no node at depth %d, prefix %d' % (depth, prefix))
+            node = node.left if prefix >> (depth - i - 1) & 1 else node.right
+        return node
+
+    def handle(self, request):
+        """Return the reply to a request message"""
+        tree = self.snapshot._tree
+        ctx = proofmarshal.BytesSerializationContext()
+        paths = _deserialize_paths(request)
+        ctx.write_varuint('count', len(paths))
+        for depth, prefix in paths:
+            node = self._find(depth, prefix)
+            if isinstance(node, InnerNode):
+                node = InnerNode(PrunedNode(*tree._node_hash(node.left)),
+                                 PrunedNode(*tree._node_hash(node.right)))
+            tree._node_ctx_serialize(ctx, node, False)
+        return ctx.getbytes()
+
+class LocalTransport:
+    """Transport that calls a SyncServer in the same process
+
+    Counts the round trips and bytes exchanged.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def request(self, message):
+        self.round_trips += 1
+        self.bytes_sent += len(message)
+        reply = self.server.handle(message)
+        self.bytes_received += len(reply)
+        return reply
+
+def sync_diff(tree, transport):
+    """Return the TreeDiff from a tree to the server's tree
+
+    tree may be a MerbinnerTree or a PersistentMerbinnerTree; it isn't
+    modified.
+    """
+    return _sync_diff(tree, transport)[0]
+
+def _sync_diff(tree, transport):
+    """Return (diff, server root hash)"""
+    if isinstance(tree, PersistentMerbinnerTree):
+        tree, root = tree._tree, tree._root
+    else:
+        root = tree._get_root()
+
+    r = TreeDiff({}, {}, {})
+    pending = [(0, 0, root)]
+    while pending:
+        reply = transport.request(_serialize_paths([(depth, prefix) for depth, prefix, local in pending]))
+        ctx = proofmarshal.BufferDeserializationContext(reply, materialize=True)
+        if ctx.read_varuint('count') != len(pending):
+            raise proofmarshal.DeserializationError('reply has the wrong number of nodes')
+
+        next_pending = []
+        for depth, prefix, local in pending:
+            remote = tree._node_ctx_deserialize(lambda: ctx, depth, prefix)
+            if depth == 0:
+                root_hash = tree._node_hash(remote)[0]
+
+            if tree._node_hash(local) == tree._node_hash(remote):
+                continue
+
+            elif isinstance(remote, InnerNode):
+                if not (isinstance(remote.left, PrunedNode) and isinstance(remote.right, PrunedNode)):
+                    raise proofmarshal.DeserializationError('inner node in reply has unpruned children')
+
+                local_left, local_right = _children(local, depth)
+                if tree._node_hash(local_left) != tree._node_hash(remote.left):
+                    next_pending.append((depth+1, prefix << 1 | 1, local_left))
+                if tree._node_hash(local_right) != tree._node_hash(remote.right):
+                    next_pending.append((depth+1, prefix << 1, local_right))
+
+            elif isinstance(remote, PrunedNode):
+                raise ValueError('server tree has been pruned at depth %d, prefix %d' % (depth, prefix))
+
+            else:
+                # Leaf or empty node, which is complete
+                _diff_nodes(tree, local, remote, depth, r)
+
+        ctx.finish()
+        pending = next_pending
+
+    return (r, root_hash)
+
+def sync(tree, transport):
+    """Bring a MerbinnerTree up to date with the server's tree
+
+    Returns the TreeDiff that was applied.
+    """
+    diff, root_hash = _sync_diff(tree, transport)
+    for key in diff.removed:
+        del tree[key]
+    for key, value in diff.added.items():
+        tree[key] = value
+    for key, (old_value, new_value) in diff.changed.items():
+        tree[key] = new_value
+
+    if tree.hash != root_hash:
+        raise ValueError('tree hash does not match the server after syncing')
+    return diff
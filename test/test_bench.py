@@ -0,0 +1,31 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import importlib
+import unittest
+
+bench_main = importlib.import_module('proofmarshal.bench.__main__')
+
+class Test_bench(unittest.TestCase):
+    def test_run(self):
+        """Smoke test of the benchmark runner"""
+        results = bench_main.run(names=['varuint.encode', 'merbinnertree.summed'], max_size=10, min_time=0)
+        self.assertIn('varuint.encode.10k', results)
+        self.assertIn('merbinnertree.summed.hash.10', results)
+        self.assertNotIn('merbinnertree.summed.hash.100', results)
+        self.assertNotIn('merbinnertree.plain.hash.10', results)
+
+        baseline = dict(results)
+        baseline['varuint.encode.10k'] /= 2
+        baseline['missing'] = 1.0
+        rows, regressions = bench_main.compare(results, baseline, 1.25)
+        self.assertEqual(len(results), len(rows))
+        self.assertEqual(['varuint.encode.10k'], regressions)
@@ -9,8 +9,17 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import hashlib
+import hmac
 import io
+import json
+import mmap
+import os
+import socket
+import tempfile
+import threading
 import unittest
+import unittest.mock
 import uuid
 
 from proofmarshal import *
@@ -62,6 +71,23 @@ class boxed_objs(ImmutableProof):
         object.__setattr__(self, 'buf', ctx.read_obj('buf', boxed_bytes))
         object.__setattr__(self, 'i', ctx.read_obj('i', boxed_varuint))
 
+class boxed_pair(ImmutableProof):
+    """Object with two, possibly identical, objects"""
+
+    HASH_HMAC_KEY = x('a3e4d5c5e7f8b84f8d3b0e2f6c3e1e07')
+
+    def __init__(self, a, b):
+        object.__setattr__(self, 'a', a)
+        object.__setattr__(self, 'b', b)
+
+    def _ctx_serialize(self, ctx):
+        ctx.write_obj('a', self.a)
+        ctx.write_obj('b', self.b)
+
+    def _ctx_deserialize(self, ctx):
+        object.__setattr__(self, 'a', ctx.read_obj('a', boxed_objs))
+        object.__setattr__(self, 'b', ctx.read_obj('b', boxed_objs))
+
 class Test_BytesSerializationContext(unittest.TestCase):
     def test_varuint(self):
         """Test varuints against vectors"""
@@ -77,6 +103,13 @@ class Test_BytesSerializationContext(unittest.TestCase):
             actual_value = boxed_varuint.deserialize(expected_bytes).i
             self.assertEqual(expected_value, actual_value)
 
+            actual_value = boxed_varuint.stream_deserialize(io.BytesIO(expected_bytes)).i
+            self.assertEqual(expected_value, actual_value)
+
+            if len(expected_bytes) > 1:
+                with self.assertRaises(TruncationError):
+                    boxed_varuint.stream_deserialize(io.BytesIO(expected_bytes[:-1]))
+
     def test_bytes(self):
         """Test bytes against vectors"""
 
@@ -116,6 +149,257 @@ class Test_BytesSerializationContext(unittest.TestCase):
             roundtrip_serialized_bytes = actual_boxed_obj.serialize()
             self.assertEqual(b2x(expected_serialized_bytes), b2x(roundtrip_serialized_bytes))
 
+class Test_LengthSerializationContext(unittest.TestCase):
+    def test_serialized_size(self):
+        """serialized_size() matches the length of serialize()"""
+        for expected_hex_bytes, expected_value in load_test_vectors('valid_varuints.json'):
+            self.assertEqual(len(x(expected_hex_bytes)), boxed_varuint(expected_value).serialized_size())
+
+        for expected_hex_serialized_bytes, expected_hex_buf, expected_i, expected_hex_hash \
+                in load_test_vectors('valid_boxed_objs.json'):
+            obj = boxed_objs(x(expected_hex_buf), expected_i)
+            self.assertEqual(len(x(expected_hex_serialized_bytes)), obj.serialized_size())
+
+    def test_preallocated(self):
+        """BytesSerializationContext writing into a preallocated buffer"""
+        obj = boxed_objs(x('deadbeef'), 1000)
+        expected = obj.serialize()
+
+        ctx = BytesSerializationContext(obj.serialized_size())
+        obj.ctx_serialize(ctx)
+        self.assertIsInstance(ctx.getbuffer(), bytearray)
+        self.assertEqual(b2x(expected), b2x(ctx.getbytes()))
+
+        # Too small
+        ctx = BytesSerializationContext(len(expected) - 1)
+        with self.assertRaises(ValueError):
+            obj.ctx_serialize(ctx)
+
+        # Too large returns what was written
+        ctx = BytesSerializationContext(len(expected) + 1)
+        obj.ctx_serialize(ctx)
+        self.assertEqual(b2x(expected), b2x(ctx.getbytes()))
+
+class Test_GatherSerializationContext(unittest.TestCase):
+    def test_objs(self):
+        for expected_hex_serialized_bytes, expected_hex_buf, expected_i, expected_hex_hash \
+                in load_test_vectors('valid_boxed_objs.json'):
+            ctx = GatherSerializationContext(copy_threshold=2)
+            boxed_objs(x(expected_hex_buf), expected_i).ctx_serialize(ctx)
+            self.assertEqual(expected_hex_serialized_bytes, b2x(ctx.getbytes()))
+
+    def test_zero_copy(self):
+        """Large byte arrays are referenced, not copied"""
+        payload = os.urandom(100000)
+        obj = boxed_pair(boxed_objs(payload, 1), boxed_objs(x('deadbeef'), 2))
+
+        ctx = GatherSerializationContext()
+        obj.ctx_serialize(ctx)
+        buffers = ctx.getbuffers()
+        self.assertEqual(3, len(buffers))
+        self.assertIs(payload, buffers[1])
+        self.assertEqual(b2x(obj.serialize()), b2x(ctx.getbytes()))
+
+    def test_writev(self):
+        obj = boxed_pair(boxed_objs(os.urandom(100000), 1), boxed_objs(os.urandom(10000), 2))
+        ctx = GatherSerializationContext()
+        obj.ctx_serialize(ctx)
+
+        with tempfile.TemporaryFile() as fd:
+            ctx.writev(fd.fileno())
+            fd.seek(0)
+            self.assertEqual(b2x(obj.serialize()), b2x(fd.read()))
+
+        sock1, sock2 = socket.socketpair()
+        with sock1, sock2:
+            sock1.setblocking(True)
+            received = []
+            reader = threading.Thread(target=lambda: received.extend(iter(lambda: sock2.recv(65536), b'')))
+            reader.start()
+            ctx.sendmsg(sock1)
+            sock1.shutdown(socket.SHUT_WR)
+            reader.join()
+        self.assertEqual(b2x(obj.serialize()), b2x(b''.join(received)))
+
+    def test_partial_writes(self):
+        """Writes may stop part way through a buffer"""
+        obj = boxed_pair(boxed_objs(b'\xaa' * 10, 1), boxed_objs(b'\xbb' * 20, 2))
+        ctx = GatherSerializationContext(copy_threshold=5)
+        ctx.MAX_BUFFERS = 2
+        obj.ctx_serialize(ctx)
+
+        written = bytearray()
+        def write(buffers):
+            buf = b''.join(buffers)[:7]
+            written.extend(buf)
+            return len(buf)
+        ctx._write_all(write)
+        self.assertEqual(b2x(obj.serialize()), b2x(written))
+
+class Test_BufferDeserializationContext(unittest.TestCase):
+    def test_zero_copy(self):
+        """Byte arrays are returned without copying"""
+        buf = bytearray(x('04deadbeef8001'))
+        actual_boxed_obj = boxed_objs.buffer_deserialize(buf)
+        self.assertIsInstance(actual_boxed_obj.buf.buf, memoryview)
+        self.assertEqual(x('deadbeef'), actual_boxed_obj.buf.buf)
+        self.assertEqual(128, actual_boxed_obj.i.i)
+
+        buf[1] = 0
+        self.assertEqual(x('00adbeef'), actual_boxed_obj.buf.buf)
+
+    def test_materialize(self):
+        actual_boxed_obj = boxed_objs.buffer_deserialize(x('04deadbeef8001'), materialize=True)
+        self.assertIsInstance(actual_boxed_obj.buf.buf, bytes)
+        self.assertEqual(x('deadbeef'), actual_boxed_obj.buf.buf)
+
+    def test_mmap(self):
+        with tempfile.TemporaryFile() as fd:
+            fd.write(x('04deadbeef8001'))
+            fd.flush()
+            actual_boxed_obj = boxed_objs.mmap_deserialize(fd)
+            self.assertEqual(x('deadbeef'), actual_boxed_obj.buf.buf)
+            self.assertEqual(128, actual_boxed_obj.i.i)
+
+    def test_mmap_materialize(self):
+        """Materialized results don't keep the file mapped"""
+        mmaps = []
+        orig_mmap = mmap.mmap
+        def tracking_mmap(*args, **kwargs):
+            mmaps.append(orig_mmap(*args, **kwargs))
+            return mmaps[-1]
+
+        with unittest.mock.patch('mmap.mmap', tracking_mmap):
+            for buf in (x('04deadbeef8001'), x('04deadbe')):
+                with tempfile.TemporaryFile() as fd:
+                    fd.write(buf)
+                    fd.flush()
+                    try:
+                        actual_boxed_obj = boxed_objs.mmap_deserialize(fd, materialize=True)
+                    except TruncationError:
+                        pass
+                    else:
+                        self.assertEqual(x('deadbeef'), actual_boxed_obj.buf.buf)
+
+        self.assertEqual(2, len(mmaps))
+        self.assertTrue(all(m.closed for m in mmaps))
+
+    def test_mmap_limits(self):
+        """Limits are enforced, and the mapping still closed"""
+        for buf, exp in ((b'\xff' * 5 + b'\x00', LimitExceededError),
+                         (b'\xff', TruncationError)):
+            with tempfile.TemporaryFile() as fd:
+                fd.write(buf)
+                fd.flush()
+                with self.assertRaises(exp):
+                    boxed_varuint.mmap_deserialize(fd, materialize=True,
+                                                   limits=DeserializationLimits(max_varuint_bytes=2))
+
+    def test_mmap_empty(self):
+        with tempfile.TemporaryFile() as fd:
+            with self.assertRaises(TruncationError):
+                boxed_objs.mmap_deserialize(fd)
+
+    def test_truncated(self):
+        for buf in (x(''), x('04deadbe'), x('04deadbeef'), x('04deadbeef80')):
+            with self.assertRaises(TruncationError):
+                boxed_objs.buffer_deserialize(buf)
+
+    def test_trailing_data(self):
+        with self.assertRaises(TrailingDataError):
+            boxed_objs.deserialize(x('04deadbeef800100'))
+
+        ctx = BytesDeserializationContext(x('04deadbeef800100'))
+        boxed_objs.ctx_deserialize(ctx)
+        with self.assertRaises(TrailingDataError):
+            ctx.finish()
+
+class Test_MemoizedSerializationContext(unittest.TestCase):
+    def test_backrefs(self):
+        """Repeated objects are serialized once"""
+        obj = boxed_objs(x('deadbeef'), 128)
+        pair = boxed_pair(obj, boxed_objs(x('deadbeef'), 128))
+
+        buf = pair.memoized_serialize()
+        self.assertEqual(b2x(x('00 00 04deadbeef 00 8001  03')), b2x(buf))
+
+        pair2 = boxed_pair.memoized_deserialize(buf)
+        self.assertIs(pair2.a, pair2.b)
+        self.assertEqual(x('deadbeef'), pair2.a.buf.buf)
+        self.assertEqual(128, pair2.a.i.i)
+        self.assertEqual(b2x(pair.hash), b2x(pair2.hash))
+
+        # Sub-objects are shared too
+        pair = boxed_pair(obj, boxed_objs(x('cafebabe'), 128))
+        buf = pair.memoized_serialize()
+        self.assertEqual(b2x(x('00 00 04deadbeef 00 8001  00 00 04cafebabe 02')), b2x(buf))
+        pair2 = boxed_pair.memoized_deserialize(buf)
+        self.assertIs(pair2.a.i, pair2.b.i)
+
+    def test_invalid_backrefs(self):
+        for hex_buf in ('00 00 04deadbeef 00 8001  04',
+                        # reference to a boxed_bytes rather than a boxed_objs
+                        '00 00 04deadbeef 00 8001  01'):
+            with self.assertRaises(DeserializationError):
+                boxed_pair.memoized_deserialize(x(hex_buf))
+
+class Test_DeserializationLimits(unittest.TestCase):
+    def test_limits(self):
+        buf = boxed_pair(boxed_objs(x('deadbeef'), 128), boxed_objs(x('cafebabe'), 1)).serialize()
+        self.assertEqual(13, len(buf))
+
+        def deserializers(limits):
+            yield lambda: boxed_pair.deserialize(buf, limits)
+            yield lambda: boxed_pair.stream_deserialize(io.BytesIO(buf), limits)
+            yield lambda: boxed_pair.ctx_deserialize(BytesDeserializationContext(buf, limits))
+
+        for limits in (DeserializationLimits(max_bytes=13, max_bytes_length=4, max_varuint_bytes=2, max_depth=2),
+                       DeserializationLimits()):
+            for deserialize in deserializers(limits):
+                self.assertEqual(b2x(buf), b2x(deserialize().serialize()))
+
+        for limits in (DeserializationLimits(max_bytes=12),
+                       DeserializationLimits(max_bytes_length=3),
+                       DeserializationLimits(max_varuint_bytes=1),
+                       DeserializationLimits(max_depth=1)):
+            for deserialize in deserializers(limits):
+                with self.assertRaises(LimitExceededError):
+                    deserialize()
+
+    def test_large_length(self):
+        """Huge lengths are rejected before anything is read or allocated"""
+        buf = x('ffffffffffffffff7f') + b'\x00' * 10
+        limits = DeserializationLimits(max_bytes_length=1000)
+        with self.assertRaises(LimitExceededError):
+            boxed_bytes.stream_deserialize(io.BytesIO(buf), limits)
+        with self.assertRaises(LimitExceededError):
+            boxed_bytes.deserialize(buf, limits)
+
+        # Long varuints are rejected without decoding them
+        with self.assertRaises(LimitExceededError):
+            boxed_varuint.deserialize(b'\xff' * 100000 + b'\x00', DeserializationLimits(max_varuint_bytes=10))
+        with self.assertRaises(LimitExceededError):
+            boxed_varuint.stream_deserialize(io.BytesIO(b'\xff' * 100 + b'\x00'),
+                                             DeserializationLimits(max_varuint_bytes=10))
+
+        # Shorter than the limit, but truncated
+        with self.assertRaises(TruncationError):
+            boxed_varuint.deserialize(b'\xff' * 5, DeserializationLimits(max_varuint_bytes=10))
+
+    def test_json(self):
+        obj = boxed_objs(x('deadbeef'), 1)
+        limits = DeserializationLimits(max_bytes_length=3)
+        with self.assertRaises(LimitExceededError):
+            boxed_objs.json_deserialize(obj.json_serialize(), limits)
+
+        fd = io.StringIO()
+        obj.json_stream_serialize(fd)
+        for limits in (DeserializationLimits(max_bytes_length=3),
+                       DeserializationLimits(max_depth=0)):
+            fd.seek(0)
+            with self.assertRaises(LimitExceededError):
+                boxed_objs.json_stream_deserialize(fd, limits)
+
 class Test_JsonSerializationContext(unittest.TestCase):
     def test_varuint(self):
         for expected_value in (0, 1, 2**32):
@@ -133,6 +417,53 @@ class Test_JsonSerializationContext(unittest.TestCase):
             actual_json = boxed_bytes(actual_value).json_serialize()
             self.assertEqual({'buf':expected_json_value}, actual_json)
 
+    def test_objs(self):
+        obj = boxed_pair(boxed_objs(x('deadbeef'), 1), boxed_objs(b'', 2**64))
+        expected_json = {'a': {'buf': {'buf': 'deadbeef'}, 'i': {'i': 1}},
+                         'b': {'buf': {'buf': ''}, 'i': {'i': 2**64}}}
+        self.assertEqual(expected_json, obj.json_serialize())
+
+        obj2 = boxed_pair.json_deserialize(expected_json)
+        self.assertEqual(b2x(obj.serialize()), b2x(obj2.serialize()))
+
+    def test_stream(self):
+        """Streamed JSON is the same as the dict form"""
+        obj = boxed_pair(boxed_objs(os.urandom(100000), 1), boxed_objs(x('deadbeef'), 2**64))
+
+        fd = io.StringIO()
+        obj.json_stream_serialize(fd)
+        self.assertEqual(obj.json_serialize(), json.loads(fd.getvalue()))
+
+        # Pieces split at every possible position
+        for chunk_size in (1, 3, 1000):
+            fd.seek(0)
+            ctx = JsonStreamDeserializationContext(fd, chunk_size)
+            obj2 = boxed_pair.ctx_deserialize(ctx)
+            ctx.finish()
+            self.assertEqual(b2x(obj.serialize()), b2x(obj2.serialize()))
+
+        # Whitespace and escapes are allowed
+        obj2 = boxed_pair.json_stream_deserialize(io.StringIO(json.dumps(obj.json_serialize(), indent=4)))
+        self.assertEqual(b2x(obj.serialize()), b2x(obj2.serialize()))
+        obj2 = boxed_varuint.json_stream_deserialize(io.StringIO('{"\\u0069" : 1}\n'))
+        self.assertEqual(1, obj2.i)
+
+    def test_stream_invalid(self):
+        for invalid in ('{"buf": "deadbeef"}',
+                        '{"i": -1}',
+                        '{"i": "1"}',
+                        '{"i": 1, "j": 2}',
+                        '{"i": 1}}',
+                        '{"i": 1',
+                        '{"i": ',
+                        '{"i'):
+            with self.assertRaises(DeserializationError):
+                boxed_varuint.json_stream_deserialize(io.StringIO(invalid))
+
+        for invalid in ('{"buf": "abc"}', '{"buf": "zz"}', '{"buf": "dead'):
+            with self.assertRaises(DeserializationError):
+                boxed_bytes.json_stream_deserialize(io.StringIO(invalid))
+
 class Test_HashSerializationContext(unittest.TestCase):
     def test_objs(self):
         """Test object hashing"""
@@ -144,3 +475,62 @@ class Test_HashSerializationContext(unittest.TestCase):
 
             actual_hash = boxed_objs(expected_buf, expected_i).hash
             self.assertEqual(b2x(expected_hash), b2x(actual_hash))
+
+    def test_incremental(self):
+        """Hash context digests match HMAC over the serialized bytes"""
+        key = boxed_bytes.HASH_HMAC_KEY
+
+        ctx1 = HashSerializationContext(key)
+        ctx1.write_varuint('i', 128)
+        ctx1.write_bytes('buf', x('deadbeef'))
+
+        # Contexts sharing a key don't share state
+        ctx2 = HashSerializationContext(key)
+        ctx2.write_bytes('buf', x('deadbeef'), 4)
+
+        self.assertEqual(b2x(hmac.HMAC(key, x('8001 04deadbeef'), hashlib.sha256).digest()),
+                         b2x(ctx1.digest()))
+        self.assertEqual(b2x(hmac.HMAC(key, x('deadbeef'), hashlib.sha256).digest()),
+                         b2x(ctx2.digest()))
+
+    def test_unkeyed(self):
+        """Without a key the hash preimage is buffered"""
+        obj = boxed_objs(x('deadbeef'), 128)
+
+        ctx = HashSerializationContext()
+        self.assertIsInstance(ctx, BytesSerializationContext)
+        obj.ctx_serialize(ctx)
+        self.assertEqual(b2x(obj.buf.hash + obj.i.hash), b2x(ctx.getbytes()))
+        self.assertEqual(b2x(obj.hash),
+                         b2x(hmac.HMAC(boxed_objs.HASH_HMAC_KEY, ctx.getbytes(), hashlib.sha256).digest()))
+        with self.assertRaises(ValueError):
+            ctx.digest()
+
+        # Nothing is buffered with a key
+        ctx = HashSerializationContext(boxed_objs.HASH_HMAC_KEY)
+        obj.ctx_serialize(ctx)
+        self.assertEqual(b2x(obj.hash), b2x(ctx.digest()))
+        with self.assertRaises(ValueError):
+            ctx.getbytes()
+        with self.assertRaises(ValueError):
+            ctx.getbuffer()
+
+    def test_engines(self):
+        """Classes select their hash engine"""
+        key = boxed_bytes.HASH_HMAC_KEY
+        self.assertIs(HMAC_SHA256, boxed_bytes.HASH_ENGINE)
+
+        for engine, expected in ((HMAC_SHA256, hmac.HMAC(key, x('04deadbeef'), hashlib.sha256)),
+                                 (BLAKE2B, hashlib.blake2b(x('04deadbeef'), key=key, digest_size=32)),
+                                 (BLAKE2S, hashlib.blake2s(x('04deadbeef'), key=key, digest_size=32))):
+            class engine_boxed_bytes(boxed_bytes):
+                HASH_ENGINE = engine
+
+            self.assertEqual(b2x(expected.digest()), b2x(engine_boxed_bytes(x('deadbeef')).hash))
+
+            ctx = HashSerializationContext(key, engine)
+            ctx.write_bytes('buf', x('deadbeef'))
+            self.assertEqual(b2x(expected.digest()), b2x(ctx.digest()))
+
+            # Keyed state is computed once
+            self.assertIn(key, engine._states)
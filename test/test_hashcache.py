@@ -0,0 +1,93 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import threading
+import unittest
+import unittest.mock
+
+import proofmarshal
+from proofmarshal.bench import BenchNested, nested
+from proofmarshal.hashcache import HashCache
+from proofmarshal.test import x, b2x
+from proofmarshal.test.test_core import boxed_bytes, boxed_objs
+
+class Test_HashCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = HashCache()
+        self.prev_cache = proofmarshal.set_hash_cache(self.cache)
+
+    def tearDown(self):
+        proofmarshal.set_hash_cache(self.prev_cache)
+
+    def test_hits(self):
+        """Identical sub-objects are only hashed once"""
+        expected_hash = x('ceb083636508dba4d21bbee70d0a4f625c0c119df86d4bde1a9a3bbf5565cb41')
+
+        for i in range(3):
+            obj = boxed_objs.deserialize(x('04deadbeef8001'))
+            self.assertEqual(b2x(expected_hash), b2x(obj.hash))
+
+        # two sub-objects per boxed_objs
+        self.assertEqual(2, self.cache.misses)
+        self.assertEqual(4, self.cache.hits)
+        self.assertEqual(2, len(self.cache))
+
+        # Hits are cached on the instance too
+        self.assertEqual(obj.buf.hash, obj.buf._cached_hash)
+
+    def test_cold_nested(self):
+        """Each object in a nested chain is serialized once on a cold cache"""
+        prev = proofmarshal.set_hash_cache(None)
+        try:
+            expected_hash = nested(50).hash
+        finally:
+            proofmarshal.set_hash_cache(prev)
+
+        obj = nested(50)
+        calls = []
+        orig = BenchNested._ctx_serialize
+        def counting(self, ctx):
+            calls.append(self)
+            return orig(self, ctx)
+        with unittest.mock.patch.object(BenchNested, '_ctx_serialize', counting):
+            self.assertEqual(b2x(expected_hash), b2x(obj.hash))
+        self.assertEqual(50, len(calls))
+
+    def test_eviction(self):
+        """Least recently used entries are evicted to stay within budget"""
+        cache = HashCache(max_bytes=3 * (4 + 1 + 32))
+        for i in range(4):
+            cache.obj_hash(boxed_bytes(bytes([i])*4))
+        self.assertEqual(3, len(cache))
+        self.assertIsNone(cache.get(boxed_bytes, x('0400000000')))
+        self.assertIsNotNone(cache.get(boxed_bytes, x('0403030303')))
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(5, stats['misses'])
+
+    def test_threads(self):
+        expected_hash = x('ceb083636508dba4d21bbee70d0a4f625c0c119df86d4bde1a9a3bbf5565cb41')
+        results = []
+        def worker():
+            for i in range(100):
+                results.append(boxed_objs.deserialize(x('04deadbeef8001')).hash)
+
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(400, len(results))
+        self.assertTrue(all(r == expected_hash for r in results))
+        self.assertEqual(800, self.cache.hits + self.cache.misses)
@@ -0,0 +1,77 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import unittest
+
+import proofmarshal
+from proofmarshal.instrument import Instrumentation
+from proofmarshal.test import x, b2x
+from proofmarshal.test.test_core import boxed_objs
+from proofmarshal.test.test_merbinnertree import BytesBytesMerbinnerTree
+
+class Test_Instrumentation(unittest.TestCase):
+    def test_serialize(self):
+        obj = boxed_objs(x('deadbeef'), 128)
+        with Instrumentation() as inst:
+            ctx = inst.wrap(proofmarshal.BytesSerializationContext())
+            obj.ctx_serialize(ctx)
+            self.assertEqual(b2x(x('04deadbeef8001')), b2x(ctx.getbytes()))
+
+        stats = inst.as_dict()
+        self.assertEqual({'calls': 1, 'bytes': 5}, stats['attrs']['boxed_bytes.buf'])
+        self.assertEqual({'calls': 1, 'bytes': 2}, stats['attrs']['boxed_varuint.i'])
+        self.assertEqual(1, stats['classes']['boxed_objs']['serialize']['calls'])
+        self.assertEqual(1, stats['classes']['boxed_bytes']['serialize']['calls'])
+
+        self.assertEqual('<root>;boxed_objs;boxed_bytes;buf 5\n'
+                         '<root>;boxed_objs;boxed_varuint;i 2\n',
+                         inst.flamegraph())
+        self.assertTrue(inst.flamegraph('time').startswith('<root>;boxed_objs'))
+
+        # Everything is unhooked afterwards
+        self.assertNotIn('ctx_serialize', type(proofmarshal.ImmutableProof.ctx_serialize).__dict__)
+        self.assertEqual('ctx_serialize', proofmarshal.ImmutableProof.ctx_serialize.__name__)
+        self.assertEqual('new_hmac', proofmarshal.new_hmac.__qualname__)
+
+    def test_deserialize_and_hash(self):
+        with Instrumentation() as inst:
+            ctx = inst.wrap(proofmarshal.BufferDeserializationContext(x('04deadbeef8001')))
+            obj = boxed_objs.ctx_deserialize(ctx)
+
+            ctx = inst.wrap(proofmarshal.HashSerializationContext(boxed_objs.HASH_HMAC_KEY))
+            obj.ctx_serialize(ctx)
+
+        stats = inst.as_dict()
+        self.assertEqual({'calls': 1, 'bytes': 5}, stats['attrs']['boxed_bytes.buf'])
+        self.assertEqual({'calls': 1, 'bytes': 2}, stats['attrs']['boxed_varuint.i'])
+        self.assertEqual({'calls': 1, 'bytes': 32}, stats['attrs']['boxed_objs.buf'])
+        self.assertEqual(1, stats['classes']['boxed_objs']['deserialize']['calls'])
+        self.assertEqual(1, stats['classes']['boxed_bytes']['hash']['calls'])
+        self.assertEqual({'<root>': 1, 'boxed_objs': 2}, stats['hmacs'])
+
+    def test_merbinnertree(self):
+        items = {x('ffffffff'):x('deadbeef'),
+                 x('bfffffff'):x('cafebabe'),
+                 x('40000000'):x('feedface'),
+                 x('00000000'):x('baadf00d'),
+                 x('80000000'):x('baadf00d')}
+        mbtree = BytesBytesMerbinnerTree(items)
+
+        with Instrumentation() as inst:
+            ctx = inst.wrap(proofmarshal.BytesSerializationContext())
+            mbtree.ctx_serialize(ctx)
+            mbtree.hash
+
+        stats = inst.as_dict()
+        self.assertEqual({1:5, 2:4}, stats['merbinnertree']['node_types'])
+        self.assertEqual({0:1, 1:2, 2:4, 3:2}, stats['merbinnertree']['node_depths'])
+        self.assertEqual({1:5, 2:4}, stats['merbinnertree']['hashed_node_types'])
+        self.assertEqual({'BytesBytesMerbinnerTree': 9}, stats['hmacs'])
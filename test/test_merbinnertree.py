@@ -10,15 +10,23 @@
 # LICENSE file.
 
 import binascii
+import copy
 import hashlib
+import hmac
+import io
 import json
 import os
+import pickle
+import random
 import struct
 import unittest
+import unittest.mock
 import uuid
 
+import proofmarshal
 from proofmarshal.test import *
 
+from proofmarshal import merbinnertree
 from proofmarshal.merbinnertree import *
 
 class BytesBytesMerbinnerTree(MerbinnerTree):
@@ -26,6 +34,7 @@ class BytesBytesMerbinnerTree(MerbinnerTree):
 
     KEY_LENGTH = 4
     VALUE_LENGTH = 4
+    KEYHASH_LENGTH = 4
 
     key_serialize = lambda self, ctx, key: ctx.write_bytes('key', key, self.KEY_LENGTH)
     key_deserialize = lambda self, ctx: ctx.read_bytes('key', self.KEY_LENGTH)
@@ -36,6 +45,23 @@ class BytesBytesMerbinnerTree(MerbinnerTree):
     key_gethash = lambda self, key: key
 
 
+class tree_pair(proofmarshal.ImmutableProof):
+    """Object with two, possibly identical, trees"""
+    HASH_HMAC_KEY = x('0f4c1e2ab3d95e6c7a8b9c0d1e2f3a4b')
+
+    def __init__(self, a, b):
+        object.__setattr__(self, 'a', a)
+        object.__setattr__(self, 'b', b)
+
+    def _ctx_serialize(self, ctx):
+        ctx.write_obj('a', self.a)
+        ctx.write_obj('b', self.b)
+
+    def _ctx_deserialize(self, ctx):
+        object.__setattr__(self, 'a', ctx.read_obj('a', BytesBytesMerbinnerTree))
+        object.__setattr__(self, 'b', ctx.read_obj('b', BytesBytesMerbinnerTree))
+
+
 class Test_MerbinnerTree(unittest.TestCase):
     def test_hash(self):
         """Manual test of the hash calculation"""
@@ -90,6 +116,300 @@ class Test_MerbinnerTree(unittest.TestCase):
 
             self.assertEqual(b2x(expected_digest), b2x(actual_digest))
 
+    def test_incremental_hash(self):
+        """Hash after modifications matches the hash of a freshly built tree"""
+        rand = random.Random(0)
+        mbtree = BytesBytesMerbinnerTree()
+        for i in range(200):
+            mbtree[rand.getrandbits(32).to_bytes(4, 'big')] = x('deadbeef')
+
+        old_root = mbtree._get_root()
+        mbtree.hash
+
+        for i in range(100):
+            key = rand.choice(list(mbtree.keys()))
+            if i % 3 == 0:
+                del mbtree[key]
+            elif i % 3 == 1:
+                mbtree[key] = rand.getrandbits(32).to_bytes(4, 'big')
+            else:
+                mbtree.update({rand.getrandbits(32).to_bytes(4, 'big'): x('cafebabe')})
+
+            expected_digest = BytesBytesMerbinnerTree(mbtree.items()).hash
+            self.assertEqual(b2x(expected_digest), b2x(mbtree.hash))
+
+        # Only the modified paths are replaced; untouched subtrees are shared
+        mbtree2 = BytesBytesMerbinnerTree(mbtree.items())
+        mbtree2.hash
+        root = mbtree2._get_root()
+        mbtree2[x('ffffffff')] = x('deadbeef')
+        self.assertIs(root.right, mbtree2._get_root().right)
+
+        self.assertEqual(mbtree2.pop(x('ffffffff')), x('deadbeef'))
+        self.assertEqual(b2x(BytesBytesMerbinnerTree(mbtree2.items()).hash), b2x(mbtree2.hash))
+
+        mbtree2.clear()
+        self.assertEqual(b2x(BytesBytesMerbinnerTree().hash), b2x(mbtree2.hash))
+
+    def test_build(self):
+        """Building from items matches building by insertion"""
+        rand = random.Random(0)
+        for n in (0, 1, 2, 3, 10, 1000):
+            items = [(rand.getrandbits(32).to_bytes(4, 'big'), x('deadbeef')) for i in range(n)]
+
+            # force long shared prefixes too
+            items += [(x('ffff0000'), x('00000000')), (x('ffff0001'), x('00000000'))]
+
+            mbtree = BytesBytesMerbinnerTree(items)
+            expected_digest = mbtree.hash
+
+            mbtree2 = BytesBytesMerbinnerTree()
+            mbtree2._get_root()
+            for key, value in items:
+                mbtree2[key] = value
+            self.assertEqual(b2x(expected_digest), b2x(mbtree2.hash))
+
+    def test_duplicate_key_hash(self):
+        """Keys with identical key hashes are rejected"""
+        class DupMerbinnerTree(BytesBytesMerbinnerTree):
+            key_gethash = lambda self, key: key[0:1]
+
+        mbtree = DupMerbinnerTree({x('00000000'):x('00000000'), x('00000001'):x('00000000')})
+        with self.assertRaises(ValueError):
+            mbtree.hash
+
+    def test_keyhash_length(self):
+        """Leaves whose key hash isn't KEYHASH_LENGTH long are rejected"""
+        class ShortMerbinnerTree(BytesBytesMerbinnerTree):
+            key_gethash = lambda self, key: key[0:3]
+
+        buf = ShortMerbinnerTree({x('ffffffff'):x('deadbeef')}).serialize()
+        with self.assertRaises(proofmarshal.DeserializationError):
+            ShortMerbinnerTree.deserialize(buf)
+
+    def test_parallel_hash(self):
+        """Parallel hashing matches serial hashing"""
+        rand = random.Random(0)
+        items = [(rand.getrandbits(32).to_bytes(4, 'big'), x('deadbeef')) for i in range(1000)]
+        expected_digest = BytesBytesMerbinnerTree(items).hash
+
+        for use_threads in (True, False):
+            for split_depth in (None, 1, 8, 20):
+                mbtree = BytesBytesMerbinnerTree(items)
+                actual_digest = mbtree.calc_hash(parallelism=2, split_depth=split_depth,
+                                                 use_threads=use_threads)
+                self.assertEqual(b2x(expected_digest), b2x(actual_digest))
+
+        mbtree = SummedBytesBytesMerbinnerTree((key, value + x('0001')) for key, value in items)
+        self.assertEqual(b2x(SummedBytesBytesMerbinnerTree(mbtree).hash),
+                         b2x(mbtree.calc_hash(parallelism=2)))
+
+    def test_prune(self):
+        """Pruned trees have the same hash as the full tree"""
+        rand = random.Random(0)
+        items = [(rand.getrandbits(32).to_bytes(4, 'big'), x('deadbeef')) for i in range(1000)]
+        mbtree = BytesBytesMerbinnerTree(items)
+        full_len = len(mbtree.serialize())
+
+        key = items[0][0]
+        proof = mbtree.prove(key)
+        self.assertEqual(b2x(mbtree.hash), b2x(proof.hash))
+        self.assertEqual({key:x('deadbeef')}, proof)
+        self.assertFalse(proof.is_pruned(key))
+        self.assertTrue(proof.is_pruned(items[1][0]))
+        self.assertLess(len(proof.serialize()), 60 * 33)
+
+        proof2 = BytesBytesMerbinnerTree.deserialize(proof.serialize())
+        self.assertEqual(b2x(mbtree.hash), b2x(proof2.hash))
+        self.assertEqual(proof, proof2)
+        self.assertEqual(b2x(proof.serialize()), b2x(proof2.serialize()))
+
+        # Multiple keys share common paths
+        keys = [key for key, value in items[0:10]]
+        multi_proof = mbtree.prune(keys)
+        self.assertEqual(b2x(mbtree.hash), b2x(multi_proof.hash))
+        self.assertEqual(set(keys), set(multi_proof.keys()))
+        self.assertLess(len(multi_proof.serialize()),
+                        sum(len(mbtree.prove(key).serialize()) for key in keys))
+
+        # Proof of non-inclusion
+        missing_key = x('00000000')
+        self.assertNotIn(missing_key, mbtree)
+        proof = mbtree.prove(missing_key)
+        self.assertFalse(proof.is_pruned(missing_key))
+        self.assertNotIn(missing_key, proof)
+        self.assertEqual(b2x(mbtree.hash), b2x(proof.hash))
+
+        # Can't modify what we can't see
+        with self.assertRaises(ValueError):
+            proof[items[1][0]] = x('cafebabe')
+
+        # Everything pruned
+        proof = mbtree.prune([])
+        self.assertEqual(b2x(mbtree.hash), b2x(proof.hash))
+        self.assertEqual('03' + b2x(mbtree.hash), b2x(proof.serialize()))
+
+    def test_prune_remove(self):
+        """Removing keys from pruned trees gives the same hash as the full tree"""
+        items = {x('ffffffff'): x('deadbeef'),
+                 x('fffffffe'): x('cafebabe'),
+                 x('bfffffff'): x('baadf00d'),
+                 x('00000000'): x('00000001')}
+
+        for keep, remove in (([x('ffffffff'), x('fffffffe')], x('ffffffff')),
+                             ([x('ffffffff'), x('bfffffff')], x('bfffffff')),
+                             (list(items), x('00000000'))):
+            full = BytesBytesMerbinnerTree(items)
+            proof = full.prune(keep)
+            persistent = proof.snapshot()
+            del full[remove]
+
+            del proof[remove]
+            self.assertEqual(b2x(full.hash), b2x(proof.hash))
+            self.assertEqual(b2x(full.hash), b2x(persistent.delete(remove).hash))
+
+        # Whether the inner node above the removed key collapses depends on
+        # what its pruned sibling hides.
+        for key in (x('ffffffff'), x('bfffffff')):
+            proof = BytesBytesMerbinnerTree(items).prove(key)
+            with self.assertRaises(ValueError):
+                del proof[key]
+            self.assertIn(key, proof)
+            with self.assertRaises(ValueError):
+                proof.snapshot().delete(key)
+
+    def test_serialized_size(self):
+        rand = random.Random(0)
+        items = [(rand.getrandbits(32).to_bytes(4, 'big'), x('deadbeef')) for i in range(1000)]
+        mbtree = BytesBytesMerbinnerTree(items)
+        self.assertEqual(len(mbtree.serialize()), mbtree.serialized_size())
+
+        # Sizes are cached per node, and updated along the modified path
+        mbtree[items[0][0]] = x('cafebabe')
+        del mbtree[items[1][0]]
+        self.assertEqual(len(mbtree.serialize()), mbtree.serialized_size())
+
+        proof = mbtree.prove(items[2][0])
+        self.assertEqual(len(proof.serialize()), proof.serialized_size())
+
+        self.assertEqual(1, BytesBytesMerbinnerTree().serialized_size())
+
+    def test_json(self):
+        rand = random.Random(0)
+        items = [(rand.getrandbits(32).to_bytes(4, 'big'), x('deadbeef')) for i in range(100)]
+        mbtree = BytesBytesMerbinnerTree(items)
+
+        for tree in (mbtree, mbtree.prove(items[0][0]), BytesBytesMerbinnerTree()):
+            tree_json = tree.json_serialize()
+            self.assertEqual(len(list(iter_nodes(tree._get_root()))), len(tree_json['nodes']))
+
+            tree2 = BytesBytesMerbinnerTree.json_deserialize(tree_json)
+            self.assertEqual(b2x(tree.serialize()), b2x(tree2.serialize()))
+
+            fd = io.StringIO()
+            tree.json_stream_serialize(fd)
+            self.assertEqual(tree_json, json.loads(fd.getvalue()))
+
+            fd.seek(0)
+            tree2 = BytesBytesMerbinnerTree.json_stream_deserialize(fd)
+            self.assertEqual(b2x(tree.serialize()), b2x(tree2.serialize()))
+
+        self.assertEqual({'nodes': [{'type': 2},
+                                    {'type': 1, 'key': 'ffffffff', 'value': 'deadbeef'},
+                                    {'type': 1, 'key': '00000000', 'value': 'cafebabe'}]},
+                         BytesBytesMerbinnerTree({x('ffffffff'): x('deadbeef'),
+                                                  x('00000000'): x('cafebabe')}).json_serialize())
+
+        # Node lists that don't make up a tree
+        leaf = {'type': 1, 'key': 'ffffffff', 'value': 'deadbeef'}
+        for nodes in ([], [{'type': 2}, leaf], [leaf, leaf]):
+            with self.assertRaises(proofmarshal.DeserializationError):
+                BytesBytesMerbinnerTree.json_deserialize({'nodes': nodes})
+            with self.assertRaises(proofmarshal.DeserializationError):
+                BytesBytesMerbinnerTree.json_stream_deserialize(io.StringIO(json.dumps({'nodes': nodes})))
+
+    def test_verify_batch(self):
+        rand = random.Random(0)
+        items = [(rand.getrandbits(32).to_bytes(4, 'big'), x('deadbeef')) for i in range(1000)]
+        mbtree = BytesBytesMerbinnerTree(items)
+        root_hash = mbtree.hash
+
+        proofs = [mbtree.prove(key).serialize() for key, value in items[0:50]]
+
+        # tampered
+        proofs.append(mbtree.prove(items[0][0]).serialize().replace(x('deadbeef'), x('cafebabe')))
+        # truncated
+        proofs.append(proofs[0][:-1])
+        # already deserialized
+        proofs.append(mbtree.prove(items[60][0]))
+        # chain of inner nodes far deeper than key hashes are long
+        proofs.append(x('02') * 100000 + (x('03') + root_hash) * 100001)
+
+        with unittest.mock.patch('proofmarshal.new_hmac', wraps=proofmarshal.new_hmac) as new_hmac:
+            results = BytesBytesMerbinnerTree.verify_batch(root_hash, proofs)
+            batch_hmac_count = new_hmac.call_count
+
+        self.assertEqual([True]*50 + [False, False, True, False], results)
+
+        with unittest.mock.patch('proofmarshal.new_hmac', wraps=proofmarshal.new_hmac) as new_hmac:
+            for proof in proofs[0:50]:
+                self.assertEqual(root_hash, BytesBytesMerbinnerTree.deserialize(proof).hash)
+            individual_hmac_count = new_hmac.call_count
+
+        # Interior nodes near the root are shared by every proof
+        self.assertLess(batch_hmac_count, individual_hmac_count * 0.6)
+
+    def test_pickle(self):
+        """Hashed trees, pruned or not, can be pickled and copied"""
+        m = BytesBytesMerbinnerTree({x('ffffffff'):x('deadbeef'), x('00000000'):x('cafebabe'),
+                                     x('80000000'):x('01020304')})
+        for tree in (m, m.prove(x('ffffffff')), BytesBytesMerbinnerTree()):
+            expected_hash = tree.hash
+            for tree2 in (pickle.loads(pickle.dumps(tree)), copy.deepcopy(tree)):
+                self.assertEqual(dict(tree), dict(tree2))
+                self.assertEqual(b2x(expected_hash), b2x(tree2.hash))
+                self.assertEqual(b2x(tree.serialize()), b2x(tree2.serialize()))
+
+        snapshot = pickle.loads(pickle.dumps(m.snapshot()))
+        self.assertEqual(dict(m), dict(snapshot))
+        self.assertEqual(b2x(m.hash), b2x(snapshot.hash))
+
+    def test_memoized(self):
+        """Trees are never back-references, even to a tree with the same hash"""
+        full = BytesBytesMerbinnerTree({x('ffffffff'):x('deadbeef'), x('00000000'):x('cafebabe')})
+        pruned = full.prove(x('ffffffff'))
+        self.assertEqual(full.hash, pruned.hash)
+
+        for pair in (tree_pair(pruned, full), tree_pair(full, full)):
+            pair2 = tree_pair.memoized_deserialize(pair.memoized_serialize())
+            self.assertIsNot(pair2.a, pair2.b)
+            self.assertEqual(dict(pair.a), dict(pair2.a))
+            self.assertEqual(dict(pair.b), dict(pair2.b))
+            self.assertEqual(b2x(pair.hash), b2x(pair2.hash))
+
+    def test_buffer_deserialize(self):
+        """Zero-copy deserialization from a writable buffer gives usable keys"""
+        m = BytesBytesMerbinnerTree({x('ffffffff'):x('deadbeef'), x('00000000'):x('cafebabe')})
+        buf = bytearray(m.serialize())
+
+        m2 = BytesBytesMerbinnerTree.buffer_deserialize(buf)
+        self.assertEqual(m.hash, m2.hash)
+        self.assertEqual(x('deadbeef'), m2[x('ffffffff')])
+        self.assertIn(x('00000000'), m2)
+
+    def test_deserialize_invalid(self):
+        """Structurally invalid trees are rejected"""
+        for hex_serialized in ('04',
+                               # leaf on wrong side
+                               '02 0100000000deadbeef 00',
+                               '02 02 01ffffffffdeadbeef 0100000000cafebabe 00',
+                               # inner node with fewer than two items
+                               '02 00 00',
+                               '02 01ffffffffdeadbeef 00',
+                               '02 00 0100000000cafebabe'):
+            with self.assertRaises(proofmarshal.DeserializationError):
+                BytesBytesMerbinnerTree.deserialize(x(hex_serialized))
+
 
 sum_struct = struct.Struct('>H')
 class SummedBytesBytesMerbinnerTree(BytesBytesMerbinnerTree):
@@ -98,9 +418,273 @@ class SummedBytesBytesMerbinnerTree(BytesBytesMerbinnerTree):
     VALUE_LENGTH = 6
 
     sum_serialize = lambda self, ctx, sum: ctx.write_bytes('sum', sum_struct.pack(sum), sum_struct.size)
+    sum_deserialize = lambda self, ctx: sum_struct.unpack(ctx.read_bytes('sum', sum_struct.size))[0]
 
     value_getsum = lambda self, value: sum_struct.unpack(value[-2:])[0]
 
+class Test_DeserializationLimits(unittest.TestCase):
+    def test_deep_tree(self):
+        """Trees deeper than key hashes are long are rejected"""
+        pruned = x('03') + b'\x00' * 32
+        def chain(depth):
+            return x('02') * depth + pruned * (depth + 1)
+
+        # As deep as possible, and still usable
+        max_depth = BytesBytesMerbinnerTree.KEYHASH_LENGTH * 8
+        self.assertEqual(32, max_depth)
+        mbtree = BytesBytesMerbinnerTree.deserialize(chain(max_depth))
+        self.assertEqual(0, len(mbtree))
+        self.assertEqual(len(chain(max_depth)), mbtree.serialized_size())
+        self.assertEqual(b2x(chain(max_depth)), b2x(mbtree.serialize()))
+        mbtree.hash
+        for key in (x('ffffffff'), x('fffffffe'), x('00000000')):
+            self.assertTrue(mbtree.is_pruned(key))
+            self.assertEqual(b2x(mbtree.hash), b2x(mbtree.prune([key]).hash))
+            with self.assertRaises(KeyError):
+                mbtree.snapshot()[key]
+
+        for depth in (max_depth + 1, 100000):
+            with self.assertRaises(proofmarshal.DeserializationError):
+                BytesBytesMerbinnerTree.deserialize(chain(depth))
+
+        for limits in (proofmarshal.DeserializationLimits(max_depth=max_depth - 1),
+                       proofmarshal.DeserializationLimits(max_nodes=2 * max_depth)):
+            with self.assertRaises(proofmarshal.LimitExceededError):
+                BytesBytesMerbinnerTree.deserialize(chain(max_depth), limits)
+
+    def test_limits(self):
+        rand = random.Random(0)
+        mbtree = BytesBytesMerbinnerTree((rand.getrandbits(32).to_bytes(4, 'big'), x('deadbeef'))
+                                         for i in range(100))
+        nodes = len(list(iter_nodes(mbtree._get_root())))
+        max_depth = max(_iter_depths(mbtree._get_root()))
+
+        limits = proofmarshal.DeserializationLimits(max_depth=max_depth, max_nodes=nodes)
+        self.assertEqual(mbtree, BytesBytesMerbinnerTree.deserialize(mbtree.serialize(), limits))
+        self.assertEqual(mbtree, BytesBytesMerbinnerTree.json_deserialize(mbtree.json_serialize(), limits))
+        self.assertEqual(mbtree, BytesBytesMerbinnerTree.indexed_deserialize(mbtree.indexed_serialize(), limits))
+
+        for limits in (proofmarshal.DeserializationLimits(max_depth=max_depth - 1),
+                       proofmarshal.DeserializationLimits(max_nodes=nodes - 1)):
+            with self.assertRaises(proofmarshal.LimitExceededError):
+                BytesBytesMerbinnerTree.deserialize(mbtree.serialize(), limits)
+            with self.assertRaises(proofmarshal.LimitExceededError):
+                BytesBytesMerbinnerTree.json_deserialize(mbtree.json_serialize(), limits)
+
+def _iter_depths(node, depth=0):
+    yield depth
+    if isinstance(node, InnerNode):
+        yield from _iter_depths(node.left, depth+1)
+        yield from _iter_depths(node.right, depth+1)
+
+class Test_PersistentMerbinnerTree(unittest.TestCase):
+    def test_versions(self):
+        rand = random.Random(0)
+        items = {rand.getrandbits(32).to_bytes(4, 'big'): x('deadbeef') for i in range(1000)}
+        keys = list(items)
+
+        v0 = PersistentMerbinnerTree(BytesBytesMerbinnerTree, items)
+        self.assertEqual(len(items), len(v0))
+        self.assertEqual(items, dict(v0))
+        self.assertEqual(b2x(BytesBytesMerbinnerTree(items).hash), b2x(v0.hash))
+        self.assertEqual(b2x(BytesBytesMerbinnerTree(items).serialize()), b2x(v0.serialize()))
+
+        v1 = v0.set(keys[0], x('cafebabe'))
+        v2 = v1.delete(keys[1])
+        v3 = v2.set(x('00000000'), x('baadf00d'))
+
+        # Earlier versions are unchanged
+        self.assertEqual(items, dict(v0))
+        self.assertEqual(x('deadbeef'), v0[keys[0]])
+        self.assertEqual(x('cafebabe'), v1[keys[0]])
+        self.assertIn(keys[1], v1)
+        self.assertNotIn(keys[1], v2)
+        self.assertEqual((1000, 1000, 999, 1000), (len(v0), len(v1), len(v2), len(v3)))
+
+        mbtree = BytesBytesMerbinnerTree(items)
+        for version, (key, value) in ((v1, (keys[0], x('cafebabe'))),
+                                      (v3, (x('00000000'), x('baadf00d')))):
+            if version is v3:
+                del mbtree[keys[1]]
+            mbtree[key] = value
+            self.assertEqual(b2x(mbtree.hash), b2x(version.hash))
+            self.assertEqual(b2x(mbtree.serialize()), b2x(version.serialize()))
+
+        with self.assertRaises(KeyError):
+            v2.delete(keys[1])
+        with self.assertRaises(AttributeError):
+            v0.foo = 1
+
+    def test_structural_sharing(self):
+        """Versions share every node not on a modified path"""
+        rand = random.Random(0)
+        items = {rand.getrandbits(32).to_bytes(4, 'big'): x('deadbeef') for i in range(1000)}
+        keys = list(items)
+
+        versions = [PersistentMerbinnerTree(BytesBytesMerbinnerTree, items)]
+        for key in keys[:100]:
+            versions.append(versions[-1].set(key, x('cafebabe')))
+
+        base_nodes = {id(node) for node in iter_nodes(versions[0]._root)}
+        all_nodes = {id(node) for version in versions for node in iter_nodes(version._root)}
+        self.assertLess(len(all_nodes) - len(base_nodes), 100 * 32)
+
+        # Hashes are only calculated for new nodes
+        versions[0].hash
+        with unittest.mock.patch.object(BytesBytesMerbinnerTree, '_node_ctx_serialize',
+                                        wraps=versions[0]._tree._node_ctx_serialize) as mock:
+            versions[1].hash
+            self.assertLess(mock.call_count, 32)
+
+    def test_snapshot(self):
+        items = {x('ffffffff'): x('deadbeef'), x('00000000'): x('cafebabe')}
+        mbtree = BytesBytesMerbinnerTree(items)
+        snapshot = mbtree.snapshot()
+        self.assertIs(mbtree._get_root(), snapshot._root)
+
+        mbtree[x('7fffffff')] = x('baadf00d')
+        self.assertEqual(items, dict(snapshot))
+
+        thawed = snapshot.thaw()
+        self.assertEqual(items, thawed)
+        thawed[x('7fffffff')] = x('baadf00d')
+        self.assertEqual(b2x(mbtree.hash), b2x(thawed.hash))
+        self.assertEqual(items, dict(snapshot))
+
+        proof = mbtree.prove(x('00000000')).snapshot()
+        self.assertTrue(proof.is_pruned(x('ffffffff')))
+        self.assertEqual(b2x(mbtree.hash), b2x(proof.hash))
+
+class Test_diff(unittest.TestCase):
+    def test_diff(self):
+        rand = random.Random(0)
+        items = {rand.getrandbits(32).to_bytes(4, 'big'): x('deadbeef') for i in range(1000)}
+        keys = list(items)
+
+        a = BytesBytesMerbinnerTree(items)
+        b = BytesBytesMerbinnerTree(items)
+        self.assertEqual(TreeDiff({}, {}, {}), a.diff(b))
+
+        b[keys[0]] = x('cafebabe')
+        del b[keys[1]]
+        b[x('00000000')] = x('baadf00d')
+        b[x('00000001')] = x('baadf00d')
+        self.assertEqual(TreeDiff({x('00000000'): x('baadf00d'), x('00000001'): x('baadf00d')},
+                                  {keys[1]: x('deadbeef')},
+                                  {keys[0]: (x('deadbeef'), x('cafebabe'))}),
+                         a.diff(b))
+        self.assertEqual(TreeDiff({keys[1]: x('deadbeef')},
+                                  {x('00000000'): x('baadf00d'), x('00000001'): x('baadf00d')},
+                                  {keys[0]: (x('cafebabe'), x('deadbeef'))}),
+                         b.snapshot().diff(a))
+
+        # To and from empty trees
+        self.assertEqual(TreeDiff(items, {}, {}), BytesBytesMerbinnerTree().diff(a))
+        self.assertEqual(TreeDiff({}, items, {}), a.diff(BytesBytesMerbinnerTree()))
+
+    def test_diff_skips_equal_subtrees(self):
+        rand = random.Random(0)
+        items = {rand.getrandbits(32).to_bytes(4, 'big'): x('deadbeef') for i in range(1000)}
+        v0 = PersistentMerbinnerTree(BytesBytesMerbinnerTree, items)
+        v1 = v0.set(next(iter(items)), x('cafebabe'))
+        v0.hash
+        v1.hash
+
+        with unittest.mock.patch.object(merbinnertree, '_diff_nodes', wraps=merbinnertree._diff_nodes) as mock:
+            diff = v0.diff(v1)
+        self.assertEqual(1, len(diff.changed))
+        self.assertLess(mock.call_count, 2 * 32)
+
+    def test_diff_pruned(self):
+        items = {x('ffffffff'): x('deadbeef'), x('00000000'): x('cafebabe')}
+        a = BytesBytesMerbinnerTree(items)
+        b = BytesBytesMerbinnerTree(items)
+        b[x('00000000')] = x('baadf00d')
+
+        proof = a.prove(x('00000000'))
+        self.assertEqual(1, len(proof.diff(b).changed))
+
+        proof = a.prove(x('ffffffff'))
+        with self.assertRaises(ValueError):
+            proof.diff(b)
+
+class Test_IndexedMerbinnerTree(unittest.TestCase):
+    def test_roundtrip(self):
+        rand = random.Random(0)
+        for n in (0, 1, 2, 1000):
+            items = {rand.getrandbits(32).to_bytes(4, 'big'): rand.getrandbits(32).to_bytes(4, 'big')
+                     for i in range(n)}
+            mbtree = BytesBytesMerbinnerTree(items)
+            buf = mbtree.indexed_serialize()
+
+            actual = BytesBytesMerbinnerTree.indexed_deserialize(buf)
+            self.assertEqual(mbtree, actual)
+            self.assertEqual(b2x(mbtree.hash), b2x(actual.hash))
+            self.assertEqual(b2x(mbtree.serialize()), b2x(actual.serialize()))
+
+            indexed = IndexedMerbinnerTree(BytesBytesMerbinnerTree, buf)
+            self.assertEqual(items, dict(indexed))
+            self.assertEqual(n, len(indexed))
+            self.assertEqual(mbtree, indexed.to_tree())
+
+    def test_get(self):
+        rand = random.Random(0)
+        items = {rand.getrandbits(32).to_bytes(4, 'big'): x('deadbeef') for i in range(1000)}
+        indexed = IndexedMerbinnerTree(BytesBytesMerbinnerTree,
+                                       BytesBytesMerbinnerTree(items).indexed_serialize())
+
+        for key in items:
+            self.assertEqual(x('deadbeef'), indexed[key])
+        self.assertNotIn(x('00000000'), indexed)
+        self.assertIsNone(indexed.get(x('ffffffff')))
+
+        # Only the leaf looked up is deserialized
+        with unittest.mock.patch.object(BytesBytesMerbinnerTree, 'key_deserialize',
+                                        wraps=indexed.tree.key_deserialize) as mock:
+            indexed[next(iter(items))]
+        self.assertEqual(1, mock.call_count)
+
+    def test_pruned(self):
+        mbtree = BytesBytesMerbinnerTree({x('ffffffff'): x('deadbeef'), x('00000000'): x('cafebabe')})
+        proof = mbtree.prove(x('00000000'))
+        indexed = IndexedMerbinnerTree(BytesBytesMerbinnerTree, proof.indexed_serialize())
+
+        self.assertEqual(x('cafebabe'), indexed[x('00000000')])
+        self.assertTrue(indexed.is_pruned(x('ffffffff')))
+        self.assertFalse(indexed.is_pruned(x('00000000')))
+        self.assertNotIn(x('ffffffff'), indexed)
+        self.assertEqual(b2x(mbtree.hash), b2x(indexed.to_tree().hash))
+
+    def test_invalid(self):
+        mbtree = BytesBytesMerbinnerTree({x('ffffffff'): x('deadbeef'), x('00000000'): x('cafebabe')})
+        buf = mbtree.indexed_serialize()
+        self.assertEqual('020901ffffffffdeadbeef0100000000cafebabe', b2x(buf))
+
+        for invalid in (x('020801ffffffffdeadbeef0100000000cafebabe'),
+                        x('020901ffffffffdeadbeef0100000000cafebabe00'),
+                        x('020901ffffffffdeadbeef0100000000cafeba')):
+            with self.assertRaises(proofmarshal.DeserializationError):
+                BytesBytesMerbinnerTree.indexed_deserialize(invalid)
+
+class Test_HashEngine(unittest.TestCase):
+    def test_blake2(self):
+        class Blake2bBytesBytesMerbinnerTree(BytesBytesMerbinnerTree):
+            HASH_ENGINE = proofmarshal.BLAKE2B
+
+        def h(buf):
+            return hashlib.blake2b(buf, key=BytesBytesMerbinnerTree.HASH_HMAC_KEY, digest_size=32).digest()
+
+        items = {x('ffffffff'): x('deadbeef'), x('00000000'): x('cafebabe')}
+        mbtree = Blake2bBytesBytesMerbinnerTree(items)
+        self.assertEqual(b2x(h(x('02') + h(x('01ffffffffdeadbeef')) + h(x('0100000000cafebabe')))),
+                         b2x(mbtree.hash))
+        self.assertNotEqual(b2x(BytesBytesMerbinnerTree(items).hash), b2x(mbtree.hash))
+
+        # Proofs verify with the same engine
+        proof = mbtree.prove(x('00000000'))
+        self.assertEqual(b2x(mbtree.hash), b2x(Blake2bBytesBytesMerbinnerTree.deserialize(proof.serialize()).hash))
+        self.assertEqual([True], Blake2bBytesBytesMerbinnerTree.verify_batch(mbtree.hash, [proof]))
+
 class Test_SummedMerbinnerTree(unittest.TestCase):
     def test_hash(self):
         """Manual test of the hash calculation"""
@@ -158,3 +742,66 @@ class Test_SummedMerbinnerTree(unittest.TestCase):
                 assert False and "invalid test: unknown mode"
 
             self.assertEqual(b2x(expected_digest), b2x(actual_digest))
+
+    def test_sums(self):
+        rand = random.Random(0)
+        # Sums are 16 bits, so values are kept small
+        items = {rand.getrandbits(32).to_bytes(4, 'big'): x('deadbeef') + rand.getrandbits(6).to_bytes(2, 'big')
+                 for i in range(1000)}
+        mbtree = SummedBytesBytesMerbinnerTree(items)
+        v0 = mbtree.snapshot()
+
+        def expected_prefix_sum(bit_prefix):
+            return sum(sum_struct.unpack(value[-2:])[0] for key, value in mbtree.items()
+                       if format(int.from_bytes(key, 'big'), '032b').startswith(bit_prefix))
+
+        def check():
+            self.assertEqual(expected_prefix_sum(''), mbtree.total_sum())
+            for bit_prefix in ('', '0', '1', '01', '110', '0110101', '10' * 16):
+                self.assertEqual(expected_prefix_sum(bit_prefix), mbtree.prefix_sum(bit_prefix))
+        check()
+
+        # Sums are kept up to date incrementally, without hashing
+        with unittest.mock.patch.object(proofmarshal, 'HashSerializationContext') as mock:
+            for key in list(items)[:10]:
+                mbtree[key] = x('deadbeef0007')
+            del mbtree[list(items)[10]]
+            check()
+        self.assertEqual(0, mock.call_count)
+
+        # ...and match the sums that are hashed
+        self.assertEqual(mbtree.total_sum(), mbtree._node_hash(mbtree._get_root())[1])
+        self.assertEqual(b2x(SummedBytesBytesMerbinnerTree(mbtree).hash), b2x(mbtree.hash))
+
+        self.assertNotEqual(v0.total_sum(), mbtree.total_sum())
+        self.assertEqual(v0.total_sum(), v0.sum)
+        self.assertEqual(mbtree.prefix_sum('101'), mbtree.snapshot().prefix_sum('101'))
+
+        with self.assertRaises(ValueError):
+            mbtree.prefix_sum('012')
+
+    def test_prefix_sum_pruned(self):
+        items = {x('ffffffff'):x('deadbeef0001'),
+                 x('bfffffff'):x('cafebabe0003'),
+                 x('00000000'):x('baadf00d0005')}
+        proof = SummedBytesBytesMerbinnerTree(items).prove(x('00000000'))
+        self.assertEqual(9, proof.total_sum())
+        self.assertEqual(4, proof.prefix_sum('1'))
+        self.assertEqual(5, proof.prefix_sum('0000'))
+        self.assertEqual(0, proof.prefix_sum('0001'))
+        with self.assertRaises(ValueError):
+            proof.prefix_sum('10')
+
+    def test_prune(self):
+        """Pruned nodes carry sums"""
+        items = {x('ffffffff'):x('deadbeef0001'),
+                 x('bfffffff'):x('cafebabe0003'),
+                 x('00000000'):x('baadf00d0005')}
+        mbtree = SummedBytesBytesMerbinnerTree(items)
+        proof = mbtree.prove(x('00000000'))
+        self.assertEqual(b2x(x('02 03') + mbtree._node_hash(mbtree._get_root().left)[0] + x('0004 0100000000baadf00d0005')),
+                         b2x(proof.serialize()))
+        self.assertEqual(len(proof.serialize()), proof.serialized_size())
+
+        proof2 = SummedBytesBytesMerbinnerTree.deserialize(proof.serialize())
+        self.assertEqual(b2x(mbtree.hash), b2x(proof2.hash))
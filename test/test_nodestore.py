@@ -0,0 +1,141 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import os
+import random
+import tempfile
+import unittest
+
+import proofmarshal
+from proofmarshal.merbinnertree import iter_nodes
+from proofmarshal.nodestore import *
+from proofmarshal.test import x, b2x
+from proofmarshal.test.test_merbinnertree import BytesBytesMerbinnerTree, SummedBytesBytesMerbinnerTree
+
+def random_items(n, seed=0):
+    rand = random.Random(seed)
+    return {rand.getrandbits(32).to_bytes(4, 'big'): rand.getrandbits(32).to_bytes(4, 'big')
+            for i in range(n)}
+
+class Test_NodeStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'nodes.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_roundtrip(self):
+        items = random_items(1000)
+        mbtree = BytesBytesMerbinnerTree(items)
+
+        store = NodeStore(self.path, BytesBytesMerbinnerTree)
+        stored = StoredMerbinnerTree.from_tree(store, mbtree)
+        self.assertEqual(b2x(mbtree.hash), b2x(stored.commit('head')))
+        store.close()
+
+        # Nodes are loaded lazily
+        store = NodeStore(self.path, BytesBytesMerbinnerTree, cache_size=10)
+        stored = StoredMerbinnerTree(store, 'head')
+        self.assertEqual(1000, len(stored))
+        self.assertEqual(b2x(mbtree.hash), b2x(stored.hash))
+
+        key = next(iter(items))
+        self.assertEqual(items[key], stored[key])
+        self.assertLessEqual(len(store.cache), 10)
+
+        self.assertEqual(items, dict(stored))
+        self.assertLessEqual(len(store.cache), 10)
+
+        with self.assertRaises(KeyError):
+            stored[x('00000000')]
+
+    def test_pruned(self):
+        """Pruned trees are rejected"""
+        items = random_items(100)
+        mbtree = BytesBytesMerbinnerTree(items)
+        store = NodeStore(self.path, BytesBytesMerbinnerTree)
+        with self.assertRaises(ValueError):
+            StoredMerbinnerTree.from_tree(store, mbtree.prove(next(iter(items))))
+        store.close()
+
+    def test_versions(self):
+        """Only new nodes are written, and shared subtrees are stored once"""
+        items = random_items(1000)
+        keys = list(items)
+        mbtree = BytesBytesMerbinnerTree(items)
+
+        store = NodeStore(self.path, BytesBytesMerbinnerTree, cache_size=100)
+        stored = StoredMerbinnerTree.from_tree(store, mbtree)
+        stored.commit('v1')
+        n = len(store)
+        # Every empty node is the same
+        self.assertEqual(len({mbtree._node_hash(node) for node in iter_nodes(mbtree._get_root())}), n)
+
+        stored[keys[0]] = x('cafebabe')
+        del stored[keys[1]]
+        stored[x('00000000')] = x('baadf00d')
+        mbtree[keys[0]] = x('cafebabe')
+        del mbtree[keys[1]]
+        mbtree[x('00000000')] = x('baadf00d')
+
+        self.assertEqual(b2x(mbtree.hash), b2x(stored.commit('v2')))
+        self.assertEqual(1000, len(stored))
+        self.assertLess(len(store) - n, 3 * 2 * 32)
+
+        # Both versions are available
+        v1 = StoredMerbinnerTree(store, 'v1')
+        v2 = StoredMerbinnerTree(store, 'v2')
+        self.assertEqual(items, dict(v1))
+        self.assertEqual(mbtree, dict(v2))
+        self.assertEqual(x('cafebabe'), v2[keys[0]])
+        self.assertNotIn(keys[1], v2)
+
+        # Same contents, same nodes
+        n = len(store)
+        v1[keys[0]] = x('cafebabe')
+        v1[keys[0]] = items[keys[0]]
+        self.assertEqual(b2x(BytesBytesMerbinnerTree(items).hash), b2x(v1.commit('v1')))
+        self.assertEqual(n, len(store))
+
+    def test_empty(self):
+        store = NodeStore(self.path, BytesBytesMerbinnerTree)
+        stored = StoredMerbinnerTree(store, 'head')
+        self.assertEqual(0, len(stored))
+        self.assertEqual(b2x(BytesBytesMerbinnerTree().hash), b2x(stored.commit('head')))
+
+        stored[x('ffffffff')] = x('deadbeef')
+        del stored[x('ffffffff')]
+        stored.commit('head')
+        self.assertEqual({}, dict(StoredMerbinnerTree(store, 'head')))
+
+    def test_summed(self):
+        items = {x('ffffffff'): x('deadbeef0001'), x('bfffffff'): x('cafebabe0003'),
+                 x('00000000'): x('baadf00d0005')}
+        mbtree = SummedBytesBytesMerbinnerTree(items)
+
+        store = NodeStore(self.path, SummedBytesBytesMerbinnerTree)
+        StoredMerbinnerTree.from_tree(store, mbtree).commit('head')
+
+        store = NodeStore(self.path, SummedBytesBytesMerbinnerTree)
+        stored = StoredMerbinnerTree(store, 'head')
+        self.assertEqual(9, stored.sum)
+        stored[x('00000000')] = x('baadf00d0007')
+        mbtree[x('00000000')] = x('baadf00d0007')
+        self.assertEqual(b2x(mbtree.hash), b2x(stored.commit()))
+
+    def test_corrupt(self):
+        store = NodeStore(self.path, BytesBytesMerbinnerTree, cache_size=0)
+        StoredMerbinnerTree.from_tree(store, BytesBytesMerbinnerTree(random_items(10))).commit('head')
+        store.db.execute("UPDATE nodes SET data = X'01ffffffff00000000' WHERE substr(data, 1, 1) = X'01'")
+
+        with self.assertRaises(proofmarshal.DeserializationError):
+            dict(StoredMerbinnerTree(store, 'head'))
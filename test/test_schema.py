@@ -0,0 +1,159 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import unittest
+
+from proofmarshal import *
+from proofmarshal.schema import *
+from proofmarshal.test import load_test_vectors, x, b2x
+from proofmarshal.test import test_core
+
+class schema_varuint(SchemaProof):
+    HASH_HMAC_KEY = test_core.boxed_varuint.HASH_HMAC_KEY
+    FIELDS = (('i', VarUInt()),)
+
+class schema_bytes(SchemaProof):
+    HASH_HMAC_KEY = test_core.boxed_bytes.HASH_HMAC_KEY
+    FIELDS = (('buf', VarBytes()),)
+
+class schema_objs(SchemaProof):
+    HASH_HMAC_KEY = test_core.boxed_objs.HASH_HMAC_KEY
+    FIELDS = (('buf', Obj(schema_bytes)),
+              ('i', Obj(schema_varuint)))
+
+    def __init__(self, buf, i):
+        object.__setattr__(self, 'buf', schema_bytes(buf))
+        object.__setattr__(self, 'i', schema_varuint(i))
+
+class schema_mixed(SchemaProof):
+    """Runs of fixed-length fields, and a hand-written nested class"""
+    HASH_HMAC_KEY = x('0b8e0ba2b2d3b4ea77e2c5dd8e1f0c39')
+    FIELDS = (('a', FixedBytes(4)),
+              ('b', FixedBytes(2)),
+              ('n', VarUInt()),
+              ('c', FixedBytes(1)),
+              ('obj', Obj(test_core.boxed_objs)),
+              ('d', FixedBytes(3)))
+
+class schema_awkward_names(SchemaProof):
+    """Field names that clash with names used in the generated code"""
+    HASH_HMAC_KEY = x('3c5e2f8d9a0b1c4d6e7f8091a2b3c4d5')
+    FIELDS = (('self', VarUInt()),
+              ('check_length', FixedBytes(2)),
+              ('cls', FixedBytes(1)),
+              ('buf', VarBytes()),
+              ('pos', Obj(schema_varuint)),
+              ('parts', VarUInt()),
+              ('ctx', FixedBytes(1)),
+              ('d', VarBytes()))
+
+class Test_SchemaProof(unittest.TestCase):
+    def test_varuint(self):
+        for expected_hex_bytes, expected_value in load_test_vectors('valid_varuints.json'):
+            expected_bytes = x(expected_hex_bytes)
+            self.assertEqual(b2x(expected_bytes), b2x(schema_varuint(expected_value).serialize()))
+            self.assertEqual(expected_value, schema_varuint.deserialize(expected_bytes).i)
+
+    def test_objs(self):
+        """Byte-compatible with the hand-written equivalents"""
+        for expected_hex_serialized_bytes, expected_hex_buf, expected_i, expected_hex_hash \
+                in load_test_vectors('valid_boxed_objs.json'):
+
+            expected_serialized_bytes = x(expected_hex_serialized_bytes)
+            expected_buf = x(expected_hex_buf)
+
+            obj = schema_objs(expected_buf, expected_i)
+            self.assertEqual(b2x(expected_serialized_bytes), b2x(obj.serialize()))
+            self.assertEqual(expected_hex_hash, b2x(obj.hash))
+
+            obj2 = schema_objs.deserialize(expected_serialized_bytes)
+            self.assertEqual(expected_buf, obj2.buf.buf)
+            self.assertEqual(expected_i, obj2.i.i)
+            self.assertEqual(expected_hex_hash, b2x(obj2.hash))
+
+            # generic contexts still work
+            ctx = BytesSerializationContext()
+            obj.ctx_serialize(ctx)
+            self.assertEqual(b2x(expected_serialized_bytes), b2x(ctx.getbytes()))
+            self.assertEqual(expected_hex_hash, b2x(ImmutableProof.calc_hash(obj)))
+
+            obj3 = schema_objs.buffer_deserialize(expected_serialized_bytes, materialize=True)
+            self.assertEqual(expected_i, obj3.i.i)
+
+        self.assertEqual({'buf':'deadbeef'}, schema_bytes(x('deadbeef')).json_serialize())
+
+    def test_mixed(self):
+        obj = schema_mixed(x('01020304'), x('0506'), 300, x('07'),
+                           test_core.boxed_objs(x('deadbeef'), 128), x('08090a'))
+
+        expected_serialized_bytes = x('01020304 0506 ac02 07 04deadbeef8001 08090a')
+        self.assertEqual(b2x(expected_serialized_bytes), b2x(obj.serialize()))
+
+        ctx = BytesSerializationContext()
+        obj.ctx_serialize(ctx)
+        self.assertEqual(b2x(expected_serialized_bytes), b2x(ctx.getbytes()))
+        self.assertEqual(b2x(ImmutableProof.calc_hash(obj)), b2x(obj.hash))
+
+        obj2 = schema_mixed.deserialize(expected_serialized_bytes)
+        for name in ('a', 'b', 'n', 'c', 'd'):
+            self.assertEqual(getattr(obj, name), getattr(obj2, name))
+        self.assertEqual(b2x(obj.hash), b2x(obj2.hash))
+
+        with self.assertRaises(ValueError):
+            schema_mixed(x('0102'), x('0506'), 300, x('07'), obj.obj, x('08090a')).serialize()
+
+    def test_invalid(self):
+        for hex_buf in ('', '04deadbe', '04deadbeef', '04deadbeef80'):
+            with self.assertRaises(TruncationError):
+                schema_objs.deserialize(x(hex_buf))
+
+        with self.assertRaises(TruncationError):
+            schema_mixed.deserialize(x('01020304 05'))
+
+        with self.assertRaises(TrailingDataError):
+            schema_objs.deserialize(x('04deadbeef800100'))
+
+    def test_limits(self):
+        buf = schema_objs(x('deadbeef'), 128).serialize()
+        self.assertEqual(b2x(buf), b2x(schema_objs.deserialize(buf, DeserializationLimits()).serialize()))
+
+        for limits in (DeserializationLimits(max_bytes_length=3),
+                       DeserializationLimits(max_bytes=len(buf) - 1),
+                       DeserializationLimits(max_varuint_bytes=1),
+                       DeserializationLimits(max_depth=0)):
+            with self.assertRaises(LimitExceededError):
+                schema_objs.deserialize(buf, limits)
+
+    def test_awkward_names(self):
+        obj = schema_awkward_names(1, x('0203'), x('04'), x('0506'), schema_varuint(7), 8, x('09'), x('0a'))
+        buf = obj.serialize()
+        self.assertEqual('01 0203 04 020506 07 08 09 010a'.replace(' ', ''), b2x(buf))
+
+        for obj2 in (schema_awkward_names.deserialize(buf),
+                     schema_awkward_names.buffer_deserialize(buf, materialize=True)):
+            for name in ('self', 'check_length', 'cls', 'buf', 'parts', 'ctx', 'd'):
+                self.assertEqual(getattr(obj, name), getattr(obj2, name))
+            self.assertEqual(7, obj2.pos.i)
+            self.assertEqual(b2x(obj.hash), b2x(obj2.hash))
+        self.assertEqual(b2x(obj.hash), b2x(ImmutableProof.calc_hash.__get__(obj)()))
+
+        with self.assertRaises(ValueError):
+            schema_awkward_names(1, x('02'), x('04'), x('0506'), schema_varuint(7), 8, x('09'), x('0a')).serialize()
+
+    def test_invalid_names(self):
+        for name in ('a b', '', '1a', 'class', 'None', '__pm_x', 'hash', 'serialize', '__init__', 42):
+            with self.assertRaises(ValueError):
+                class foo(SchemaProof):
+                    FIELDS = ((name, VarUInt()),)
+
+        with self.assertRaises(ValueError):
+            class foo(SchemaProof):
+                FIELDS = (('a', VarUInt()), ('a', VarBytes()))
@@ -0,0 +1,239 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import asyncio
+import io
+import os
+import random
+import threading
+import unittest
+import unittest.mock
+
+import proofmarshal
+from proofmarshal.stream import *
+from proofmarshal.test import x, b2x
+from proofmarshal.test.test_core import boxed_bytes, boxed_objs
+from proofmarshal.test.test_merbinnertree import BytesBytesMerbinnerTree
+
+class hex_serializer(proofmarshal.Serializer):
+    @classmethod
+    def ctx_serialize(cls, self, ctx):
+        ctx.write_bytes('buf', self)
+
+def make_objs():
+    return [boxed_objs(x('deadbeef'), 1),
+            boxed_objs(b'\xff' * 300, 2**20),
+            boxed_objs(b'', 0)]
+
+class Test_PushParser(unittest.TestCase):
+    def test_chunks(self):
+        """Every object is returned, in order, regardless of chunking"""
+        objs = make_objs()
+        buf = b''.join(obj.serialize() for obj in objs)
+
+        for chunk_size in (1, 2, 7, 100, len(buf)):
+            parser = PushParser(boxed_objs)
+            actual = []
+            for i in range(0, len(buf), chunk_size):
+                actual.extend(parser.feed(buf[i:i+chunk_size]))
+            actual.extend(parser.close())
+            self.assertEqual([b2x(obj.serialize()) for obj in objs],
+                             [b2x(obj.serialize()) for obj in actual])
+
+    def test_large_bytes(self):
+        """A large byte array is only parsed once it has all arrived"""
+        obj = boxed_bytes(b'\x00' * 100000)
+        buf = obj.serialize()
+
+        parser = PushParser(boxed_bytes)
+        calls = []
+        orig_ctx_deserialize = boxed_bytes.ctx_deserialize
+        def ctx_deserialize(ctx):
+            calls.append(ctx)
+            return orig_ctx_deserialize(ctx)
+        parser.serialization_class = type('counted_boxed_bytes', (boxed_bytes,),
+                                          {'ctx_deserialize': staticmethod(ctx_deserialize)})
+
+        actual = []
+        for i in range(0, len(buf), 1000):
+            actual.extend(parser.feed(buf[i:i+1000]))
+        self.assertEqual(1, len(actual))
+        self.assertEqual(obj.buf, actual[0].buf)
+        self.assertLessEqual(len(calls), 3)
+
+    def test_merbinnertree(self):
+        rand = random.Random(0)
+        mbtree = BytesBytesMerbinnerTree((rand.getrandbits(32).to_bytes(4, 'big'), x('deadbeef'))
+                                         for i in range(100))
+        buf = mbtree.serialize() * 2
+
+        parser = PushParser(BytesBytesMerbinnerTree)
+        actual = []
+        for i in range(0, len(buf), 50):
+            actual.extend(parser.feed(buf[i:i+50]))
+        actual.extend(parser.close())
+        self.assertEqual(2, len(actual))
+        for actual_tree in actual:
+            self.assertEqual(mbtree, actual_tree)
+            self.assertEqual(b2x(mbtree.hash), b2x(actual_tree.hash))
+
+    def test_linear(self):
+        """Objects arriving in many chunks are parsed in linear time"""
+        rand = random.Random(0)
+        mbtree = BytesBytesMerbinnerTree((rand.getrandbits(32).to_bytes(4, 'big'), x('deadbeef'))
+                                         for i in range(2000))
+        buf = mbtree.serialize() * 3
+
+        parser = PushParser(BytesBytesMerbinnerTree)
+        parsed = []
+        orig_ctx_deserialize = BytesBytesMerbinnerTree.ctx_deserialize
+        def ctx_deserialize(ctx):
+            parsed.append(len(ctx.buf))
+            return orig_ctx_deserialize(ctx)
+
+        actual = []
+        threads = threading.active_count()
+        with unittest.mock.patch.object(BytesBytesMerbinnerTree, 'ctx_deserialize', ctx_deserialize):
+            for i in range(0, len(buf), 1024):
+                actual.extend(parser.feed(buf[i:i+1024]))
+                self.assertEqual(threads, threading.active_count())
+            actual.extend(parser.close())
+
+        self.assertEqual(3, len(actual))
+        for actual_tree in actual:
+            self.assertEqual(mbtree, actual_tree)
+        self.assertLessEqual(sum(parsed), 4 * len(buf))
+
+    def test_truncated(self):
+        buf = make_objs()[0].serialize()
+        parser = PushParser(boxed_objs)
+        self.assertEqual([], parser.feed(buf[:-1]))
+        self.assertEqual(len(buf) - 1, len(parser))
+        with self.assertRaises(proofmarshal.TruncationError):
+            parser.close()
+
+    def test_stream_truncated(self):
+        """Short reads from a stream raise TruncationError"""
+        buf = make_objs()[0].serialize()
+        with self.assertRaises(proofmarshal.TruncationError):
+            boxed_objs.stream_deserialize(io.BytesIO(buf[:-1]))
+
+    def test_length_prefixed(self):
+        objs = make_objs()
+        buf = b''.join(proofmarshal.varuint.encode(len(obj.serialize())) + obj.serialize() for obj in objs)
+
+        parser = PushParser(boxed_objs, length_prefixed=True)
+        actual = []
+        for i in range(len(buf)):
+            actual.extend(parser.feed(buf[i:i+1]))
+        parser.close()
+        self.assertEqual([b2x(obj.serialize()) for obj in objs],
+                         [b2x(obj.serialize()) for obj in actual])
+
+        # Prefix doesn't match the object
+        for invalid in (x('05') + objs[0].serialize(), x('07') + objs[0].serialize() + x('00')):
+            with self.assertRaises(proofmarshal.DeserializationError):
+                PushParser(boxed_objs, length_prefixed=True).feed(invalid)
+
+    def test_limits(self):
+        """Limits are checked before waiting for more data"""
+        limits = proofmarshal.DeserializationLimits(max_bytes=1000)
+        buf = make_objs()[0].serialize()
+
+        parser = PushParser(boxed_objs, limits=limits)
+        self.assertEqual(1, len(parser.feed(buf)))
+        with self.assertRaises(proofmarshal.LimitExceededError):
+            # Start of a 2**21 byte array
+            parser.feed(x('80808001'))
+
+        parser = PushParser(boxed_objs, length_prefixed=True, limits=limits)
+        self.assertEqual(1, len(parser.feed(proofmarshal.varuint.encode(len(buf)) + buf)))
+        with self.assertRaises(proofmarshal.LimitExceededError):
+            parser.feed(proofmarshal.varuint.encode(2**30))
+
+class Test_iter_deserialize(unittest.TestCase):
+    def test_roundtrip(self):
+        """BatchWriter output is read back by iter_deserialize()"""
+        objs = make_objs() * 100
+        for length_prefixed in (False, True):
+            fd = io.BytesIO()
+            with BatchWriter(fd, length_prefixed, batch_size=1000) as writer:
+                writer.write_many(objs)
+
+            fd.seek(0)
+            actual = list(iter_deserialize(fd, boxed_objs, length_prefixed, block_size=100))
+            self.assertEqual([b2x(obj.serialize()) for obj in objs],
+                             [b2x(obj.serialize()) for obj in actual])
+
+    def test_pipe(self):
+        """Objects are read from an unbuffered pipe in blocks"""
+        objs = make_objs() * 100
+        rfd, wfd = os.pipe()
+
+        def write():
+            with open(wfd, 'wb', buffering=0) as fd:
+                with BatchWriter(fd, batch_size=4096) as writer:
+                    writer.write_many(objs)
+        writer = threading.Thread(target=write)
+        writer.start()
+
+        reads = []
+        with open(rfd, 'rb', buffering=0) as fd:
+            orig_read = fd.read
+            class counted_fd:
+                def read(self, n):
+                    reads.append(n)
+                    return orig_read(n)
+            actual = list(iter_deserialize(counted_fd(), boxed_objs))
+        writer.join()
+
+        self.assertEqual(len(objs), len(actual))
+        self.assertLess(len(reads), 100)
+
+    def test_serialization_class(self):
+        fd = io.BytesIO()
+        with BatchWriter(fd) as writer:
+            writer.write(x('deadbeef'), hex_serializer)
+        self.assertEqual('04deadbeef', b2x(fd.getvalue()))
+
+    def test_truncated(self):
+        buf = make_objs()[0].serialize()
+        with self.assertRaises(proofmarshal.TruncationError):
+            list(iter_deserialize(io.BytesIO(buf + buf[:-1]), boxed_objs))
+
+class Test_AsyncReader(unittest.TestCase):
+    def test_read(self):
+        objs = make_objs()
+        buf = b''.join(obj.serialize() for obj in objs)
+
+        async def main():
+            reader = asyncio.StreamReader()
+            for i in range(0, len(buf), 3):
+                reader.feed_data(buf[i:i+3])
+            reader.feed_eof()
+
+            return [obj async for obj in AsyncReader(reader, boxed_objs, chunk_size=5)]
+
+        actual = asyncio.run(main())
+        self.assertEqual([b2x(obj.serialize()) for obj in objs],
+                         [b2x(obj.serialize()) for obj in actual])
+
+    def test_truncated(self):
+        buf = make_objs()[0].serialize()
+
+        async def main():
+            reader = asyncio.StreamReader()
+            reader.feed_data(buf[:-1])
+            reader.feed_eof()
+            await AsyncReader(reader, boxed_objs).read()
+
+        with self.assertRaises(proofmarshal.TruncationError):
+            asyncio.run(main())
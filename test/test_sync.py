@@ -0,0 +1,92 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import random
+import unittest
+
+import proofmarshal
+from proofmarshal.merbinnertree import PersistentMerbinnerTree, TreeDiff
+from proofmarshal.sync import *
+from proofmarshal.test import x, b2x
+from proofmarshal.test.test_merbinnertree import BytesBytesMerbinnerTree, SummedBytesBytesMerbinnerTree
+
+def random_items(n, seed=0):
+    rand = random.Random(seed)
+    return {rand.getrandbits(32).to_bytes(4, 'big'): rand.getrandbits(32).to_bytes(4, 'big')
+            for i in range(n)}
+
+class Test_sync(unittest.TestCase):
+    def test_sync(self):
+        items = random_items(10000)
+        keys = list(items)
+        local = BytesBytesMerbinnerTree(items)
+        remote = BytesBytesMerbinnerTree(items)
+
+        transport = LocalTransport(SyncServer(remote))
+        self.assertEqual(TreeDiff({}, {}, {}), sync(local, transport))
+        self.assertEqual(1, transport.round_trips)
+
+        remote[keys[0]] = x('cafebabe')
+        del remote[keys[1]]
+        remote[x('00000000')] = x('baadf00d')
+        expected_diff = local.diff(remote)
+
+        transport = LocalTransport(SyncServer(remote))
+        self.assertEqual(expected_diff, sync(local, transport))
+        self.assertEqual(b2x(remote.hash), b2x(local.hash))
+        self.assertEqual(remote, local)
+
+        # Proportional to the differences and depth, not the size of the tree
+        self.assertLess(transport.round_trips, 40)
+        self.assertLess(transport.bytes_received, 3 * 40 * 2 * 33)
+
+    def test_sync_diff(self):
+        """Trees of different shapes"""
+        for local_items, remote_items in (({}, random_items(100)),
+                                          (random_items(100), {}),
+                                          (random_items(100, 1), random_items(100, 2)),
+                                          (random_items(1), random_items(100))):
+            local = PersistentMerbinnerTree(BytesBytesMerbinnerTree, local_items)
+            remote = BytesBytesMerbinnerTree(remote_items)
+            diff = sync_diff(local, LocalTransport(SyncServer(remote)))
+            self.assertEqual(local.diff(remote), diff)
+
+            synced = dict(local)
+            for key in diff.removed:
+                del synced[key]
+            synced.update(diff.added)
+            synced.update({key: new_value for key, (old_value, new_value) in diff.changed.items()})
+            self.assertEqual(remote, synced)
+
+    def test_summed(self):
+        local = SummedBytesBytesMerbinnerTree({x('ffffffff'): x('deadbeef0001'),
+                                               x('00000000'): x('baadf00d0005')})
+        remote = SummedBytesBytesMerbinnerTree(local)
+        remote[x('00000000')] = x('baadf00d0007')
+        sync(local, LocalTransport(SyncServer(remote)))
+        self.assertEqual(b2x(remote.hash), b2x(local.hash))
+
+    def test_pruned_server(self):
+        remote = BytesBytesMerbinnerTree(random_items(100))
+        local = BytesBytesMerbinnerTree()
+        with self.assertRaises(ValueError):
+            sync(local, LocalTransport(SyncServer(remote.prove(x('00000000')))))
+
+    def test_invalid_requests(self):
+        server = SyncServer(BytesBytesMerbinnerTree(random_items(100)))
+        for invalid in ('01 02 04',     # prefix longer than depth
+                        '01 00',        # truncated
+                        '01 00 00 00'): # trailing data
+            with self.assertRaises(proofmarshal.DeserializationError):
+                server.handle(x(invalid))
+
+        with self.assertRaises(ValueError):
+            server.handle(x('01 40 00'))
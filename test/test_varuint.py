@@ -0,0 +1,51 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import unittest
+
+from proofmarshal import varuint
+from proofmarshal.test import load_test_vectors, x, b2x
+
+class Test_varuint(unittest.TestCase):
+    def test_vectors(self):
+        """Test single value encode/decode against vectors"""
+        for expected_hex_bytes, expected_value in load_test_vectors('valid_varuints.json'):
+            expected_bytes = x(expected_hex_bytes)
+
+            self.assertEqual(b2x(expected_bytes), b2x(varuint.encode(expected_value)))
+            self.assertEqual((expected_value, len(expected_bytes)), varuint.decode(expected_bytes))
+
+    def test_large_values(self):
+        for value in (2**14-1, 2**14, 2**32, 2**64-1, 2**200):
+            buf = varuint.encode(value)
+            self.assertEqual((value, len(buf)), varuint.decode(buf))
+
+    def test_many(self):
+        """Bulk encode/decode matches single value encode/decode"""
+        values = [0, 1, 127, 128, 300, 16383, 16384, 2**32, 5]
+        buf = varuint.encode_many(values)
+        self.assertEqual(b''.join(varuint.encode(v) for v in values), buf)
+
+        self.assertEqual((values, len(buf)), varuint.decode_many(buf))
+        self.assertEqual((values[:3], 3), varuint.decode_many(buf, 3))
+        self.assertEqual((values[1:], len(buf)), varuint.decode_many(buf, offset=1))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            varuint.encode(-1)
+        with self.assertRaises(ValueError):
+            varuint.encode_many([1, -1])
+        with self.assertRaises(ValueError):
+            varuint.decode(x('8080'))
+        with self.assertRaises(ValueError):
+            varuint.decode_many(x('0180'))
+        with self.assertRaises(ValueError):
+            varuint.decode_many(x('01'), 2)
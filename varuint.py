@@ -0,0 +1,110 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Variable-length unsigned integer codec
+
+Unsigned little-endian base128 format (LEB128); each byte holds seven bits of
+the value, least significant first, with the high bit set on every byte but
+the last.
+"""
+
+# Values below this are encoded by table lookup; that covers every one and two
+# byte encoding, which is almost everything seen in practice.
+TABLE_LIMIT = 2**14
+
+_ENCODE_TABLE = tuple([bytes([i]) for i in range(0x80)] +
+                      [bytes([i & 0x7f | 0x80, i >> 7]) for i in range(0x80, TABLE_LIMIT)])
+
+def _encode_into(buf, value):
+    """Append the encoding of a value outside the table to a bytearray"""
+    while value > 0x7f:
+        buf.append(value & 0x7f | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def encode(value):
+    """Encode a single value to bytes"""
+    if 0 <= value < TABLE_LIMIT:
+        return _ENCODE_TABLE[value]
+    elif value < 0:
+        raise ValueError('varuint must not be negative; got %d' % value)
+    else:
+        buf = bytearray()
+        _encode_into(buf, value)
+        return bytes(buf)
+
+def encode_many(values):
+    """Encode a sequence of values to bytes in a single pass"""
+    buf = bytearray()
+    table = _ENCODE_TABLE
+    for value in values:
+        if 0 <= value < TABLE_LIMIT:
+            buf += table[value]
+        elif value < 0:
+            raise ValueError('varuint must not be negative; got %d' % value)
+        else:
+            _encode_into(buf, value)
+    return bytes(buf)
+
+def decode(buf, offset=0):
+    """Decode a single value from a buffer
+
+    Returns (value, offset) where offset is the position just past the
+    encoded value.
+    """
+    try:
+        b = buf[offset]
+        if b < 0x80:
+            return (b, offset + 1)
+
+        value = b & 0x7f
+        shift = 7
+        while True:
+            offset += 1
+            b = buf[offset]
+            value |= (b & 0x7f) << shift
+            if b < 0x80:
+                return (value, offset + 1)
+            shift += 7
+
+    except IndexError:
+        raise ValueError('truncated varuint') from None
+
+def decode_many(buf, count=None, offset=0):
+    """Decode a sequence of values from a buffer in a single pass
+
+    If count is None values are decoded until the end of the buffer.
+
+    Returns (values, offset)
+    """
+    values = []
+    append = values.append
+    end = len(buf)
+    if count is not None:
+        for i in range(count):
+            if offset < end and buf[offset] < 0x80:
+                append(buf[offset])
+                offset += 1
+            else:
+                value, offset = decode(buf, offset)
+                append(value)
+
+    else:
+        while offset < end:
+            b = buf[offset]
+            if b < 0x80:
+                append(b)
+                offset += 1
+            else:
+                value, offset = decode(buf, offset)
+                append(value)
+
+    return (values, offset)